@@ -0,0 +1,759 @@
+import argparse
+import asyncio
+import builtins
+import contextlib
+import csv
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import manager
+
+BOOK_SIZES = [10_000, 100_000, 1_000_000]
+BENCHMARK_SEED = 2024
+
+FIRST_NAMES = [
+    "Aarav",
+    "Amelia",
+    "Carlos",
+    "Chen",
+    "Fatima",
+    "Hannah",
+    "Ivan",
+    "Kenji",
+    "Lucia",
+    "Mohammed",
+    "Noah",
+    "Olivia",
+    "Priya",
+    "Sofia",
+    "Tomasz",
+    "Yara",
+]
+LAST_NAMES = [
+    "Anderson",
+    "Garcia",
+    "Ivanova",
+    "Kim",
+    "Kowalski",
+    "Martin",
+    "Nakamura",
+    "Okafor",
+    "Patel",
+    "Rossi",
+    "Schmidt",
+    "Silva",
+    "Smith",
+    "Wang",
+]
+COMPANIES = ["Acme", "Globex", "Initech", "Umbrella", "Stark Industries", "Wayne"]
+OCCUPATIONS = ["Engineer", "Designer", "Manager", "Nurse", "Teacher", "Accountant"]
+GROUPS = ["Family", "Friends", "Work", "Gym", "Neighbours", "Book Club"]
+MELODIES = ["Happy Jazz", "Morning Sunrise", "Relaxing Guitar", "Upbeat Dance"]
+DEFAULT_MELODY = "Calm Piano"
+
+SEARCH_QUERIES = ["patel", "globex", "5550012", "@example.org", "amelia kim"]
+FUZZY_QUERIES = ["amelai kim", "nakamra", "olivai", "schmit", "kowalsky"]
+LOAD_SEARCH_QUERIES = ["amelia kim", "5550012", "kenji.patel", "yara iv"]
+AUTOCOMPLETE_PREFIXES = ["a", "amelia k", "kim", "555001", "5581", "zz"]
+REMINDER_DAYS = "30"
+
+
+def random_birthday(rng, first_year, last_year):
+    start = date(first_year, 1, 1)
+    end = date(last_year, 12, 31)
+    return (start + timedelta(days=rng.randrange((end - start).days))).isoformat()
+
+
+def generate_rows(count, seed=BENCHMARK_SEED):
+    rng = random.Random(seed)
+    for number in range(count):
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        # 7919 is coprime with 10**7, so every contact gets its own numbers.
+        line = f"{number * 7919 % 10**7:07d}"
+        email_name = f"{first_name}.{last_name}.{number}".lower()
+        works = rng.random() < 0.6
+        married = rng.random() < 0.4
+
+        children = []
+        for _ in range(rng.choice([0, 0, 0, 1, 1, 2, 3])):
+            children.append(
+                {
+                    "name": f"{rng.choice(FIRST_NAMES)} {last_name}",
+                    "birthday": random_birthday(rng, 1995, 2022),
+                }
+            )
+
+        yield (
+            f"{first_name} {last_name}",
+            f"555{line}",
+            rng.choice(GROUPS) if rng.random() < 0.7 else "",
+            rng.choice(COMPANIES) if works else "",
+            rng.choice(OCCUPATIONS) if works else "",
+            f"{rng.randint(1, 999)} Market Street" if works else "",
+            f"https://{rng.choice(COMPANIES).lower()}.example.com" if works else "",
+            f"556{line}" if rng.random() < 0.2 else "",
+            "",
+            f"557{line}" if rng.random() < 0.3 else "",
+            f"558{line}" if works and rng.random() < 0.5 else "",
+            f"{email_name}@example.org",
+            f"{email_name}@mail.example.net" if rng.random() < 0.2 else "",
+            f"{email_name}@work.example.com" if works else "",
+            rng.choice(MELODIES) if rng.random() < 0.3 else DEFAULT_MELODY,
+            f"{rng.randint(1, 250)} {rng.choice(LAST_NAMES)} Road",
+            random_birthday(rng, 1940, 2005),
+            "",
+            f"{rng.choice(FIRST_NAMES)} {last_name}" if married else "",
+            random_birthday(rng, 1940, 2005) if married else "",
+            "",
+            json.dumps(children),
+        )
+
+
+def generate_book(directory, count, seed=BENCHMARK_SEED):
+    group_counts = dict.fromkeys(GROUPS, 0)
+    melody_counts = dict.fromkeys(MELODIES + [DEFAULT_MELODY], 0)
+
+    contacts_filename = os.path.join(directory, "contacts.csv")
+    with open(contacts_filename, mode="w", newline="", encoding="utf-8") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(manager.CONTACT_FIELDNAMES)
+        for row in generate_rows(count, seed):
+            writer.writerow(row)
+            if row[2]:
+                group_counts[row[2]] += 1
+            melody_counts[row[manager.MELODY_COLUMN]] += 1
+
+    manager.write_to_file(
+        [{"name": name, "count": count} for name, count in group_counts.items()],
+        os.path.join(directory, "groups.txt"),
+    )
+    manager.write_to_file(
+        [{"name": name, "count": count} for name, count in melody_counts.items()],
+        os.path.join(directory, "melodies.txt"),
+    )
+    return contacts_filename
+
+
+@contextlib.contextmanager
+def scripted_session(answers=()):
+    # The menu functions are interactive, so they get canned answers and their
+    # output is thrown away to keep terminal speed out of the timings.
+    answers = iter(answers)
+    original_input = builtins.input
+    builtins.input = lambda prompt="": next(answers)
+    try:
+        with open(os.devnull, mode="w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                yield
+    finally:
+        builtins.input = original_input
+
+
+def time_runs(function, repeat):
+    runs = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        runs.append(time.perf_counter() - start)
+    return runs, result
+
+
+def refresh_counts(groups, melodies, indexes):
+    store = manager.Store()
+    for item in groups + melodies:
+        item["count"] = 0
+    manager.update_counts(groups, indexes, store, "groups", *manager.find_names(groups))
+    manager.update_counts(
+        melodies, indexes, store, "melodies", *manager.find_names(melodies)
+    )
+
+
+def list_members(indexes):
+    for group_name in GROUPS:
+        manager.indexed_members(indexes, "group", group_name)
+    for melody_name in MELODIES:
+        manager.indexed_members(indexes, "melody", melody_name)
+
+
+def show_counters(groups, melodies):
+    with scripted_session(["", ""]):
+        manager.show_groups(groups)
+        manager.show_melodies(melodies)
+
+
+def search_contacts(contacts, indexes):
+    # Long result lists are paged; the empty answer leaves the pager.
+    for query in SEARCH_QUERIES:
+        with scripted_session([query, ""]):
+            manager.search_contact(contacts, indexes)
+
+
+def complete_prefixes(indexes):
+    for prefix in AUTOCOMPLETE_PREFIXES:
+        manager.complete_contacts(indexes, prefix)
+
+
+def fuzzy_search(indexes):
+    for query in FUZZY_QUERIES:
+        manager.fuzzy_find_contacts(indexes, query)
+
+
+def birthday_reminders(contacts, indexes):
+    with scripted_session([REMINDER_DAYS]):
+        manager.manage_birthday_reminders(contacts, indexes)
+
+
+def list_contacts(contacts):
+    with scripted_session(["n", ""]):
+        manager.print_contact_list(contacts)
+
+
+def benchmark_book(directory, size, seed, repeat):
+    generate_start = time.perf_counter()
+    filename = generate_book(directory, size, seed)
+    print(
+        f"Generated {size} contacts in {time.perf_counter() - generate_start:.2f}s",
+        file=sys.stderr,
+    )
+    groups = manager.read_from_file(os.path.join(directory, "groups.txt"))
+    melodies = manager.read_from_file(os.path.join(directory, "melodies.txt"))
+    output_filename = os.path.join(directory, "written.csv")
+
+    results = {}
+    runs, contacts = time_runs(lambda: manager.read_contacts_from_csv(filename), repeat)
+    results["read_contacts_from_csv"] = runs
+    runs, indexes = time_runs(lambda: manager.build_indexes(contacts), repeat)
+    results["build_indexes"] = runs
+    results["write_contacts_to_csv"], _ = time_runs(
+        lambda: manager.write_contacts_to_csv(contacts, output_filename), repeat
+    )
+    results["search_contact"], _ = time_runs(
+        lambda: search_contacts(contacts, indexes), repeat
+    )
+    results["complete_contacts"], _ = time_runs(
+        lambda: complete_prefixes(indexes), repeat
+    )
+    results["fuzzy_find_contacts"], _ = time_runs(lambda: fuzzy_search(indexes), repeat)
+    results["find_duplicate_clusters"], _ = time_runs(
+        lambda: manager.find_duplicate_clusters(contacts), repeat
+    )
+    results["manage_birthday_reminders"], _ = time_runs(
+        lambda: birthday_reminders(contacts, indexes), repeat
+    )
+    results["print_contact_list"], _ = time_runs(
+        lambda: list_contacts(contacts), repeat
+    )
+    results["update_counts"], _ = time_runs(
+        lambda: refresh_counts(groups, melodies, indexes), repeat
+    )
+    results["indexed_members"], _ = time_runs(lambda: list_members(indexes), repeat)
+    results["show_groups_and_melodies"], _ = time_runs(
+        lambda: show_counters(groups, melodies), repeat
+    )
+
+    return [
+        {
+            "benchmark": name,
+            "size": size,
+            "runs": runs,
+            "best": min(runs),
+            "median": statistics.median(runs),
+        }
+        for name, runs in results.items()
+    ]
+
+
+def run_suite(sizes, seed, repeat):
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "seed": seed,
+        "repeat": repeat,
+        "results": [],
+    }
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            for result in benchmark_book(directory, size, seed, repeat):
+                report["results"].append(result)
+                print(
+                    f"{size:>8} {result['benchmark']:<28} "
+                    f"best {result['best']:9.4f}s median {result['median']:9.4f}s",
+                    file=sys.stderr,
+                )
+    return report
+
+
+def compare_reports(baseline_filename, current_filename):
+    with open(baseline_filename, encoding="utf-8") as file:
+        baseline = json.load(file)
+    with open(current_filename, encoding="utf-8") as file:
+        current = json.load(file)
+
+    baseline_times = {
+        (result["benchmark"], result["size"]): result["best"]
+        for result in baseline["results"]
+    }
+    print(
+        f"{'benchmark':<28} {'size':>8} {'baseline':>10} {'current':>10} {'change':>8}"
+    )
+    for result in current["results"]:
+        key = (result["benchmark"], result["size"])
+        if key not in baseline_times:
+            continue
+        before = baseline_times[key]
+        after = result["best"]
+        change = (after - before) / before * 100 if before else 0.0
+        print(
+            f"{result['benchmark']:<28} {result['size']:>8} "
+            f"{before:9.4f}s {after:9.4f}s {change:+7.1f}%"
+        )
+
+
+async def http_request(reader, writer, method, path, body=None):
+    data = b"" if body is None else json.dumps(body).encode("utf-8")
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\n"
+        f"Host: localhost\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(data)}\r\n"
+        f"\r\n".encode("latin-1") + data
+    )
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    position = max(0, int(len(sorted_values) * fraction + 0.5) - 1)
+    return sorted_values[min(position, len(sorted_values) - 1)]
+
+
+async def load_client(host, port, client, requests, write_ratio, phones, rng, timings):
+    # Writes add a throwaway contact and delete it again right away, so a load
+    # test leaves the book as it found it.
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for number in range(requests):
+            if rng.random() < write_ratio:
+                phone = f"999{client:04d}{number:06d}"
+                requests_to_send = [
+                    (
+                        "write",
+                        "POST",
+                        "/contacts",
+                        {"name": f"Load Test {client} {number}", "mobile_phone": phone},
+                    ),
+                    ("write", "DELETE", f"/contacts/{phone}", None),
+                ]
+            else:
+                path = rng.choice(
+                    [
+                        f"/contacts/{rng.choice(phones)}",
+                        f"/contacts/search?q={rng.choice(LOAD_SEARCH_QUERIES)}",
+                        f"/contacts/complete?prefix={rng.choice(AUTOCOMPLETE_PREFIXES)}",
+                        f"/contacts?offset={rng.randrange(len(phones))}&limit=25",
+                        "/birthdays?days=1",
+                    ]
+                ).replace(" ", "%20")
+                requests_to_send = [("read", "GET", path, None)]
+
+            for kind, method, path, body in requests_to_send:
+                start = time.perf_counter()
+                status, _ = await http_request(reader, writer, method, path, body)
+                timings.append((kind, time.perf_counter() - start, status))
+    finally:
+        writer.close()
+
+
+async def run_load_test(host, port, connections, requests, write_ratio, seed):
+    reader, writer = await asyncio.open_connection(host, port)
+    _, listing = await http_request(reader, writer, "GET", "/contacts?limit=1000")
+    writer.close()
+    phones = [contact["mobile_phone"] for contact in listing["contacts"]]
+    if not phones:
+        raise SystemExit("The server has no contacts to load test with.")
+
+    timings = []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            load_client(
+                host,
+                port,
+                client,
+                requests,
+                write_ratio,
+                phones,
+                random.Random(seed + client),
+                timings,
+            )
+            for client in range(connections)
+        )
+    )
+    return timings, time.perf_counter() - start
+
+
+def benchmark_server(host, port, connections, requests, write_ratio, seed):
+    timings, elapsed = asyncio.run(
+        run_load_test(host, port, connections, requests, write_ratio, seed)
+    )
+    errors = sum(1 for _, _, status in timings if status >= 400)
+    print(
+        f"{len(timings)} requests over {connections} connection(s) in {elapsed:.2f}s: "
+        f"{len(timings) / elapsed:.0f} requests/s, {errors} error(s)"
+    )
+    for kind in ("all", "read", "write"):
+        latencies = sorted(
+            latency
+            for request_kind, latency, _ in timings
+            if kind in ("all", request_kind)
+        )
+        if not latencies:
+            continue
+        print(
+            f"{kind:<6} {len(latencies):>8} requests  "
+            f"p50 {percentile(latencies, 0.5) * 1000:8.2f}ms  "
+            f"p99 {percentile(latencies, 0.99) * 1000:8.2f}ms  "
+            f"max {latencies[-1] * 1000:8.2f}ms"
+        )
+
+
+def worker_counts(max_workers):
+    counts = []
+    workers = 1
+    while workers < max_workers:
+        counts.append(workers)
+        workers *= 2
+    counts.append(max_workers)
+    return counts
+
+
+def benchmark_loader(filename, max_workers):
+    size = os.path.getsize(filename)
+    print(f"Loading {filename} ({size / (1024 * 1024):.1f} MiB)")
+
+    baseline = None
+    for workers in worker_counts(max_workers):
+        start = time.perf_counter()
+        contacts = manager.read_contacts_from_csv(filename, workers=workers)
+        elapsed = time.perf_counter() - start
+        if baseline is None:
+            baseline = elapsed
+
+        print(
+            f"{workers:>3} worker(s): {elapsed:7.2f}s "
+            f"{len(contacts) / elapsed:10.0f} contacts/s "
+            f"{baseline / elapsed:5.2f}x"
+        )
+        del contacts
+
+
+def report_time(label, function):
+    runs, result = time_runs(function, 1)
+    print(f"{label:<36} {runs[0]:7.2f}s")
+    return result
+
+
+def benchmark_shards(directory):
+    # Compares the single CSV file with a sharded copy of the same book: a
+    # full load, loading one group or one phone number, and saving one change.
+    filename = os.path.join(directory, "contacts.csv")
+    contacts = report_time(
+        "csv: load the book", lambda: manager.read_contacts_from_csv(filename)
+    )
+    with tempfile.TemporaryDirectory() as temp_directory:
+        report_time(
+            "csv: rewrite the book",
+            lambda: manager.write_contacts_to_csv(
+                contacts, os.path.join(temp_directory, "contacts.csv")
+            ),
+        )
+
+        for partition in ("hash", "group"):
+            shards_directory = os.path.join(temp_directory, partition)
+            manager.ShardedStore(shards_directory, partition).save_all(contacts, [], [])
+            store = manager.ShardedStore(shards_directory)
+            sharded_contacts = report_time(
+                f"{partition}: load the book", store.load_contacts
+            )
+            if partition == "hash":
+                phone = contacts[len(contacts) // 2].mobile_phone
+                report_time(
+                    "hash: find one mobile phone",
+                    lambda: store.find_contacts(mobile_phone=phone),
+                )
+            else:
+                report_time(
+                    f"group: load the group {GROUPS[0]}",
+                    manager.ShardedStore(
+                        shards_directory, only_groups=[GROUPS[0]]
+                    ).load_contacts,
+                )
+
+            contact = sharded_contacts[len(sharded_contacts) // 2]
+            old_group = contact.group
+            contact.group = GROUPS[1] if old_group == GROUPS[0] else GROUPS[0]
+            store.contact_group_changed(sharded_contacts, contact, old_group)
+            report_time(
+                f"{partition}: save one group change",
+                lambda: store.save_contact_changes(sharded_contacts),
+            )
+            del sharded_contacts
+
+
+def benchmark_snapshot(filename, repeat):
+    with tempfile.TemporaryDirectory() as temp_directory:
+        binary_filename = os.path.join(temp_directory, "contacts.bin")
+        with contextlib.redirect_stdout(sys.stderr):
+            manager.convert_contacts(filename, binary_filename)
+
+        for label, snapshot in (("csv", filename), ("binary", binary_filename)):
+            runs, contacts = time_runs(
+                lambda: manager.read_contacts_from_csv(snapshot, workers=1), repeat
+            )
+            size = os.path.getsize(snapshot)
+            print(
+                f"{label:<8} {size / (1024 * 1024):7.1f} MiB "
+                f"best {min(runs):6.2f}s median {statistics.median(runs):6.2f}s "
+                f"{len(contacts) / min(runs):10.0f} contacts/s"
+            )
+            del contacts
+
+
+def benchmark_lookup(filename, lookups, journal_updates):
+    # Looking one contact up in a loaded book against reading just its record
+    # through the offset index, for the CSV file and its binary snapshot. Then
+    # the same with a journal of updates on top of the CSV file, read afresh
+    # for every lookup and kept folded by a store between lookups.
+    with tempfile.TemporaryDirectory() as temp_directory:
+        binary_filename = os.path.join(temp_directory, "contacts.bin")
+        with contextlib.redirect_stdout(sys.stderr):
+            manager.convert_contacts(filename, binary_filename)
+        phones = [
+            contact.mobile_phone
+            for contact in manager.iter_contacts_from_csv(filename, ["mobile_phone"])
+        ]
+        phones = random.Random(BENCHMARK_SEED).sample(phones, min(lookups, len(phones)))
+
+        report_time(
+            "csv: load and index the book",
+            lambda: manager.build_indexes(manager.read_contacts_from_csv(filename)),
+        )
+        for label, snapshot in (("csv", filename), ("binary", binary_filename)):
+            report_time(
+                f"{label}: build the offset index",
+                lambda: manager.build_offset_index(snapshot),
+            )
+            runs, _ = time_runs(
+                lambda: [
+                    manager.find_snapshot_contact(phone, snapshot) for phone in phones
+                ],
+                1,
+            )
+            print(
+                f"{label + ': one contact via the index':<36} "
+                f"{runs[0] / len(phones) * 1000:7.2f}ms"
+            )
+
+        journal_book = os.path.join(temp_directory, "contacts.csv")
+        contacts = manager.read_contacts_from_csv(filename)
+        manager.write_contacts_to_csv(contacts, journal_book)
+        rng = random.Random(BENCHMARK_SEED)
+        records = []
+        for position in rng.sample(
+            range(len(contacts)), min(journal_updates, len(contacts))
+        ):
+            contact = contacts[position]
+            contact.name = f"{contact.name} (updated)"
+            records.append(
+                {
+                    "op": "update",
+                    "index": position,
+                    "mobile_phone": contact.mobile_phone,
+                    "contact": manager.flatten_contact(contact),
+                }
+            )
+        manager.log_contact_changes(contacts, records, journal_book)
+        if not os.path.exists(manager.journal_filename(journal_book)):
+            print("The journal was compacted; ask for fewer --journal-updates.")
+            return
+        manager.build_offset_index(journal_book)
+
+        store = manager.CSVStore(journal_book)
+        label = f"csv + {len(records)} journal records"
+        for description, find in (
+            (
+                "journal read each time",
+                lambda phone: manager.find_snapshot_contact(phone, journal_book),
+            ),
+            ("journal kept folded", store.find_contact),
+        ):
+            runs, _ = time_runs(lambda: [find(phone) for phone in phones], 1)
+            print(
+                f"{label + ': one contact, ' + description:<36} "
+                f"{runs[0] / len(phones) * 1000:7.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Contact Book Manager benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    suite_parser = subparsers.add_parser(
+        "suite", help="time the main operations on generated contact books"
+    )
+    suite_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=BOOK_SIZES,
+        help="number of contacts in each generated book (default: %(default)s)",
+    )
+    suite_parser.add_argument(
+        "--seed", type=int, default=BENCHMARK_SEED, help="generator seed"
+    )
+    suite_parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per benchmark (default: 3)"
+    )
+    suite_parser.add_argument(
+        "--output", help="write the JSON report to this file instead of stdout"
+    )
+
+    generate_parser = subparsers.add_parser(
+        "generate", help="write a synthetic contact book into a directory"
+    )
+    generate_parser.add_argument("size", type=int, help="number of contacts")
+    generate_parser.add_argument("directory", help="directory for the book files")
+    generate_parser.add_argument(
+        "--seed", type=int, default=BENCHMARK_SEED, help="generator seed"
+    )
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="compare two JSON reports written by the suite"
+    )
+    compare_parser.add_argument("baseline", help="report of the earlier run")
+    compare_parser.add_argument("current", help="report of the later run")
+
+    loader_parser = subparsers.add_parser(
+        "loader", help="time the CSV loader with an increasing number of workers"
+    )
+    loader_parser.add_argument("filename", help="contacts CSV file to load")
+    loader_parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="largest worker count to try (default: number of CPUs)",
+    )
+
+    snapshot_parser = subparsers.add_parser(
+        "snapshot", help="compare loading a CSV file with its binary snapshot"
+    )
+    snapshot_parser.add_argument("filename", help="contacts CSV file to convert")
+    snapshot_parser.add_argument(
+        "--repeat", type=int, default=3, help="loads per format (default: 3)"
+    )
+
+    lookup_parser = subparsers.add_parser(
+        "lookup", help="compare single-contact lookups with loading the whole book"
+    )
+    lookup_parser.add_argument("filename", help="contacts CSV file to look up in")
+    lookup_parser.add_argument(
+        "--lookups", type=int, default=100, help="contacts to look up (default: 100)"
+    )
+    lookup_parser.add_argument(
+        "--journal-updates",
+        type=int,
+        default=1000,
+        help="updates in the journal for the last lookups (default: %(default)s)",
+    )
+
+    shards_parser = subparsers.add_parser(
+        "shards", help="compare loading and saving a sharded book with the CSV file"
+    )
+    shards_parser.add_argument(
+        "directory", help="directory of a book written by 'generate'"
+    )
+
+    server_parser = subparsers.add_parser(
+        "server", help="load test a running server.py and report latencies"
+    )
+    server_parser.add_argument("--host", default="127.0.0.1", help="server address")
+    server_parser.add_argument("--port", type=int, default=8080, help="server port")
+    server_parser.add_argument(
+        "--connections",
+        type=int,
+        default=50,
+        help="concurrent client connections (default: %(default)s)",
+    )
+    server_parser.add_argument(
+        "--requests",
+        type=int,
+        default=200,
+        help="requests sent by each connection (default: %(default)s)",
+    )
+    server_parser.add_argument(
+        "--write-ratio",
+        type=float,
+        default=0.05,
+        help="share of requests that add and delete a contact (default: %(default)s)",
+    )
+    server_parser.add_argument(
+        "--seed", type=int, default=BENCHMARK_SEED, help="request mix seed"
+    )
+
+    args = parser.parse_args()
+    if args.benchmark == "suite":
+        # Progress and anything the manager prints go to stderr so that stdout
+        # carries only the JSON report.
+        with contextlib.redirect_stdout(sys.stderr):
+            report = run_suite(args.sizes, args.seed, args.repeat)
+        if args.output:
+            with open(args.output, mode="w", encoding="utf-8") as file:
+                json.dump(report, file, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            print()
+    elif args.benchmark == "generate":
+        os.makedirs(args.directory, exist_ok=True)
+        generate_book(args.directory, args.size, args.seed)
+    elif args.benchmark == "compare":
+        compare_reports(args.baseline, args.current)
+    elif args.benchmark == "loader":
+        benchmark_loader(args.filename, args.max_workers)
+    elif args.benchmark == "snapshot":
+        benchmark_snapshot(args.filename, args.repeat)
+    elif args.benchmark == "lookup":
+        benchmark_lookup(args.filename, args.lookups, args.journal_updates)
+    elif args.benchmark == "shards":
+        benchmark_shards(args.directory)
+    elif args.benchmark == "server":
+        benchmark_server(
+            args.host,
+            args.port,
+            args.connections,
+            args.requests,
+            args.write_ratio,
+            args.seed,
+        )
@@ -1,133 +1,2339 @@
+import argparse
+import array
+import bisect
+import contextlib
 import csv
+import functools
+import gc
+import io
+import itertools
 import os
 import json
-from datetime import datetime, timedelta
+import mmap
+import operator
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
 
-def read_contacts_from_csv(filename="contacts.csv"):
+JOURNAL_COMPACT_BYTES = 1024 * 1024
+BIRTHDAY_REMINDER_DAYS = 10
+AUTOCOMPLETE_LIMIT = 10
+CONTACT_PAGE_SIZE = 25
+PHONE_COUNTRY_CODE = "1"
+FUZZY_SEARCH_DISTANCE = 2
+DEDUP_NAME_DISTANCE = 1
+DEDUP_BLOCK_LIMIT = 50
+BATCH_FLUSH_EVERY = 1000
+LIST_CHUNK_SIZE = 1000
+PARALLEL_LOAD_MIN_BYTES = 16 * 1024 * 1024
+PARALLEL_LOAD_CHUNKS_PER_WORKER = 4
+SHARD_COUNT = 16
+REINDEX_MAX_CHANGES = 2000
+
+# The groups and melodies lists keep a usage count that mirrors these indexes.
+COUNTED_INDEXES = {"groups": "group", "melodies": "melody"}
+
+# Binary snapshots: the magic bytes, then one record per contact (a header
+# of payload length, group and melody string ids, then the other fields and
+# the canonical phone keys joined by NUL characters), the NUL-joined string
+# table, the record offsets and a footer pointing at both. The footer also
+# names the country code the phone keys were made with.
+BINARY_EXTENSION = ".bin"
+BINARY_MAGIC = b"CBOOK01\n"
+BINARY_RECORD = struct.Struct("<III")
+BINARY_FOOTER = struct.Struct("<QQQ8s8s")
+
+# Offset indexes, kept next to a snapshot as <snapshot>.idx: a header naming
+# the snapshot's size, modification time and number of contacts, then one
+# entry per phone key with the byte offset and position of the contact's
+# record.
+OFFSET_INDEX_KEY_BYTES = 20
+OFFSET_INDEX_MAGIC = b"CBIDX02\n"
+OFFSET_INDEX_HEADER = struct.Struct("<8sQQQQ")
+OFFSET_INDEX_ENTRY = struct.Struct(f"<{OFFSET_INDEX_KEY_BYTES}sQQ")
+
+CONTACT_FIELDNAMES = [
+    "name",
+    "mobile_phone",
+    "group",
+    "company_name",
+    "company_occupation",
+    "company_address",
+    "company_web_page",
+    "other_phones_mobile_phone_2",
+    "other_phones_mobile_phone_3",
+    "other_phones_home_phone",
+    "other_phones_office_phone",
+    "emails_private_email_1",
+    "emails_private_email_2",
+    "emails_office_email",
+    "melody",
+    "other_address",
+    "other_birth_day",
+    "other_notes",
+    "other_spouse_name",
+    "other_spouse_birthday",
+    "other_spouse_notes",
+    "other_children",
+]
+COMPANY_COLUMNS = slice(3, 7)
+OTHER_PHONES_COLUMNS = slice(7, 11)
+EMAILS_COLUMNS = slice(11, 14)
+MELODY_COLUMN = 14
+CONTACT_WIDTH = len(CONTACT_FIELDNAMES)
+OTHER_COLUMNS = slice(15, 22)
+CHILDREN_COLUMN = 21
+
+
+class Record:
+    __slots__ = ()
+    lazy_fields = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "fields" not in cls.__dict__:
+            cls.fields = cls.__slots__
+        cls.slot_values = operator.attrgetter(*cls.fields)
+
+    def __getattr__(self, key):
+        # Lazy fields are left unset when a record is loaded and are decoded
+        # from the raw row it came from the first time they are read.
+        parser = self.lazy_fields.get(key)
+        try:
+            row = object.__getattribute__(self, "row")
+        except AttributeError:
+            parser = None
+        if parser is None:
+            raise AttributeError(
+                f"{type(self).__name__!r} object has no attribute {key!r}"
+            )
+        value = parser(row)
+        setattr(self, key, value)
+        return value
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        # Rebuilding through the constructor unpickles much faster than the
+        # default per-slot state restore, which matters for the parallel loader.
+        return (type(self), self.slot_values(self))
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.fields else default
+
+    def keys(self):
+        return list(self.fields)
+
+    def values(self):
+        return [getattr(self, key) for key in self.fields]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.fields]
+
+    def is_loaded(self, key):
+        try:
+            object.__getattribute__(self, key)
+        except AttributeError:
+            return False
+        return True
+
+    def to_dict(self):
+        return {
+            key: value.to_dict() if isinstance(value, Record) else value
+            for key, value in self.items()
+        }
+
+
+class Company(Record):
+    __slots__ = ("name", "occupation", "address", "web_page")
+
+    def __init__(self, name=None, occupation=None, address=None, web_page=None):
+        self.name = name
+        self.occupation = occupation
+        self.address = address
+        self.web_page = web_page
+
+
+class OtherPhones(Record):
+    __slots__ = ("mobile_phone_2", "mobile_phone_3", "home_phone", "office_phone")
+
+    def __init__(
+        self,
+        mobile_phone_2=None,
+        mobile_phone_3=None,
+        home_phone=None,
+        office_phone=None,
+    ):
+        self.mobile_phone_2 = mobile_phone_2
+        self.mobile_phone_3 = mobile_phone_3
+        self.home_phone = home_phone
+        self.office_phone = office_phone
+
+
+class Emails(Record):
+    __slots__ = ("private_email_1", "private_email_2", "office_email")
+
+    def __init__(self, private_email_1=None, private_email_2=None, office_email=None):
+        self.private_email_1 = private_email_1
+        self.private_email_2 = private_email_2
+        self.office_email = office_email
+
+
+class Spouse(Record):
+    __slots__ = ("name", "birthday", "notes")
+
+    def __init__(self, name=None, birthday=None, notes=None):
+        self.name = name
+        self.birthday = birthday
+        self.notes = notes
+
+
+class OtherDetails(Record):
+    fields = ("address", "birth_day", "notes", "spouse", "children")
+    __slots__ = fields + ("row",)
+
+    def __init__(
+        self, address=None, birth_day=None, notes=None, spouse=None, children=None
+    ):
+        self.address = address
+        self.birth_day = birth_day
+        self.notes = notes
+        self.spouse = spouse if spouse is not None else Spouse()
+        self.children = children if children is not None else []
+
+
+class Contact(Record):
+    fields = (
+        "name",
+        "mobile_phone",
+        "group",
+        "company",
+        "other_phones",
+        "emails",
+        "melody",
+        "other",
+    )
+    __slots__ = fields + ("row", "phone_keys")
+
+    def __init__(
+        self,
+        name,
+        mobile_phone,
+        group=None,
+        company=None,
+        other_phones=None,
+        emails=None,
+        melody=None,
+        other=None,
+    ):
+        self.name = name
+        self.mobile_phone = mobile_phone
+        self.group = group
+        self.company = company if company is not None else Company()
+        self.other_phones = other_phones if other_phones is not None else OtherPhones()
+        self.emails = emails if emails is not None else Emails()
+        self.melody = melody
+        self.other = other if other is not None else OtherDetails()
+        self.phone_keys = canonical_phones(
+            (mobile_phone, *OtherPhones.slot_values(self.other_phones))
+        )
+
+    def __reduce__(self):
+        # The phone keys travel along, so unpickling does not canonicalize
+        # every phone again.
+        return (contact_from_row, (flatten_contact_row(self), self.phone_keys))
+
+
+class Instrumentation:
+    def __init__(self, trace_memory=False, summary_every=0):
+        self.trace_memory = trace_memory
+        self.summary_every = summary_every
+        self.operations = {}
+        self.active = []
+        self.actions = 0
+        if trace_memory:
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        frame = {"rows": 0, "bytes_written": 0, "peak_memory": 0}
+        if self.trace_memory:
+            # The peak is reset for every operation, so the operations around
+            # this one keep the peak they reached so far.
+            self.update_peaks(tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.active.append(frame)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.active.pop()
+            if self.trace_memory:
+                frame["peak_memory"] = max(
+                    frame["peak_memory"], tracemalloc.get_traced_memory()[1]
+                )
+                self.update_peaks(frame["peak_memory"])
+
+            stats = self.operations.setdefault(
+                name,
+                {
+                    "calls": 0,
+                    "seconds": 0.0,
+                    "max_seconds": 0.0,
+                    "rows": 0,
+                    "bytes_written": 0,
+                    "peak_memory": None,
+                },
+            )
+            stats["calls"] += 1
+            stats["seconds"] += elapsed
+            stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+            stats["rows"] += frame["rows"]
+            stats["bytes_written"] += frame["bytes_written"]
+            if self.trace_memory:
+                stats["peak_memory"] = max(
+                    stats["peak_memory"] or 0, frame["peak_memory"]
+                )
+
+    def update_peaks(self, peak):
+        for frame in self.active:
+            frame["peak_memory"] = max(frame["peak_memory"], peak)
+
+    def record(self, rows=0, bytes_written=0):
+        for frame in self.active:
+            frame["rows"] += rows
+            frame["bytes_written"] += bytes_written
+
+    def action_finished(self):
+        self.actions += 1
+        if self.summary_every and self.actions % self.summary_every == 0:
+            self.print_summary()
+
+    def print_summary(self, file=sys.stderr):
+        print(
+            f"\n{'Operation':<32} {'Calls':>6} {'Total s':>9} {'Mean ms':>9} "
+            f"{'Max ms':>9} {'Rows':>10} {'Written':>12} {'Peak MiB':>9}",
+            file=file,
+        )
+        for name, stats in sorted(self.operations.items()):
+            peak = stats["peak_memory"]
+            peak = f"{peak / (1024 * 1024):.1f}" if peak is not None else "-"
+            print(
+                f"{name:<32} {stats['calls']:>6} {stats['seconds']:>9.3f} "
+                f"{stats['seconds'] / stats['calls'] * 1000:>9.2f} "
+                f"{stats['max_seconds'] * 1000:>9.2f} {stats['rows']:>10} "
+                f"{stats['bytes_written']:>12} {peak:>9}",
+                file=file,
+            )
+
+    def dump(self, filename):
+        with open(filename, mode="w", encoding="utf-8") as file:
+            json.dump(
+                {"actions": self.actions, "operations": self.operations},
+                file,
+                indent=2,
+            )
+
+
+instrumentation = None
+
+
+def enable_instrumentation(trace_memory=False, summary_every=0):
+    global instrumentation
+    instrumentation = Instrumentation(trace_memory, summary_every)
+    return instrumentation
+
+
+def measure(name):
+    if instrumentation is None:
+        return contextlib.nullcontext()
+    return instrumentation.measure(name)
+
+
+def instrumented(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if instrumentation is None:
+                return function(*args, **kwargs)
+            with instrumentation.measure(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_io(rows=0, bytes_written=0):
+    if instrumentation is not None:
+        instrumentation.record(rows, bytes_written)
+
+
+@instrumented("read_contacts_from_csv")
+def read_contacts_from_csv(filename="contacts.csv", workers=None):
     contacts = []
+    if workers is None:
+        workers = os.cpu_count() or 1
 
+    # Loading allocates millions of long-lived objects; letting the cyclic
+    # garbage collector rescan them all along the way doubles the load time.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
     try:
-        with open(filename, mode="r", newline="", encoding="utf-8") as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                contact = unflatten_contact(row)
-                contacts.append(contact)
+        if (
+            workers > 1
+            and os.path.getsize(filename) >= PARALLEL_LOAD_MIN_BYTES
+            and not is_binary_snapshot(filename)
+        ):
+            contacts.extend(read_snapshot_in_parallel(filename, workers))
+        else:
+            contacts.extend(iter_snapshot_contacts(filename))
     except FileNotFoundError:
         print(f"No such file: {filename}")
     except Exception as e:
         print(f"Error reading file: {e}")
+    finally:
+        if gc_was_enabled:
+            gc.enable()
 
+    replay_journal(contacts, filename)
+
+    record_io(rows=len(contacts))
     return contacts
 
 
-def write_contacts_to_csv(contacts, filename="contacts.csv"):
-    if not contacts:
+def iter_contacts_from_csv(filename="contacts.csv", fields=None):
+    if fields is not None:
+        for field in fields:
+            if field not in CONTACT_FIELD_PARSERS:
+                raise ValueError(f"Unknown contact field: {field}")
+
+    journal = JournalView(filename)
+    journal.update()
+    if fields is not None and journal.moves and "group" not in fields:
+        # Group moves apply to the contacts that were in the group.
+        fields = (*fields, "group")
+
+    if os.path.exists(filename):
+        snapshot_contacts = iter_snapshot_contacts(filename, fields)
+    else:
+        print(f"No such file: {filename}")
+        snapshot_contacts = ()
+    yield from journal.contacts(snapshot_contacts, fields)
+
+
+def iter_snapshot_contacts(filename="contacts.csv", fields=None):
+    if is_binary_snapshot(filename):
+        yield from iter_binary_contacts(filename, fields)
         return
 
-    fieldnames = [
-        "name",
-        "mobile_phone",
-        "group",
-        "company_name",
-        "company_occupation",
-        "company_address",
-        "company_web_page",
-        "other_phones_mobile_phone_2",
-        "other_phones_mobile_phone_3",
-        "other_phones_home_phone",
-        "other_phones_office_phone",
-        "emails_private_email_1",
-        "emails_private_email_2",
-        "emails_office_email",
-        "melody",
-        "other_address",
-        "other_birth_day",
-        "other_notes",
-        "other_spouse_name",
-        "other_spouse_birthday",
-        "other_spouse_notes",
-        "other_children",
+    with open(filename, mode="r", newline="", encoding="utf-8") as csvfile:
+        reader = csv.reader(csvfile)
+        fieldnames = next(reader, None)
+        if fieldnames is None:
+            return
+
+        rows = contact_rows(reader, fieldnames)
+        if fields is None:
+            for row in rows:
+                yield contact_from_row(row)
+        else:
+            for row in rows:
+                yield project_contact(row, fields)
+
+
+def contact_rows(reader, fieldnames):
+    # Rows are kept in CONTACT_FIELDNAMES order, so files written with another
+    # column order or with missing columns are rearranged first.
+    width = len(CONTACT_FIELDNAMES)
+    if fieldnames == CONTACT_FIELDNAMES:
+        for row in reader:
+            if len(row) == width:
+                yield row
+            elif row:
+                yield (row + [None] * width)[:width]
+    else:
+        missing = len(fieldnames)
+        positions = [
+            fieldnames.index(field) if field in fieldnames else missing
+            for field in CONTACT_FIELDNAMES
+        ]
+        for row in reader:
+            if row:
+                row = row + [None] * (missing + 1 - len(row))
+                yield [row[position] for position in positions]
+
+
+def read_snapshot_in_parallel(filename, workers):
+    with open(filename, mode="rb") as file:
+        header = file.readline()
+    fieldnames = next(csv.reader([header.decode("utf-8")]))
+
+    boundaries = find_record_boundaries(
+        filename, len(header), workers * PARALLEL_LOAD_CHUNKS_PER_WORKER
+    )
+    tasks = [
+        (filename, start, end, fieldnames)
+        for start, end in zip(boundaries, boundaries[1:])
     ]
 
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk in executor.map(parse_contact_range, tasks):
+            yield from chunk
+
+
+def find_record_boundaries(filename, start, chunks):
+    # A newline ends a record only when it is outside a quoted field. Fields
+    # escape quotes by doubling them, so the parity of the quote characters
+    # seen so far tells whether a newline sits inside a field.
+    size = os.path.getsize(filename)
+    boundaries = [start]
+    in_quotes = False
+
+    with open(filename, mode="rb") as file:
+        position = start
+        for chunk in range(1, chunks):
+            target = start + (size - start) * chunk // chunks
+            if target <= position:
+                continue
+
+            file.seek(position)
+            while position < target:
+                block = file.read(min(target - position, 1024 * 1024))
+                if block.count(b'"') % 2:
+                    in_quotes = not in_quotes
+                position += len(block)
+
+            while True:
+                line = file.readline()
+                if not line:
+                    break
+                position += len(line)
+                if line.count(b'"') % 2:
+                    in_quotes = not in_quotes
+                if not in_quotes:
+                    break
+
+            if position >= size:
+                break
+            boundaries.append(position)
+
+    boundaries.append(size)
+    return boundaries
+
+
+def parse_contact_range(task):
+    filename, start, end, fieldnames = task
+    with open(filename, mode="rb") as file:
+        file.seek(start)
+        text = file.read(end - start).decode("utf-8")
+
+    gc.disable()
+    reader = csv.reader(io.StringIO(text, newline=""))
+    return [contact_from_row(row) for row in contact_rows(reader, fieldnames)]
+
+
+def is_binary_snapshot(filename):
+    with open(filename, mode="rb") as file:
+        return file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+@contextlib.contextmanager
+def mapped_snapshot(filename):
+    with open(filename, mode="rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def read_binary_footer(data):
+    strings_offset, index_offset, count, country_code, magic = (
+        BINARY_FOOTER.unpack_from(data, len(data) - BINARY_FOOTER.size)
+    )
+    if magic != BINARY_MAGIC:
+        raise ValueError("The binary snapshot is incomplete.")
+    strings = data[strings_offset:index_offset].decode("utf-8").split("\0")
+    keys_current = country_code.rstrip(b"\0").decode("ascii") == PHONE_COUNTRY_CODE
+    return strings, index_offset, count, keys_current
+
+
+def binary_row(data, position, strings, keys_current):
+    length, group, melody = BINARY_RECORD.unpack_from(data, position)
+    start = position + BINARY_RECORD.size
+    row = data[start : start + length].decode("utf-8").split("\0")
+    # Decoding the stored phone keys is cheap, while working them out again
+    # is most of what building a contact takes. A key equal to its phone is
+    # stored empty and shares the phone's string.
+    if keys_current:
+        phones = (row[1], *row[OTHER_PHONES_COLUMNS])
+        phone_keys = tuple(
+            key or phone for key, phone in zip(row[CONTACT_WIDTH:], phones)
+        )
+    else:
+        phone_keys = None
+    del row[CONTACT_WIDTH:]
+    row[2] = strings[group]
+    row[MELODY_COLUMN] = strings[melody]
+    return start + length, row, phone_keys
+
+
+def iter_binary_contacts(filename, fields=None):
+    # The records follow each other, so a load walks them in order and the
+    # offset index is only needed to jump to a single one. Group and melody
+    # names come from the string table, so every contact shares one copy.
+    with mapped_snapshot(filename) as data:
+        strings, _, count, keys_current = read_binary_footer(data)
+        position = len(BINARY_MAGIC)
+        for _ in range(count):
+            position, row, phone_keys = binary_row(
+                data, position, strings, keys_current
+            )
+            if fields is None:
+                yield contact_from_row(row, phone_keys)
+            else:
+                yield project_contact(row, fields, phone_keys)
+
+
+@instrumented("write_contacts_to_csv")
+def write_contacts_to_csv(contacts, filename="contacts.csv"):
+    # contacts can be any iterable, so the rows are counted as they go out.
+    rows = 0
+    try:
+        with atomic_write(filename, newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(CONTACT_FIELDNAMES)
+            for contact in contacts:
+                writer.writerow(flatten_contact_row(contact))
+                rows += 1
+        record_io(rows=rows)
+    except Exception as e:
+        print(f"Error writing to file: {e}")
+        return False
+    return True
+
+
+@instrumented("write_contacts_to_binary")
+def write_contacts_to_binary(contacts, filename="contacts.bin"):
+    strings = {"": 0}
+    offsets = array.array("Q")
     try:
-        with open(filename, mode="w", newline="", encoding="utf-8") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
+        with atomic_write(filename, mode="wb") as file:
+            file.write(BINARY_MAGIC)
+            position = len(BINARY_MAGIC)
             for contact in contacts:
-                flattened_contact = flatten_contact(contact)
-                writer.writerow(flattened_contact)
-            csvfile.flush()
+                row = [
+                    "" if value is None else value
+                    for value in flatten_contact_row(contact)
+                ]
+                group = strings.setdefault(row[2], len(strings))
+                melody = strings.setdefault(row[MELODY_COLUMN], len(strings))
+                phones = (row[1], *row[OTHER_PHONES_COLUMNS])
+                phone_keys = [
+                    "" if key == phone else key
+                    for key, phone in zip(canonical_phones(phones), phones)
+                ]
+                row[2] = row[MELODY_COLUMN] = ""
+                payload = "\0".join((*row, *phone_keys)).encode("utf-8")
+                if payload.count(b"\0") != len(row) + len(phone_keys) - 1:
+                    raise ValueError(f"{contact.name} has a NUL character in it.")
+
+                offsets.append(position)
+                file.write(BINARY_RECORD.pack(len(payload), group, melody))
+                file.write(payload)
+                position += BINARY_RECORD.size + len(payload)
+
+            table = "\0".join(strings).encode("utf-8")
+            if table.count(b"\0") != len(strings) - 1:
+                raise ValueError("A group or melody name has a NUL character in it.")
+            file.write(table)
+            if sys.byteorder == "big":
+                offsets.byteswap()
+            file.write(offsets.tobytes())
+            file.write(
+                BINARY_FOOTER.pack(
+                    position,
+                    position + len(table),
+                    len(offsets),
+                    PHONE_COUNTRY_CODE.encode("ascii"),
+                    BINARY_MAGIC,
+                )
+            )
+        record_io(rows=len(offsets))
     except Exception as e:
         print(f"Error writing to file: {e}")
+        return False
+    return True
+
+
+def write_snapshot(contacts, filename="contacts.csv"):
+    if filename.endswith(BINARY_EXTENSION):
+        return write_contacts_to_binary(contacts, filename)
+    return write_contacts_to_csv(contacts, filename)
+
+
+def convert_contacts(source, target):
+    # The contacts are streamed from one file to the other. Pending journal
+    # changes of the source are part of what is written, and a journal left
+    # over for the target no longer applies to it.
+    converted = 0
+
+    def contacts():
+        nonlocal converted
+        for contact in iter_contacts_from_csv(source):
+            converted += 1
+            yield contact
+
+    if compact_journal(contacts(), target):
+        print(f"Converted {converted} contacts from {source} to {target}.")
+
+
+@contextlib.contextmanager
+def atomic_write(filename, newline=None, mode="w"):
+    # The new content goes to a temporary file that replaces the original only
+    # once it is complete, so a crash never leaves a truncated file behind.
+    temp_filename = f"{filename}.tmp"
+    encoding = None if "b" in mode else "utf-8"
+    try:
+        with open(temp_filename, mode=mode, newline=newline, encoding=encoding) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_filename, filename)
+        record_io(bytes_written=os.path.getsize(filename))
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_filename)
+        raise
+
+
+@contextlib.contextmanager
+def locked_file(filename, wait=True):
+    # The lock is advisory: it only keeps out other processes that take it too,
+    # which every store working on the same files does. Without wait, the lock
+    # is only taken if it is free, and the body is told whether it was.
+    with open(filename, mode="a+b") as lock_file:
+        if fcntl is not None:
+            try:
+                fcntl.flock(
+                    lock_file.fileno(),
+                    fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB,
+                )
+            except BlockingIOError:
+                yield False
+                return
+        elif msvcrt is not None:
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(
+                        lock_file.fileno(),
+                        msvcrt.LK_LOCK if wait else msvcrt.LK_NBLCK,
+                        1,
+                    )
+                    break
+                except OSError:
+                    if not wait:
+                        yield False
+                        return
+        try:
+            yield True
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def file_stamp(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
 
 
 def flatten_contact(contact):
-    flattened_contact = {
-        "name": contact["name"],
-        "mobile_phone": contact["mobile_phone"],
-        "group": contact["group"],
-        "company_name": contact["company"]["name"],
-        "company_occupation": contact["company"]["occupation"],
-        "company_address": contact["company"]["address"],
-        "company_web_page": contact["company"]["web_page"],
-        "other_phones_mobile_phone_2": contact["other_phones"]["mobile_phone_2"],
-        "other_phones_mobile_phone_3": contact["other_phones"]["mobile_phone_3"],
-        "other_phones_home_phone": contact["other_phones"]["home_phone"],
-        "other_phones_office_phone": contact["other_phones"]["office_phone"],
-        "emails_private_email_1": contact["emails"]["private_email_1"],
-        "emails_private_email_2": contact["emails"]["private_email_2"],
-        "emails_office_email": contact["emails"]["office_email"],
-        "melody": contact["melody"],
-        "other_address": contact["other"]["address"],
-        "other_birth_day": contact["other"]["birth_day"],
-        "other_notes": contact["other"]["notes"],
-        "other_spouse_name": contact["other"]["spouse"]["name"],
-        "other_spouse_birthday": contact["other"]["spouse"]["birthday"],
-        "other_spouse_notes": contact["other"]["spouse"]["notes"],
-        "other_children": contact["other"]["children"],
-    }
-    return flattened_contact
+    return dict(zip(CONTACT_FIELDNAMES, flatten_contact_row(contact)))
+
+
+def flatten_contact_row(contact):
+    return (
+        contact.name,
+        contact.mobile_phone,
+        contact.group,
+        *contact_section(contact, "company", COMPANY_COLUMNS, Company.slot_values),
+        *OtherPhones.slot_values(contact.other_phones),
+        *contact_section(contact, "emails", EMAILS_COLUMNS, Emails.slot_values),
+        contact.melody,
+        *contact_section(contact, "other", OTHER_COLUMNS, flatten_other),
+    )
+
+
+def contact_section(contact, field, columns, flatten):
+    # A nested record that was never decoded is still exactly what was loaded,
+    # so its columns are copied from the raw row instead of being rebuilt.
+    if contact.is_loaded(field):
+        return flatten(getattr(contact, field))
+    return contact.row[columns]
+
+
+def flatten_other(other):
+    if other.is_loaded("children"):
+        children = json.dumps(other.children)
+    else:
+        children = other.row[CHILDREN_COLUMN]
+    return (
+        other.address,
+        other.birth_day,
+        other.notes,
+        *Spouse.slot_values(other.spouse),
+        children,
+    )
 
 
 def unflatten_contact(flat_contact):
-    contact = {
-        "name": flat_contact["name"],
-        "mobile_phone": flat_contact["mobile_phone"],
-        "group": flat_contact["group"],
-        "company": {
-            "name": flat_contact["company_name"],
-            "occupation": flat_contact["company_occupation"],
-            "address": flat_contact["company_address"],
-            "web_page": flat_contact["company_web_page"],
-        },
-        "other_phones": {
-            "mobile_phone_2": flat_contact["other_phones_mobile_phone_2"],
-            "mobile_phone_3": flat_contact["other_phones_mobile_phone_3"],
-            "home_phone": flat_contact["other_phones_home_phone"],
-            "office_phone": flat_contact["other_phones_office_phone"],
-        },
-        "emails": {
-            "private_email_1": flat_contact["emails_private_email_1"],
-            "private_email_2": flat_contact["emails_private_email_2"],
-            "office_email": flat_contact["emails_office_email"],
-        },
-        "melody": flat_contact["melody"],
-        "other": {
-            "address": flat_contact["other_address"],
-            "birth_day": flat_contact["other_birth_day"],
-            "notes": flat_contact["other_notes"],
-            "spouse": {
-                "name": flat_contact["other_spouse_name"],
-                "birthday": flat_contact["other_spouse_birthday"],
-                "notes": flat_contact["other_spouse_notes"],
-            },
-            "children": json.loads(flat_contact["other_children"]),
-        },
+    return contact_from_row([flat_contact[field] for field in CONTACT_FIELDNAMES])
+
+
+def contact_from_row(row, phone_keys=None):
+    # Only the fields needed to list and index a contact are decoded up front;
+    # the others are built from the row on first access.
+    contact = Contact.__new__(Contact)
+    contact.name, contact.mobile_phone, contact.group = row[:3]
+    contact.other_phones = unflatten_other_phones(row)
+    contact.melody = row[MELODY_COLUMN]
+    contact.phone_keys = row_phone_keys(row) if phone_keys is None else phone_keys
+    contact.row = row
+    return contact
+
+
+def row_phone_keys(row):
+    return canonical_phones((row[1], *row[OTHER_PHONES_COLUMNS]))
+
+
+def unflatten_company(row):
+    return Company(*row[COMPANY_COLUMNS])
+
+
+def unflatten_other_phones(row):
+    return OtherPhones(*row[OTHER_PHONES_COLUMNS])
+
+
+def unflatten_emails(row):
+    return Emails(*row[EMAILS_COLUMNS])
+
+
+def unflatten_other(row):
+    address, birth_day, notes, spouse_name, spouse_birthday, spouse_notes, _ = row[
+        OTHER_COLUMNS
+    ]
+    other = OtherDetails.__new__(OtherDetails)
+    other.address = address
+    other.birth_day = birth_day
+    other.notes = notes
+    other.spouse = Spouse(spouse_name, spouse_birthday, spouse_notes)
+    other.row = row
+    return other
+
+
+def unflatten_children(row):
+    children = row[CHILDREN_COLUMN]
+    if not children or children == "[]":
+        return []
+    try:
+        return json.loads(children)
+    except ValueError:
+        return children
+
+
+Contact.lazy_fields = {
+    "company": unflatten_company,
+    "emails": unflatten_emails,
+    "other": unflatten_other,
+}
+OtherDetails.lazy_fields = {"children": unflatten_children}
+
+CONTACT_FIELD_PARSERS = {
+    "name": operator.itemgetter(0),
+    "mobile_phone": operator.itemgetter(1),
+    "group": operator.itemgetter(2),
+    "company": unflatten_company,
+    "other_phones": unflatten_other_phones,
+    "emails": unflatten_emails,
+    "melody": operator.itemgetter(MELODY_COLUMN),
+    "other": unflatten_other,
+}
+CONTACT_LIST_FIELDS = ("name", "mobile_phone", "group", "melody")
+CONTACT_SEARCH_FIELDS = ("name", "mobile_phone", "company", "other_phones", "emails")
+
+
+def project_contact(row, fields, phone_keys=None):
+    # Only the requested attributes are set; the others stay unset so the
+    # nested records they would need are never built.
+    contact = Contact.__new__(Contact)
+    for field in fields:
+        setattr(contact, field, CONTACT_FIELD_PARSERS[field](row))
+    contact.phone_keys = row_phone_keys(row) if phone_keys is None else phone_keys
+    return contact
+
+
+def journal_filename(filename):
+    # A binary snapshot gets a journal of its own, so converting a book never
+    # leaves it sharing one with the CSV file next to it.
+    root, extension = os.path.splitext(filename)
+    if extension == BINARY_EXTENSION:
+        return f"{filename}.journal"
+    return root + ".journal"
+
+
+@instrumented("log_contact_changes")
+def log_contact_changes(contacts, records, filename="contacts.csv"):
+    # Returns whether the records reached the journal.
+    journal = journal_filename(filename)
+
+    try:
+        if not os.path.exists(journal):
+            with open(journal, mode="w", encoding="utf-8") as file:
+                file.write(json.dumps(journal_header(filename)) + "\n")
+
+        journal_size = os.path.getsize(journal)
+        try:
+            with open(journal, mode="a", encoding="utf-8") as file:
+                data = "".join(json.dumps(record) + "\n" for record in records)
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+        except BaseException:
+            # Replaying stops at a damaged record, so a partly written one
+            # would hide everything appended after it.
+            with contextlib.suppress(OSError):
+                os.truncate(journal, journal_size)
+            raise
+        record_io(rows=len(records), bytes_written=len(data.encode("utf-8")))
+    except Exception as e:
+        print(f"Error writing to journal: {e}")
+        return False
+
+    # Compacting rewrites the whole snapshot, so it is only worth doing once the
+    # journal is a sizeable fraction of it. Changes made without loading the
+    # book load it for that.
+    snapshot_size = os.path.getsize(filename) if os.path.exists(filename) else 0
+    if os.path.getsize(journal) >= max(JOURNAL_COMPACT_BYTES, snapshot_size // 4):
+        if contacts is None:
+            contacts = read_contacts_from_csv(filename)
+        compact_journal(contacts, filename)
+    return True
+
+
+def compact_journal(contacts, filename="contacts.csv"):
+    if not write_snapshot(contacts, filename):
+        return False
+    try:
+        os.remove(journal_filename(filename))
+    except FileNotFoundError:
+        pass
+    return True
+
+
+def journal_header(filename="contacts.csv"):
+    header = {"op": "snapshot", "size": 0, "mtime_ns": 0, "crc32": 0}
+    if os.path.exists(filename):
+        stat = os.stat(filename)
+        header["size"] = stat.st_size
+        header["mtime_ns"] = stat.st_mtime_ns
+        header["crc32"] = snapshot_checksum(filename)
+    return header
+
+
+def snapshot_checksum(filename):
+    checksum = 0
+    with open(filename, mode="rb") as file:
+        for block in iter(functools.partial(file.read, 1024 * 1024), b""):
+            checksum = zlib.crc32(block, checksum)
+    return checksum
+
+
+def journal_matches_snapshot(header, filename="contacts.csv"):
+    # A journal belongs to the snapshot it was started on. A crash between
+    # compacting and removing the journal leaves it next to a new snapshot,
+    # which can have the same size, so the modification time is compared as
+    # well. A book copied elsewhere only differs in that, and the checksum
+    # tells the two cases apart.
+    stat = os.stat(filename) if os.path.exists(filename) else None
+    if header["size"] != (stat.st_size if stat else 0):
+        return False
+    if "crc32" not in header or stat is None:
+        # Journals of older versions only recorded the size.
+        return True
+    if header["mtime_ns"] == stat.st_mtime_ns:
+        return True
+    return header["crc32"] == snapshot_checksum(filename)
+
+
+def replay_journal(contacts, filename="contacts.csv"):
+    # A full load folds the journal as streamed reads and single lookups do,
+    # so all three agree on what the book holds.
+    journal = JournalView(filename, LoadedSnapshot(contacts))
+    try:
+        journal.update()
+    except Exception as e:
+        print(f"Error replaying journal: {e}")
+
+    contacts[:] = list(journal.contacts(contacts))
+    return contacts
+
+
+def apply_journal_record(contacts, record, indexes=None):
+    # With indexes, the record is applied to a live book and the indexes are
+    # kept in step; without them it is replayed into a freshly loaded list.
+    op = record["op"]
+    if op == "add":
+        contact = unflatten_contact(record["contact"])
+        contacts.append(contact)
+        if indexes is not None:
+            index_contact(indexes, contact)
+    elif op in ("update", "delete"):
+        position = journal_position(contacts, record, indexes)
+        if position is None:
+            return
+        old_contact = contacts[position]
+        if indexes is not None:
+            unindex_contact(indexes, old_contact)
+        if op == "update":
+            contacts[position] = unflatten_contact(record["contact"])
+            if indexes is not None:
+                indexes["positions"].replaced(old_contact, contacts[position])
+                index_contact(indexes, contacts[position])
+        else:
+            del contacts[position]
+            if indexes is not None:
+                indexes["positions"].removed(old_contact)
+    elif op == "group":
+        contact = journal_contact(contacts, record["mobile_phone"], indexes)
+        if contact is None:
+            return
+        if indexes is not None:
+            if contact.group:
+                unindex_member(indexes, "group", contact.group, id(contact))
+            if record["group"]:
+                indexes["group"].setdefault(record["group"], set()).add(id(contact))
+        contact.group = record["group"]
+    elif op == "move_group":
+        if indexes is not None:
+            members = indexes["group"].pop(record["from"], set())
+            for contact_id in members:
+                indexes["contacts"][contact_id].group = record["to"]
+            if record["to"]:
+                indexes["group"].setdefault(record["to"], set()).update(members)
+        else:
+            for contact in contacts:
+                if contact.group == record["from"]:
+                    contact.group = record["to"]
+    else:
+        raise ValueError(f"Unknown journal operation: {op}")
+
+
+class JournalView:
+    # The journal folded by contact, so a book can be read one contact at a
+    # time instead of being loaded and replayed as a whole. Every record
+    # names its contact the way journal_position reads it in a loaded book:
+    # by its index if the contact there has the record's phone, otherwise as
+    # the first contact with that phone. The book so far is the snapshot
+    # less the deleted contacts, followed by the added ones, so an index
+    # maps to a snapshot position without reading the snapshot, which is
+    # only asked about the phones the records name.
+
+    def __init__(self, filename="contacts.csv", snapshot=None):
+        self.filename = filename
+        self.loaded_snapshot = snapshot
+        self.reset()
+
+    def reset(self):
+        self.snapshot = self.loaded_snapshot or IndexedSnapshot(self.filename)
+        self.snapshot_stamp = file_stamp(self.filename)
+        self.journal_stamp = None
+        self.position = 0
+        self.line_number = 0
+        self.stopped = False
+        # Entries are dicts: "contact" is the contact as the journal left
+        # it, or None for a snapshot contact it has not replaced, which
+        # "group" may give a new group. "position" is where a snapshot
+        # contact is in the snapshot; added contacts have None there and
+        # are numbered by "added" instead.
+        self.changed = {}
+        self.deleted = []
+        self.added = []
+        self.added_count = 0
+        # The entries whose contacts have each phone key.
+        self.phones = {}
+        # Group moves, in order, for snapshot contacts no record has
+        # regrouped or replaced; the entries have them applied already.
+        self.moves = []
+
+    def update(self):
+        # Reads what was appended to the journal since the last update. A
+        # journal that was started again, or a new snapshot, means starting
+        # over.
+        journal = journal_filename(self.filename)
+        stamp = file_stamp(journal)
+        if (
+            stamp is None
+            or file_stamp(self.filename) != self.snapshot_stamp
+            or self.journal_stamp is None
+            or stamp[0] != self.journal_stamp[0]
+            or stamp[1] < self.position
+        ):
+            self.reset()
+        self.journal_stamp = stamp
+        if stamp is None or self.stopped or stamp[1] == self.position:
+            return
+
+        with open(journal, mode="rb") as file:
+            file.seek(self.position)
+            data = file.read()
+        # A record is only complete with its line break.
+        data = data[: data.rfind(b"\n") + 1]
+        self.position += len(data)
+        record_io(rows=data.count(b"\n"))
+        with self.snapshot.opened():
+            for line in data.decode("utf-8").splitlines():
+                self.line_number += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print(
+                        f"Ignoring incomplete journal entry at line {self.line_number}."
+                    )
+                    self.stopped = True
+                    return
+                if record["op"] == "snapshot":
+                    self.stopped = not journal_matches_snapshot(record, self.filename)
+                    if self.stopped:
+                        return
+                else:
+                    self.apply(record)
+
+    def apply(self, record):
+        op = record["op"]
+        if op == "add":
+            entry = {
+                "contact": unflatten_contact(record["contact"]),
+                "position": None,
+                "added": self.added_count,
+            }
+            self.added_count += 1
+            self.added.append(entry)
+            self.keep(entry)
+        elif op in ("update", "delete"):
+            found = self.target(
+                canonical_phone(record.get("mobile_phone")), record["index"]
+            )
+            if found is None:
+                return
+            position, entry = found
+            if entry is not None:
+                self.forget(entry)
+            if op == "update":
+                if entry is None:
+                    entry = self.changed[position] = {"position": position}
+                entry["contact"] = unflatten_contact(record["contact"])
+                entry.pop("group", None)
+                self.keep(entry)
+            elif position is None:
+                self.added.pop(self.added_index(entry))
+            else:
+                self.changed.pop(position, None)
+                bisect.insort(self.deleted, position)
+        elif op == "group":
+            found = self.target(canonical_phone(record["mobile_phone"]))
+            if found is None:
+                return
+            position, entry = found
+            if entry is None:
+                entry = self.changed[position] = {"position": position, "contact": None}
+            if entry["contact"] is not None:
+                entry["contact"].group = record["group"]
+            else:
+                entry["group"] = record["group"]
+        elif op == "move_group":
+            source, target = record["from"], record["to"]
+            self.moves.append((source, target))
+            for entries in (self.changed.values(), self.added):
+                for entry in entries:
+                    if entry["contact"] is not None:
+                        if entry["contact"].group == source:
+                            entry["contact"].group = target
+                    elif entry.get("group") == source:
+                        entry["group"] = target
+        else:
+            raise ValueError(f"Unknown journal operation: {op}")
+
+    def find(self, phone_key):
+        # The contact a loaded book's phone index gives for the phone key,
+        # the first in the book with it, and its index in the book.
+        with self.snapshot.opened():
+            found = self.first_holder(phone_key)
+        if found is None:
+            return None
+        position, entry, contact = found
+        if entry is None:
+            contact.group = self.moved_group(contact.group)
+        else:
+            contact = self.changed_contact(contact, entry)
+        return contact, self.index_of(position, entry)
+
+    def target(self, phone_key, index=None):
+        # The contact a record is about, as the snapshot position, or None
+        # for an added contact, and the entry, which a snapshot contact no
+        # record has touched does not have yet. None if there is none.
+        if index is not None and 0 <= index < self.length():
+            position, entry = self.at(index)
+            if not phone_key or self.has_mobile_phone(position, entry, phone_key):
+                return position, entry
+        if not phone_key:
+            return None
+        found = self.first_holder(phone_key, mobile=True)
+        return None if found is None else found[:2]
+
+    def length(self):
+        return self.snapshot.count() - len(self.deleted) + len(self.added)
+
+    def at(self, index):
+        kept = self.snapshot.count() - len(self.deleted)
+        if index >= kept:
+            return None, self.added[index - kept]
+        # The first snapshot position with index kept positions before it.
+        low, high = index, index + len(self.deleted)
+        while low < high:
+            middle = (low + high) // 2
+            if middle - bisect.bisect_right(self.deleted, middle) < index:
+                low = middle + 1
+            else:
+                high = middle
+        return low, self.changed.get(low)
+
+    def index_of(self, position, entry):
+        if position is not None:
+            return position - bisect.bisect_left(self.deleted, position)
+        kept = self.snapshot.count() - len(self.deleted)
+        return kept + self.added_index(entry)
+
+    def added_index(self, entry):
+        return next(index for index, added in enumerate(self.added) if added is entry)
+
+    def is_deleted(self, position):
+        index = bisect.bisect_left(self.deleted, position)
+        return index < len(self.deleted) and self.deleted[index] == position
+
+    def has_mobile_phone(self, position, entry, phone_key):
+        if entry is not None and entry["contact"] is not None:
+            return entry["contact"].phone_keys[0] == phone_key
+        return any(
+            snapshot_position == position and contact.phone_keys[0] == phone_key
+            for snapshot_position, contact in self.snapshot.find(phone_key)
+        )
+
+    def first_holder(self, phone_key, mobile=False):
+        # The first contact in book order with the phone key, or with it as
+        # its mobile phone: its snapshot position, entry and contact.
+        def holds(contact):
+            if mobile:
+                return contact.phone_keys[0] == phone_key
+            return phone_key in contact.phone_keys
+
+        found = None
+        for position, contact in self.snapshot.find(phone_key):
+            entry = self.changed.get(position)
+            replaced = entry is not None and entry["contact"] is not None
+            if not replaced and not self.is_deleted(position) and holds(contact):
+                found = position, entry, contact
+                break
+
+        added = None
+        for entry in self.phones.get(phone_key, ()):
+            if not holds(entry["contact"]):
+                continue
+            position = entry["position"]
+            if position is None:
+                if added is None or entry["added"] < added[1]["added"]:
+                    added = None, entry, entry["contact"]
+            elif found is None or position < found[0]:
+                found = position, entry, entry["contact"]
+        return found or added
+
+    def keep(self, entry):
+        for phone_key in set(contact_phone_keys(entry["contact"])):
+            self.phones.setdefault(phone_key, []).append(entry)
+
+    def forget(self, entry):
+        if entry["contact"] is None:
+            return
+        for phone_key in set(contact_phone_keys(entry["contact"])):
+            entries = self.phones[phone_key]
+            entries[:] = [kept for kept in entries if kept is not entry]
+            if not entries:
+                del self.phones[phone_key]
+
+    def contacts(self, snapshot_contacts, fields=None):
+        deleted = set(self.deleted)
+        for position, contact in enumerate(snapshot_contacts):
+            if position in deleted:
+                continue
+            entry = self.changed.get(position)
+            if entry is not None:
+                contact = self.changed_contact(contact, entry, fields)
+            elif self.moves:
+                contact.group = self.moved_group(contact.group)
+            yield contact
+
+        for entry in self.added:
+            yield self.project(entry["contact"], fields)
+
+    def changed_contact(self, contact, entry, fields=None):
+        if entry["contact"] is not None:
+            return self.project(entry["contact"], fields)
+        if "group" in entry:
+            contact.group = entry["group"]
+        else:
+            contact.group = self.moved_group(contact.group)
+        return contact
+
+    def moved_group(self, group):
+        for source, target in self.moves:
+            if group == source:
+                group = target
+        return group
+
+    def project(self, contact, fields):
+        if fields is None:
+            return contact
+        return project_contact(flatten_contact_row(contact), fields, contact.phone_keys)
+
+
+def journal_contact(contacts, phone, indexes=None):
+    # The first contact in the book with this mobile phone.
+    phone_key = canonical_phone(phone)
+    if not phone_key:
+        return None
+    if indexes is not None:
+        holders = indexes["shared_phones"].get(phone_key)
+        if holders is None:
+            holders = [find_contact_by_phone(indexes, phone_key)]
+        holders = [
+            contact
+            for contact in holders
+            if contact is not None and contact.phone_keys[0] == phone_key
+        ]
+        if len(holders) > 1:
+            positions = indexes["positions"]
+            return min(holders, key=lambda contact: positions.find(contacts, contact))
+        return holders[0] if holders else None
+    for contact in contacts:
+        if contact.phone_keys[0] == phone_key:
+            return contact
+    return None
+
+
+def journal_position(contacts, record, indexes=None):
+    # The index is where the writing process had the contact. Another process
+    # may have added or removed contacts before it, so the mobile phone, when
+    # the record has one, decides which contact is meant.
+    position = record["index"]
+    phone_key = canonical_phone(record.get("mobile_phone"))
+    in_book = position is not None and 0 <= position < len(contacts)
+    if not phone_key:
+        return position if in_book else None
+    if in_book and contacts[position].phone_keys[0] == phone_key:
+        return position
+
+    contact = journal_contact(contacts, phone_key, indexes)
+    if contact is None:
+        return None
+    if indexes is not None:
+        return indexes["positions"].find(contacts, contact)
+    return next(
+        position for position, candidate in enumerate(contacts) if candidate is contact
+    )
+
+
+def offset_index_filename(filename):
+    return f"{filename}.idx"
+
+
+def read_csv_record(file):
+    # A record goes on over line breaks for as long as a quoted field is open.
+    record = file.readline()
+    while record.count(b'"') % 2:
+        line = file.readline()
+        if not line:
+            break
+        record += line
+    return record
+
+
+def parse_csv_record(record, fieldnames):
+    reader = csv.reader(io.StringIO(record.decode("utf-8"), newline=""))
+    return next(contact_rows(reader, fieldnames), None)
+
+
+def iter_snapshot_offsets(filename="contacts.csv"):
+    # Yields where each contact's record starts, its position and its phone
+    # keys, without building the contacts.
+    if is_binary_snapshot(filename):
+        with mapped_snapshot(filename) as data:
+            strings, _, count, keys_current = read_binary_footer(data)
+            offset = len(BINARY_MAGIC)
+            for position in range(count):
+                next_offset, row, phone_keys = binary_row(
+                    data, offset, strings, keys_current
+                )
+                yield offset, position, phone_keys or row_phone_keys(row)
+                offset = next_offset
+        return
+
+    with open(filename, mode="rb") as file:
+        header = file.readline()
+        fieldnames = next(csv.reader([header.decode("utf-8")]), [])
+        offset = len(header)
+        position = 0
+        while True:
+            record = read_csv_record(file)
+            if not record:
+                break
+            row = parse_csv_record(record, fieldnames)
+            if row is not None:
+                yield offset, position, row_phone_keys(row)
+                position += 1
+            offset += len(record)
+
+
+@instrumented("build_offset_index")
+def build_offset_index(filename="contacts.csv"):
+    # Every phone key of a contact points at its record, sorted by key for a
+    # binary search. Keys longer than an entry are cut short, which is safe
+    # because a lookup checks the phone keys of the record it reads.
+    stat = os.stat(filename)
+    entries = []
+    contacts = 0
+    for offset, position, phone_keys in iter_snapshot_offsets(filename):
+        contacts = position + 1
+        for phone_key in set(phone_keys):
+            if phone_key:
+                entries.append((phone_key.encode("utf-8"), offset, position))
+    entries.sort()
+
+    with atomic_write(offset_index_filename(filename), mode="wb") as file:
+        file.write(
+            OFFSET_INDEX_HEADER.pack(
+                OFFSET_INDEX_MAGIC,
+                stat.st_size,
+                stat.st_mtime_ns,
+                contacts,
+                len(entries),
+            )
+        )
+        file.write(b"".join(OFFSET_INDEX_ENTRY.pack(*entry) for entry in entries))
+    record_io(rows=len(entries))
+
+
+def offset_index_current(filename):
+    # An index belongs to one version of the snapshot. Compaction writes a
+    # new snapshot, and the index is rebuilt on the next lookup.
+    stat = os.stat(filename)
+    try:
+        with open(offset_index_filename(filename), mode="rb") as file:
+            header = file.read(OFFSET_INDEX_HEADER.size)
+    except FileNotFoundError:
+        return False
+    if len(header) != OFFSET_INDEX_HEADER.size:
+        return False
+    magic, size, mtime_ns, _, _ = OFFSET_INDEX_HEADER.unpack(header)
+    return (
+        magic == OFFSET_INDEX_MAGIC
+        and size == stat.st_size
+        and mtime_ns == stat.st_mtime_ns
+    )
+
+
+def find_snapshot_offsets(phone_key, filename="contacts.csv"):
+    if not offset_index_current(filename):
+        build_offset_index(filename)
+    with mapped_snapshot(offset_index_filename(filename)) as data:
+        return search_offset_index(data, phone_key)
+
+
+def search_offset_index(data, phone_key):
+    key = phone_key.encode("utf-8")[:OFFSET_INDEX_KEY_BYTES]
+    key = key.ljust(OFFSET_INDEX_KEY_BYTES, b"\0")
+    matches = []
+    count = OFFSET_INDEX_HEADER.unpack_from(data)[4]
+    start = OFFSET_INDEX_HEADER.size
+    size = OFFSET_INDEX_ENTRY.size
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        entry = start + middle * size
+        if data[entry : entry + OFFSET_INDEX_KEY_BYTES] < key:
+            low = middle + 1
+        else:
+            high = middle
+    for entry in range(start + low * size, start + count * size, size):
+        entry_key, offset, position = OFFSET_INDEX_ENTRY.unpack_from(data, entry)
+        if entry_key != key:
+            break
+        matches.append((offset, position))
+    return matches
+
+
+@contextlib.contextmanager
+def snapshot_reader(filename="contacts.csv"):
+    # Yields a function that decodes the contact whose record starts at an
+    # offset, with the snapshot kept open between calls.
+    if is_binary_snapshot(filename):
+        with mapped_snapshot(filename) as data:
+            strings, _, _, keys_current = read_binary_footer(data)
+
+            def read(offset):
+                _, row, phone_keys = binary_row(data, offset, strings, keys_current)
+                return contact_from_row(row, phone_keys)
+
+            yield read
+        return
+
+    with open(filename, mode="rb") as file:
+        fieldnames = next(csv.reader([file.readline().decode("utf-8")]))
+
+        def read(offset):
+            file.seek(offset)
+            return contact_from_row(parse_csv_record(read_csv_record(file), fieldnames))
+
+        yield read
+
+
+def read_snapshot_contact(offset, filename="contacts.csv"):
+    with snapshot_reader(filename) as read:
+        return read(offset)
+
+
+class IndexedSnapshot:
+    # A snapshot on disk, asked about single phones through its offset
+    # index, which is built the first time it is needed.
+    def __init__(self, filename="contacts.csv"):
+        self.filename = filename
+        self.contact_count = None
+        self.files = None
+
+    @contextlib.contextmanager
+    def opened(self):
+        # Keeps the offset index mapped and the snapshot open for a run of
+        # lookups, rather than opening both for each one.
+        if self.files is not None or not os.path.exists(self.filename):
+            yield
+            return
+        if not offset_index_current(self.filename):
+            build_offset_index(self.filename)
+        with mapped_snapshot(offset_index_filename(self.filename)) as index:
+            with snapshot_reader(self.filename) as read:
+                self.files = index, read
+                try:
+                    yield
+                finally:
+                    self.files = None
+
+    def count(self):
+        if self.contact_count is None:
+            with self.opened():
+                self.contact_count = 0
+                if self.files is not None:
+                    index, _ = self.files
+                    self.contact_count = OFFSET_INDEX_HEADER.unpack_from(index)[3]
+        return self.contact_count
+
+    def find(self, phone_key):
+        # The snapshot contacts with the phone key and their positions, in
+        # snapshot order.
+        contacts = []
+        with self.opened():
+            if self.files is None:
+                return contacts
+            index, read = self.files
+            for offset, position in search_offset_index(index, phone_key):
+                contact = read(offset)
+                if phone_key in contact.phone_keys:
+                    contacts.append((position, contact))
+        return contacts
+
+
+class LoadedSnapshot:
+    # The contacts of a snapshot that is loaded whole. Their phones are
+    # gathered the first time a journal record asks for one.
+    def __init__(self, contacts):
+        self.contacts = contacts
+        self.holders = None
+
+    def opened(self):
+        return contextlib.nullcontext()
+
+    def count(self):
+        return len(self.contacts)
+
+    def find(self, phone_key):
+        if self.holders is None:
+            self.holders = {}
+            for position, contact in enumerate(self.contacts):
+                for key in set(contact_phone_keys(contact)):
+                    self.holders.setdefault(key, []).append(position)
+        return [
+            (position, self.contacts[position])
+            for position in self.holders.get(phone_key, ())
+        ]
+
+
+@instrumented("find_snapshot_contact")
+def find_snapshot_contact(phone, filename="contacts.csv", journal=None):
+    # Finds the contact a full load would find for this phone, and its
+    # position, which journal records use as their index, or None. Only the
+    # snapshot records the offset index points at are read. A journal view
+    # kept between lookups only reads what was appended since the last one.
+    phone_key = canonical_phone(phone)
+    if not phone_key:
+        return None
+    if journal is None:
+        journal = JournalView(filename)
+    journal.update()
+    return journal.find(phone_key)
+
+
+@instrumented("build_indexes")
+def build_indexes(contacts):
+    indexes = {
+        "contacts": {},
+        "phone": {},
+        # Every contact of a phone key that more than one contact has, in the
+        # order they were indexed.
+        "shared_phones": {},
+        # Postings are sorted arrays of the ordinals contacts get as they are
+        # indexed, which take a fraction of the memory of sets of ids and
+        # stay sorted by appending, since a new contact's ordinal is the
+        # highest yet.
+        "trigram": {},
+        "ordinals": {},
+        "ordinal_contacts": [],
+        "birthday": [],
+        "group": {},
+        "melody": {},
+        "prefix_keys": [],
+        "prefix_ids": [],
+        "names": BKTree(),
+        "positions": ContactPositions(),
+        # Group and melody members in shards that are not loaded, which the
+        # counts still have to include, and the phones in use there.
+        "unloaded": {"group": {}, "melody": {}, "phone": {}},
     }
+
+    duplicates = 0
+    for contact in contacts:
+        duplicates += index_contact(indexes, contact, keep_sorted=False)
+    # Sorting once is far cheaper than inserting every entry into place.
+    indexes["birthday"].sort()
+    prefix_keys = indexes["prefix_keys"]
+    prefix_ids = indexes["prefix_ids"]
+    order = sorted(range(len(prefix_keys)), key=prefix_keys.__getitem__)
+    indexes["prefix_keys"] = [prefix_keys[position] for position in order]
+    indexes["prefix_ids"] = [prefix_ids[position] for position in order]
+    if duplicates:
+        print(
+            f"Warning: {duplicates} phone number(s) are shared by more than one contact."
+        )
+
+    record_io(rows=len(indexes["contacts"]))
+    return indexes
+
+
+def contact_phones(contact):
+    other_phones = contact.other_phones
+    phones = [
+        contact.mobile_phone,
+        other_phones.mobile_phone_2,
+        other_phones.mobile_phone_3,
+        other_phones.home_phone,
+        other_phones.office_phone,
+    ]
+    return [phone for phone in phones if phone]
+
+
+def contact_phone_keys(contact):
+    return [key for key in contact.phone_keys if key]
+
+
+def contact_search_fields(contact):
+    company = contact_section(contact, "company", COMPANY_COLUMNS, Company.slot_values)
+    fields = [
+        contact.name,
+        company[0],
+        *contact_section(contact, "emails", EMAILS_COLUMNS, Emails.slot_values),
+    ]
+    fields = [field.lower() for field in fields if field]
+    fields.extend(contact_phone_keys(contact))
+    return fields
+
+
+def normalize_name(name):
+    return " ".join(name.lower().split())
+
+
+def phone_digits(phone):
+    if phone.isdigit():
+        return phone
+    return "".join(character for character in phone if character.isdigit())
+
+
+def canonical_phone(phone):
+    # "+1 555-0100", "001 555 0100" and "5550100" all get the key "5550100";
+    # numbers dialled with another country code keep it.
+    if not phone:
+        return ""
+    if phone.isdigit() and not phone.startswith("00"):
+        return phone
+
+    digits = phone_digits(phone)
+    if phone.lstrip().startswith("+"):
+        international = True
+    elif digits.startswith("00"):
+        international = True
+        digits = digits[2:]
+    else:
+        international = False
+    if international and digits.startswith(PHONE_COUNTRY_CODE):
+        digits = digits[len(PHONE_COUNTRY_CODE) :]
+    return digits
+
+
+def canonical_phones(phones):
+    return tuple(canonical_phone(phone) for phone in phones)
+
+
+def looks_like_phone(text):
+    return any(character.isdigit() for character in text) and not any(
+        character.isalpha() for character in text
+    )
+
+
+def prefix_keys(contact):
+    # Every word of the name starts a key, so "kim" finds "Amelia Kim" too.
+    words = normalize_name(contact.name or "").split(" ")
+    keys = {" ".join(words[position:]) for position in range(len(words))}
+    keys.update(contact_phone_keys(contact))
+    keys.discard("")
+    return keys
+
+
+def name_keys(contact):
+    return set(normalize_name(contact.name or "").split())
+
+
+def prefix_query(text):
+    if looks_like_phone(text):
+        return canonical_phone(text)
+    return normalize_name(text)
+
+
+def trigrams(text):
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def contact_trigrams(contact):
+    grams = set()
+    for field in contact_search_fields(contact):
+        grams.update(trigrams(field))
+    return grams
+
+
+def day_of_year(day):
+    # Days are numbered on a leap-year calendar so that February 29 always has
+    # a slot between February 28 and March 1.
+    return date(2000, day.month, day.day).timetuple().tm_yday
+
+
+def birthday_entries(contact):
+    # Reading the raw row keeps index maintenance from decoding every contact.
+    if contact.is_loaded("other"):
+        other = contact.other
+        birth_day = other.birth_day
+        spouse_name, spouse_birthday = other.spouse.name, other.spouse.birthday
+        children = other.children
+    else:
+        _, birth_day, _, spouse_name, spouse_birthday, _, _ = contact.row[OTHER_COLUMNS]
+        children = unflatten_children(contact.row)
+
+    people = [
+        (contact.name, birth_day, ""),
+        (spouse_name, spouse_birthday, "spouse"),
+    ]
+    if isinstance(children, list):
+        for child in children:
+            people.append((child.get("name"), child.get("birthday"), "child"))
+
+    entries = []
+    for position, (name, birthday, relation) in enumerate(people):
+        if not birthday:
+            continue
+        try:
+            parsed_birthday = date.fromisoformat(birthday)
+        except ValueError:
+            continue
+        entries.append(
+            (
+                day_of_year(parsed_birthday),
+                id(contact),
+                position,
+                name or "",
+                relation,
+                birthday,
+            )
+        )
+    return entries
+
+
+def index_contact(indexes, contact, keep_sorted=True):
+    contact_id = id(contact)
+    indexes["contacts"][contact_id] = contact
+
+    duplicates = 0
+    phone_index = indexes["phone"]
+    for phone_key in set(contact_phone_keys(contact)):
+        holder = phone_index.setdefault(phone_key, contact)
+        if holder is not contact:
+            duplicates += 1
+            indexes["shared_phones"].setdefault(phone_key, [holder]).append(contact)
+
+    ordinal_contacts = indexes["ordinal_contacts"]
+    ordinal = len(ordinal_contacts)
+    ordinal_contacts.append(contact)
+    indexes["ordinals"][contact_id] = ordinal
+    trigram_index = indexes["trigram"]
+    for field in contact_search_fields(contact):
+        for start in range(len(field) - 2):
+            gram = field[start : start + 3]
+            posting = trigram_index.get(gram)
+            if posting is None:
+                trigram_index[gram] = array.array("I", (ordinal,))
+            elif posting[-1] != ordinal:
+                # A gram the contact has more than once is only posted once.
+                posting.append(ordinal)
+
+    # Without keep_sorted the birthday and prefix entries are only appended,
+    # and the caller sorts them once every contact is in, as build_indexes
+    # does. Inserting each entry into place makes indexing a whole book
+    # quadratic.
+    prefix_keys_index = indexes["prefix_keys"]
+    prefix_ids_index = indexes["prefix_ids"]
+    if keep_sorted:
+        for entry in birthday_entries(contact):
+            bisect.insort(indexes["birthday"], entry)
+        for key in prefix_keys(contact):
+            position = bisect.bisect_right(prefix_keys_index, key)
+            prefix_keys_index.insert(position, key)
+            prefix_ids_index.insert(position, contact_id)
+    else:
+        indexes["birthday"].extend(birthday_entries(contact))
+        for key in prefix_keys(contact):
+            prefix_keys_index.append(key)
+            prefix_ids_index.append(contact_id)
+
+    for key in name_keys(contact):
+        indexes["names"].add(key, contact_id)
+
+    if contact.group:
+        indexes["group"].setdefault(contact.group, set()).add(contact_id)
+    if contact.melody:
+        indexes["melody"].setdefault(contact.melody, set()).add(contact_id)
+
+    return duplicates
+
+
+def unindex_contact(indexes, contact):
+    contact_id = id(contact)
+    indexes["contacts"].pop(contact_id, None)
+
+    phone_index = indexes["phone"]
+    shared_phones = indexes["shared_phones"]
+    for phone_key in set(contact_phone_keys(contact)):
+        holders = shared_phones.get(phone_key)
+        if holders is not None:
+            # Another contact with the phone takes over its index entry.
+            holders[:] = [holder for holder in holders if holder is not contact]
+            if phone_index.get(phone_key) is contact:
+                phone_index[phone_key] = holders[0]
+            if len(holders) == 1:
+                del shared_phones[phone_key]
+        elif phone_index.get(phone_key) is contact:
+            del phone_index[phone_key]
+
+    ordinal = indexes["ordinals"].pop(contact_id, None)
+    if ordinal is not None:
+        indexes["ordinal_contacts"][ordinal] = None
+        trigram_index = indexes["trigram"]
+        for gram in contact_trigrams(contact):
+            posting = trigram_index.get(gram)
+            if posting is None:
+                continue
+            position = bisect.bisect_left(posting, ordinal)
+            if position < len(posting) and posting[position] == ordinal:
+                del posting[position]
+                if not posting:
+                    del trigram_index[gram]
+
+    birthday_index = indexes["birthday"]
+    for entry in birthday_entries(contact):
+        position = bisect.bisect_left(birthday_index, entry)
+        if position < len(birthday_index) and birthday_index[position] == entry:
+            del birthday_index[position]
+
+    prefix_keys_index = indexes["prefix_keys"]
+    prefix_ids_index = indexes["prefix_ids"]
+    for key in prefix_keys(contact):
+        start = bisect.bisect_left(prefix_keys_index, key)
+        end = bisect.bisect_right(prefix_keys_index, key, start)
+        for position in range(start, end):
+            if prefix_ids_index[position] == contact_id:
+                del prefix_keys_index[position]
+                del prefix_ids_index[position]
+                break
+
+    for key in name_keys(contact):
+        indexes["names"].discard(key, contact_id)
+
+    if contact.group:
+        unindex_member(indexes, "group", contact.group, contact_id)
+    if contact.melody:
+        unindex_member(indexes, "melody", contact.melody, contact_id)
+
+
+def unindex_member(indexes, index_name, key, contact_id):
+    members = indexes[index_name].get(key)
+    if members is not None:
+        members.discard(contact_id)
+        if not members:
+            del indexes[index_name][key]
+
+
+def indexed_members(indexes, index_name, key):
+    contacts = indexes["contacts"]
+    return [contacts[contact_id] for contact_id in indexes[index_name].get(key, ())]
+
+
+def member_count(indexes, index_name, key):
+    unloaded = indexes["unloaded"][index_name].get(key, 0)
+    return len(indexes[index_name].get(key, ())) + unloaded
+
+
+def update_counts(items, indexes, store, items_name, *names):
+    # The counts kept with groups and melodies are only a copy of the
+    # membership indexes, refreshed whenever membership changes so they can
+    # never drift.
+    index_name = COUNTED_INDEXES[items_name]
+    for name in names:
+        item = find_named(items, name) if name else None
+        if item and item["count"] != member_count(indexes, index_name, name):
+            item["count"] = member_count(indexes, index_name, name)
+            store.mark_dirty(items_name)
+
+
+def upcoming_birthdays(indexes, days=BIRTHDAY_REMINDER_DAYS, today=None):
+    if today is None:
+        today = date.today()
+
+    birthday_index = indexes["birthday"]
+    start = day_of_year(today)
+    start_position = bisect.bisect_left(birthday_index, (start,))
+
+    if days >= 365:
+        entries = birthday_index[start_position:] + birthday_index[:start_position]
+    else:
+        end = day_of_year(today + timedelta(days=days))
+        end_position = bisect.bisect_left(birthday_index, (end + 1,))
+        if start <= end:
+            entries = birthday_index[start_position:end_position]
+        else:
+            entries = birthday_index[start_position:] + birthday_index[:end_position]
+
+    return [
+        (indexes["contacts"][contact_id], name, relation, birthday)
+        for _, contact_id, _, name, relation, birthday in entries
+    ]
+
+
+def complete_contacts(indexes, prefix, limit=AUTOCOMPLETE_LIMIT):
+    prefix = prefix_query(prefix)
+    if not prefix:
+        # "+1" or "  " leave no key, and every key starts with "".
+        return []
+    prefix_keys_index = indexes["prefix_keys"]
+    prefix_ids_index = indexes["prefix_ids"]
+    contacts = indexes["contacts"]
+
+    matches = []
+    seen = set()
+    position = bisect.bisect_left(prefix_keys_index, prefix)
+    while (
+        len(matches) < limit
+        and position < len(prefix_keys_index)
+        and prefix_keys_index[position].startswith(prefix)
+    ):
+        contact_id = prefix_ids_index[position]
+        if contact_id not in seen:
+            seen.add(contact_id)
+            matches.append(contacts[contact_id])
+        position += 1
+    return matches
+
+
+def edit_distance(first, second):
+    if first == second:
+        return 0
+    if not first or not second:
+        return len(first) + len(second)
+
+    # Bit-parallel Levenshtein distance (Myers/Hyyro): bit i of each vector
+    # tracks row i of the dynamic programming column for the first string.
+    positions = {}
+    for i, character in enumerate(first):
+        positions[character] = positions.get(character, 0) | (1 << i)
+
+    mask = (1 << len(first)) - 1
+    last = 1 << (len(first) - 1)
+    plus = mask
+    minus = 0
+    distance = len(first)
+    for character in second:
+        matches = positions.get(character, 0)
+        vertical = matches | minus
+        horizontal = ((((matches & plus) + plus) & mask) ^ plus) | matches
+        horizontal_plus = minus | (~(horizontal | plus) & mask)
+        horizontal_minus = plus & horizontal
+        if horizontal_plus & last:
+            distance += 1
+        elif horizontal_minus & last:
+            distance -= 1
+        horizontal_plus = ((horizontal_plus << 1) | 1) & mask
+        horizontal_minus = (horizontal_minus << 1) & mask
+        plus = horizontal_minus | (~(vertical | horizontal_plus) & mask)
+        minus = horizontal_plus & vertical
+    return distance
+
+
+class BKTree:
+    # Each node is [key, contact ids, {distance: child}]. Every key keeps its
+    # node once created, so removing the last contact with a name only empties
+    # the node, and adding it back does not touch the tree.
+    def __init__(self):
+        self.root = None
+        self.nodes = {}
+        self.unlinked = []
+
+    def add(self, key, contact_id):
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = [key, set(), {}]
+            # Finding a node's place costs an edit distance per tree level, so
+            # new keys are only linked in when the tree is next searched.
+            self.unlinked.append(node)
+        node[1].add(contact_id)
+
+    def discard(self, key, contact_id):
+        node = self.nodes.get(key)
+        if node is not None:
+            node[1].discard(contact_id)
+
+    def link(self, node):
+        if self.root is None:
+            self.root = node
+            return
+
+        parent = self.root
+        while True:
+            distance = edit_distance(node[0], parent[0])
+            child = parent[2].get(distance)
+            if child is None:
+                parent[2][distance] = node
+                return
+            parent = child
+
+    def search(self, key, max_distance):
+        for node in self.unlinked:
+            self.link(node)
+        self.unlinked = []
+
+        matches = []
+        pending = [self.root] if self.root is not None else []
+        while pending:
+            node = pending.pop()
+            distance = edit_distance(key, node[0])
+            if distance <= max_distance and node[1]:
+                matches.append((distance, node[1]))
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    pending.append(child)
+        return matches
+
+
+def fuzzy_find_contacts(indexes, query, max_distance=FUZZY_SEARCH_DISTANCE):
+    # The tree holds name words, which repeat far more than whole names do.
+    # Every query word must match a word of the name, and the distances of
+    # all query words together must stay within max_distance. Phone numbers
+    # are not names, so "+1" is not two edits away from "Li".
+    if looks_like_phone(query):
+        return []
+    distances = None
+    for word in normalize_name(query).split():
+        word_distances = {}
+        for distance, contact_ids in indexes["names"].search(word, max_distance):
+            for contact_id in contact_ids:
+                if distance < word_distances.get(contact_id, max_distance + 1):
+                    word_distances[contact_id] = distance
+
+        if distances is None:
+            distances = word_distances
+        else:
+            distances = {
+                contact_id: distances[contact_id] + distance
+                for contact_id, distance in word_distances.items()
+                if contact_id in distances
+                and distances[contact_id] + distance <= max_distance
+            }
+        if not distances:
+            return []
+
+    if distances is None:
+        return []
+
+    contacts = indexes["contacts"]
+    matches = [
+        (contacts[contact_id], distance) for contact_id, distance in distances.items()
+    ]
+    matches.sort(key=lambda match: (match[1], match[0].name.lower()))
+    return matches
+
+
+def search_query(text):
+    # None when a phone number such as "+1" has no digits left to look for.
+    if looks_like_phone(text):
+        return canonical_phone(text) or None
+    return text.lower()
+
+
+def find_contacts(indexes, query):
+    query = search_query(query)
+    if query is None:
+        return []
+    grams = trigrams(query)
+
+    if grams:
+        postings = sorted((indexes["trigram"].get(gram, ()) for gram in grams), key=len)
+        ordinal_contacts = indexes["ordinal_contacts"]
+        candidates = [
+            ordinal_contacts[ordinal] for ordinal in intersect_postings(postings)
+        ]
+    else:
+        candidates = indexes["contacts"].values()
+
+    matching_contacts = list(filter_contacts(candidates, query))
+    matching_contacts.sort(key=lambda contact: contact.name.lower())
+    return matching_contacts
+
+
+def intersect_postings(postings):
+    # Every ordinal of the shortest posting is looked for in the others by
+    # bisection, as they are sorted.
+    shortest, *others = postings
+    for ordinal in shortest:
+        for posting in others:
+            position = bisect.bisect_left(posting, ordinal)
+            if position == len(posting) or posting[position] != ordinal:
+                break
+        else:
+            yield ordinal
+
+
+def filter_contacts(contacts, query):
+    query = query.lower()
+    for contact in contacts:
+        if any(query in field for field in contact_search_fields(contact)):
+            yield contact
+
+
+SOUNDEX_CODES = {
+    letter: code
+    for code, letters in (
+        ("1", "bfpv"),
+        ("2", "cgjkqsxz"),
+        ("3", "dt"),
+        ("4", "l"),
+        ("5", "mn"),
+        ("6", "r"),
+    )
+    for letter in letters
+}
+
+
+@functools.lru_cache(maxsize=None)
+def sound_key(word):
+    letters = [character for character in word.lower() if character.isalpha()]
+    if not letters:
+        return ""
+
+    key = letters[0]
+    previous = SOUNDEX_CODES.get(letters[0], "")
+    for letter in letters[1:]:
+        code = SOUNDEX_CODES.get(letter, "")
+        if code and code != previous:
+            key += code
+            if len(key) == 4:
+                break
+        if letter not in "hw":
+            previous = code
+    return key.ljust(4, "0")
+
+
+def normalize_email(email):
+    return email.strip().lower()
+
+
+def dedup_keys(contact):
+    keys = set()
+    for phone_key in contact_phone_keys(contact):
+        keys.add(("phone", phone_key))
+    for email in contact_section(contact, "emails", EMAILS_COLUMNS, Emails.slot_values):
+        if email and email.strip():
+            keys.add(("email", normalize_email(email)))
+
+    words = normalize_name(contact.name or "").split()
+    if words:
+        # Sound-alike names only block together when the birthdays agree too,
+        # which keeps the blocks of common names small enough to compare.
+        birth_day = contact_section(contact, "other", OTHER_COLUMNS, flatten_other)[1]
+        sounds = " ".join(sorted(sound_key(word) or word for word in words))
+        keys.add(("name", sounds, birth_day or ""))
+    return keys
+
+
+def find_duplicate_clusters(contacts, block_limit=DEDUP_BLOCK_LIMIT):
+    # Contacts are only compared with the others that share a blocking key, and
+    # name blocks above block_limit are skipped, so no contact is compared more
+    # than block_limit times however large the book grows.
+    parents = list(range(len(contacts)))
+
+    def find(position):
+        while parents[position] != position:
+            parents[position] = parents[parents[position]]
+            position = parents[position]
+        return position
+
+    blocks = {}
+    for position, contact in enumerate(contacts):
+        for key in dedup_keys(contact):
+            blocks.setdefault(key, []).append(position)
+
+    links = []
+    skipped = 0
+    for key, positions in blocks.items():
+        if len(positions) < 2:
+            continue
+        if key[0] != "name":
+            links.extend(
+                (positions[0], position, f"same {key[0]} {key[1]}")
+                for position in positions[1:]
+            )
+        elif len(positions) > block_limit:
+            skipped += 1
+        else:
+            names = [normalize_name(contacts[position].name) for position in positions]
+            for first in range(len(positions)):
+                for second in range(first + 1, len(positions)):
+                    if (
+                        edit_distance(names[first], names[second])
+                        <= DEDUP_NAME_DISTANCE
+                    ):
+                        links.append(
+                            (positions[first], positions[second], "similar name")
+                        )
+
+    for first, second, _ in links:
+        first_root, second_root = find(first), find(second)
+        if first_root != second_root:
+            parents[max(first_root, second_root)] = min(first_root, second_root)
+
+    clusters = {}
+    for first, second, reason in links:
+        members, reasons = clusters.setdefault(find(first), (set(), set()))
+        members.update((first, second))
+        reasons.add(reason)
+
+    return [
+        ([contacts[position] for position in sorted(members)], sorted(reasons))
+        for _, (members, reasons) in sorted(clusters.items())
+    ], skipped
+
+
+def find_contact_by_phone(indexes, phone):
+    return indexes["phone"].get(canonical_phone(phone))
+
+
+def phone_user(indexes, phone):
+    # A phone may belong to a contact in a shard the session did not load,
+    # which find_contact_by_phone does not see.
+    phone_key = canonical_phone(phone)
+    contact = indexes["phone"].get(phone_key)
+    if contact is None:
+        contact = indexes["unloaded"]["phone"].get(phone_key)
     return contact
 
 
+def read_phone(prompt, indexes, owner=None):
+    while True:
+        phone = input(prompt)
+        existing_contact = phone_user(indexes, phone)
+        if not phone or existing_contact is None or existing_contact is owner:
+            return phone
+        print(f"The phone number {phone} is already used by {existing_contact.name}.")
+
+
+@instrumented("read_from_file")
 def read_from_file(filename):
     data = []
 
@@ -142,25 +2348,1079 @@ def read_from_file(filename):
     except Exception as e:
         print(f"Error reading from file: {e}")
 
+    record_io(rows=len(data))
     return data
 
 
+@instrumented("write_to_file")
 def write_to_file(data, filename):
     try:
-        with open(filename, mode="w", encoding="utf-8") as file:
+        with atomic_write(filename) as file:
             for item in data:
                 file.write(f"{item['name']},{item['count']}\n")
+        record_io(rows=len(data))
     except Exception as e:
         print(f"Error writing to file: {e}")
+        return False
+    return True
+
+
+class ContactPositions:
+    # Where each contact is in the book's list, so updating or deleting one
+    # does not scan the list for it. Deleting a contact moves every later
+    # one down by a place. Rather than renumbering them, a remembered
+    # position ends a short search that reaches back one place per deletion
+    # since, and contacts added since are looked for after the remembered
+    # ones. Once that search would pass REINDEX_MAX_CHANGES places, the
+    # positions are taken afresh.
+
+    def __init__(self):
+        self.positions = None
+        self.length = 0
+        self.deleted = 0
+
+    def find(self, contacts, contact):
+        if self.positions is not None:
+            position = self.positions.get(id(contact))
+            if position is None:
+                start, end = self.length - self.deleted, len(contacts)
+            else:
+                start, end = position - self.deleted, position + 1
+            if end - start <= REINDEX_MAX_CHANGES:
+                with contextlib.suppress(ValueError):
+                    return contacts.index(contact, max(start, 0), end)
+
+        self.positions = {
+            id(contact): position for position, contact in enumerate(contacts)
+        }
+        self.length = len(contacts)
+        self.deleted = 0
+        if id(contact) not in self.positions:
+            raise ValueError(f"{contact.name} is not in the contact book.")
+        return self.positions[id(contact)]
+
+    def replaced(self, old_contact, contact):
+        if self.positions is not None and id(old_contact) in self.positions:
+            self.positions[id(contact)] = self.positions.pop(id(old_contact))
+
+    def removed(self, contact):
+        if self.positions is not None:
+            self.positions.pop(id(contact), None)
+            self.deleted += 1
+
+
+class Store:
+    def __init__(self):
+        self.dirty = set()
+
+    def mark_dirty(self, name):
+        self.dirty.add(name)
+
+    def locked(self, wait=True):
+        return contextlib.nullcontext(True)
+
+    def changed(self):
+        return False
+
+    def refresh(self, contacts, groups, melodies, indexes, wait=True):
+        return False
+
+    def discard_changes(self):
+        self.dirty.clear()
+
+    def index_unloaded(self, indexes):
+        pass
+
+    def find_contact(self, phone):
+        return find_contact_by_phone(open_book(self)["indexes"], phone)
+
+    def update_contact(self, phone, data):
+        book = open_book(self)
+        batch_update_contact(book, {"mobile_phone": phone, "contact": data})
+        self.save_changes(
+            book["contacts"], book["groups"], book["melodies"], book["indexes"]
+        )
+        return find_contact_by_phone(book["indexes"], data["mobile_phone"])
+
+    @instrumented("save_changes")
+    def save_changes(self, contacts, groups, melodies, indexes=None):
+        if "contacts" in self.dirty:
+            self.save_contact_changes(contacts, indexes)
+        if "groups" in self.dirty:
+            self.save_groups(groups)
+        if "melodies" in self.dirty:
+            self.save_melodies(melodies)
+        self.dirty.clear()
+
+
+class CSVStore(Store):
+    def __init__(
+        self,
+        contacts_filename="contacts.csv",
+        groups_filename="groups.txt",
+        melodies_filename="melodies.txt",
+    ):
+        super().__init__()
+        self.contacts_filename = contacts_filename
+        self.groups_filename = groups_filename
+        self.melodies_filename = melodies_filename
+        self.pending_records = []
+        # Several processes may share these files. Every read and write
+        # happens under one lock, and the stamps and journal position below
+        # record what this process last saw, so it can tell when another
+        # process has changed the files since. A thread that holds the lock
+        # may take it again; other threads wait for it as other processes do.
+        self.lock_filename = os.path.splitext(contacts_filename)[0] + ".lock"
+        self.lock_held = threading.local()
+        self.contacts_stamp = None
+        self.journal_position = 0
+        self.file_stamps = {}
+        # The journal as folded for single lookups, kept between them.
+        self.journal = None
+
+    @contextlib.contextmanager
+    def locked(self, wait=True):
+        depth = getattr(self.lock_held, "depth", 0)
+        self.lock_held.depth = depth + 1
+        try:
+            if depth:
+                yield True
+            else:
+                with locked_file(self.lock_filename, wait) as acquired:
+                    yield acquired
+        finally:
+            self.lock_held.depth = depth
+
+    def journal_size(self):
+        journal = journal_filename(self.contacts_filename)
+        return os.path.getsize(journal) if os.path.exists(journal) else 0
+
+    def remember_contacts_file(self):
+        self.contacts_stamp = file_stamp(self.contacts_filename)
+        self.journal_position = self.journal_size()
+
+    def contacts_changed(self):
+        return (
+            file_stamp(self.contacts_filename) != self.contacts_stamp
+            or self.journal_size() != self.journal_position
+        )
+
+    def named_files(self):
+        # The groups or melodies this process changed and has not saved yet are
+        # not reloaded; saving them overwrites the file anyway.
+        return [
+            (items_name, filename)
+            for items_name, filename in (
+                ("groups", self.groups_filename),
+                ("melodies", self.melodies_filename),
+            )
+            if items_name not in self.dirty
+        ]
+
+    def changed(self):
+        return self.contacts_changed() or any(
+            file_stamp(filename) != self.file_stamps.get(filename)
+            for _, filename in self.named_files()
+        )
+
+    def load_contacts(self):
+        with self.locked():
+            contacts = read_contacts_from_csv(self.contacts_filename)
+            self.remember_contacts_file()
+        return contacts
+
+    def load_groups(self):
+        return self.load_named(self.groups_filename)
+
+    def load_melodies(self):
+        return self.load_named(self.melodies_filename)
+
+    def load_named(self, filename):
+        with self.locked():
+            items = read_from_file(filename)
+            self.file_stamps[filename] = file_stamp(filename)
+        return items
+
+    def save_groups(self, groups):
+        self.save_named(groups, self.groups_filename)
+
+    def save_melodies(self, melodies):
+        self.save_named(melodies, self.melodies_filename)
+
+    def save_named(self, items, filename):
+        with self.locked():
+            if not write_to_file(items, filename):
+                raise OSError(f"Could not save {filename}.")
+            self.file_stamps[filename] = file_stamp(filename)
+
+    def save_changes(self, contacts, groups, melodies, indexes=None):
+        # Whatever other processes saved since the last refresh is merged in
+        # first, under the same lock as the write, so it is never overwritten.
+        with self.locked():
+            if indexes is not None:
+                self.refresh(contacts, groups, melodies, indexes)
+            super().save_changes(contacts, groups, melodies, indexes)
+
+    def iter_contacts(self, fields=None):
+        return iter_contacts_from_csv(self.contacts_filename, fields)
+
+    def group_members(self, group_name):
+        return [
+            contact for contact in self.load_contacts() if contact.group == group_name
+        ]
+
+    def birthdays_within(self, days=BIRTHDAY_REMINDER_DAYS):
+        return upcoming_birthdays(build_indexes(self.load_contacts()), days)
+
+    def save_contact_changes(self, contacts, indexes=None):
+        if self.pending_records:
+            with self.locked():
+                # The records stay pending until they are in the journal, so
+                # the next save tries them again.
+                if not log_contact_changes(
+                    contacts, self.pending_records, self.contacts_filename
+                ):
+                    raise OSError(
+                        "Could not save the contact changes to "
+                        f"{journal_filename(self.contacts_filename)}."
+                    )
+                self.remember_contacts_file()
+            self.pending_records = []
+
+    def discard_changes(self):
+        self.pending_records = []
+        super().discard_changes()
+
+    def save_all(self, contacts, groups, melodies):
+        with self.locked():
+            self.pending_records = []
+            compact_journal(contacts, self.contacts_filename)
+            self.remember_contacts_file()
+            self.save_groups(groups)
+            self.save_melodies(melodies)
+        self.dirty.clear()
+
+    def find_snapshot_contact(self, phone):
+        if self.journal is None:
+            self.journal = JournalView(self.contacts_filename)
+        return find_snapshot_contact(phone, self.contacts_filename, self.journal)
+
+    def find_contact(self, phone):
+        with self.locked():
+            found = self.find_snapshot_contact(phone)
+        return None if found is None else found[0]
+
+    def update_contact(self, phone, data):
+        # Changes one contact without loading the book. The update goes to the
+        # journal like any other, and only the counts of the groups and
+        # melodies it leaves or joins change.
+        with self.locked():
+            found = self.find_snapshot_contact(phone)
+            if found is None:
+                raise ValueError(f"No contact found with the mobile phone {phone}.")
+            old_contact, position = found
+
+            contact = contact_from_command(data)
+            for new_phone in contact_phones(contact):
+                existing = self.find_snapshot_contact(new_phone)
+                if existing and existing[1] != position:
+                    raise ValueError(
+                        f"The phone number {new_phone} is already used by "
+                        f"{existing[0].name}."
+                    )
+            groups = self.load_groups()
+            melodies = self.load_melodies()
+            check_references(groups, melodies, contact)
+
+            self.contact_updated(None, position, old_contact, contact)
+            try:
+                self.save_contact_changes(None)
+            except OSError:
+                # No book holds this change, so it is dropped, not retried.
+                self.pending_records.pop()
+                raise
+            for items_name, items, old_name, name in (
+                ("groups", groups, old_contact.group, contact.group),
+                ("melodies", melodies, old_contact.melody, contact.melody),
+            ):
+                if old_name == name:
+                    continue
+                for item_name, change in ((old_name, -1), (name, 1)):
+                    item = find_named(items, item_name) if item_name else None
+                    if item:
+                        item["count"] += change
+                        self.mark_dirty(items_name)
+            if "groups" in self.dirty:
+                self.save_groups(groups)
+            if "melodies" in self.dirty:
+                self.save_melodies(melodies)
+            self.dirty.clear()
+        return contact
+
+    @instrumented("refresh")
+    def refresh(self, contacts, groups, melodies, indexes, wait=True):
+        # The file stamps are compared before the lock is taken, so a book
+        # nobody else changed costs a few stat calls and never waits for
+        # another process. New journal records are applied on their own;
+        # only a rewritten snapshot means reloading the whole book. Without
+        # wait, a refresh that would have to wait for the lock is skipped and
+        # the changes are picked up by a later one.
+        if not self.changed():
+            return False
+
+        named_items = {"groups": groups, "melodies": melodies}
+        with self.locked(wait) as acquired:
+            if not acquired:
+                return False
+            changed = self.refresh_contacts(contacts, indexes)
+            for items_name, filename in self.named_files():
+                if file_stamp(filename) != self.file_stamps.get(filename):
+                    named_items[items_name][:] = self.load_named(filename)
+                    changed = True
+            if changed:
+                for items_name, items in (("groups", groups), ("melodies", melodies)):
+                    update_counts(items, indexes, self, items_name, *find_names(items))
+        return changed
+
+    def refresh_contacts(self, contacts, indexes):
+        if not self.contacts_changed():
+            return False
+        journal = journal_filename(self.contacts_filename)
+        journal_size = self.journal_size()
+        snapshot_changed = file_stamp(self.contacts_filename) != self.contacts_stamp
+
+        if snapshot_changed or journal_size < self.journal_position:
+            # Another process compacted the journal into a new snapshot. The
+            # changes this process has not saved yet are replayed on top.
+            fresh_contacts = read_contacts_from_csv(self.contacts_filename)
+            for record in self.pending_records:
+                apply_journal_record(fresh_contacts, record)
+            contacts[:] = fresh_contacts
+            indexes.clear()
+            indexes.update(build_indexes(contacts))
+        else:
+            with open(journal, mode="rb") as file:
+                file.seek(self.journal_position)
+                data = file.read()
+            record_io(rows=data.count(b"\n"))
+            for line in data.decode("utf-8").splitlines():
+                record = json.loads(line)
+                if record["op"] != "snapshot":
+                    apply_journal_record(contacts, record, indexes)
+
+        self.remember_contacts_file()
+        return True
+
+    def log(self, record):
+        self.pending_records.append(record)
+        self.mark_dirty("contacts")
+
+    def contact_added(self, contacts, contact):
+        self.log({"op": "add", "contact": flatten_contact(contact)})
+
+    def contact_updated(self, contacts, index, old_contact, contact):
+        self.log(
+            {
+                "op": "update",
+                "index": index,
+                "mobile_phone": old_contact.mobile_phone,
+                "contact": flatten_contact(contact),
+            }
+        )
+
+    def contact_deleted(self, contacts, index, contact):
+        self.log({"op": "delete", "index": index, "mobile_phone": contact.mobile_phone})
+
+    def contact_group_changed(self, contacts, contact, old_group):
+        self.log(
+            {
+                "op": "group",
+                "mobile_phone": contact.mobile_phone,
+                "group": contact.group,
+            }
+        )
+
+    def group_moved(self, contacts, source, target):
+        self.log({"op": "move_group", "from": source, "to": target})
+
+    def close(self):
+        pass
+
+
+class UnloadedPhones:
+    # The phones of the contacts in the shards a session did not load. Each
+    # lookup reads the offset indexes of those shards, built on first use,
+    # so a new phone is checked against the whole book without loading it.
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, phone_key, default=None):
+        store = self.store
+        shards = sorted(set(store.manifest["shards"]) - store.loaded)
+        if not phone_key or not shards:
+            return default
+        with store.locked():
+            for shard in shards:
+                filename = store.shard_filename(shard)
+                if not os.path.exists(filename):
+                    continue
+                for offset, _ in find_snapshot_offsets(phone_key, filename):
+                    contact = read_snapshot_contact(offset, filename)
+                    if phone_key in contact.phone_keys:
+                        return contact
+        return default
+
+
+class ShardedStore(CSVStore):
+    # The contacts are split over several CSV files in one directory, either
+    # by a hash of the mobile phone or one file per group. manifest.json says
+    # how the book is split and how many group and melody members each shard
+    # holds, so a session can load only some of the groups and still keep the
+    # counts of the others. Saving rewrites only the shards that changed.
+    def __init__(
+        self,
+        directory="contacts",
+        partition="hash",
+        shard_count=SHARD_COUNT,
+        only_groups=None,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(
+            os.path.join(directory, "manifest.json"),
+            os.path.join(directory, "groups.txt"),
+            os.path.join(directory, "melodies.txt"),
+        )
+        self.directory = directory
+        self.manifest_filename = self.contacts_filename
+        self.manifest = {
+            "partition": partition,
+            "shard_count": shard_count,
+            "next_file": 0,
+            "shards": {},
+        }
+        self.manifest_stamp = None
+        self.read_manifest()
+        if only_groups is not None and self.manifest["partition"] != "group":
+            raise ValueError("Only a book sharded by group can load single groups.")
+        self.only_groups = None if only_groups is None else set(only_groups)
+        self.loaded = set()
+        self.dirty_shards = set()
+        self.shard_stamps = {}
+
+    def read_manifest(self):
+        with self.locked():
+            if os.path.exists(self.manifest_filename):
+                with open(self.manifest_filename, mode="r", encoding="utf-8") as file:
+                    self.manifest = json.load(file)
+            self.manifest_stamp = file_stamp(self.manifest_filename)
+
+    def write_manifest(self):
+        with atomic_write(self.manifest_filename) as file:
+            json.dump(self.manifest, file, indent=1)
+        self.manifest_stamp = file_stamp(self.manifest_filename)
+
+    # Single contacts come from a loaded book. A shard's offset index only
+    # answers which phones are in use, and changing a contact rewrites its
+    # whole shard anyway.
+    find_contact = Store.find_contact
+    update_contact = Store.update_contact
+
+    def shard_of(self, contact):
+        if self.manifest["partition"] == "group":
+            return contact.group or ""
+        return self.phone_shard(contact.phone_keys[0])
+
+    def phone_shard(self, phone_key):
+        key = zlib.crc32(phone_key.encode("utf-8"))
+        return f"{key % self.manifest['shard_count']:03d}"
+
+    def shard_filename(self, shard):
+        entry = self.manifest["shards"].get(shard)
+        if entry is None:
+            return None
+        return os.path.join(self.directory, entry["file"])
+
+    def shard_stamp(self, shard):
+        filename = self.shard_filename(shard)
+        return None if filename is None else file_stamp(filename)
+
+    def wanted_shards(self):
+        if self.only_groups is None:
+            return set(self.manifest["shards"])
+        return self.only_groups & set(self.manifest["shards"])
+
+    def read_shard(self, shard):
+        filename = self.shard_filename(shard)
+        self.shard_stamps[shard] = None if filename is None else file_stamp(filename)
+        self.loaded.add(shard)
+        if self.shard_stamps[shard] is None:
+            return []
+        return read_contacts_from_csv(filename)
+
+    def write_shard(self, shard, contacts):
+        entry = self.manifest["shards"].get(shard)
+        if not contacts:
+            if entry is not None:
+                filename = self.shard_filename(shard)
+                for name in (filename, offset_index_filename(filename)):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(name)
+                del self.manifest["shards"][shard]
+            self.shard_stamps[shard] = None
+            return
+
+        # A new shard joins the manifest only once its file is written.
+        if entry is not None:
+            file = entry["file"]
+        elif self.manifest["partition"] == "group":
+            file = f"group-{self.manifest['next_file']:04d}.csv"
+        else:
+            file = f"shard-{shard}.csv"
+        if not write_contacts_to_csv(contacts, os.path.join(self.directory, file)):
+            raise OSError(f"Could not save the contacts of shard {shard!r}.")
+        if entry is None:
+            if self.manifest["partition"] == "group":
+                self.manifest["next_file"] += 1
+            entry = self.manifest["shards"][shard] = {"file": file}
+
+        entry["contacts"] = len(contacts)
+        for index_name in COUNTED_INDEXES.values():
+            counts = {}
+            for contact in contacts:
+                name = getattr(contact, index_name)
+                if name:
+                    counts[name] = counts.get(name, 0) + 1
+            entry[index_name] = counts
+        self.shard_stamps[shard] = self.shard_stamp(shard)
+        self.loaded.add(shard)
+
+    def index_unloaded(self, indexes):
+        unloaded = {index_name: {} for index_name in COUNTED_INDEXES.values()}
+        for shard, entry in self.manifest["shards"].items():
+            if shard in self.loaded:
+                continue
+            for index_name, counts in unloaded.items():
+                for name, count in entry[index_name].items():
+                    counts[name] = counts.get(name, 0) + count
+        unloaded["phone"] = UnloadedPhones(self)
+        indexes["unloaded"] = unloaded
+
+    def load_contacts(self):
+        contacts = []
+        with self.locked():
+            self.read_manifest()
+            self.loaded = set()
+            for shard in sorted(self.wanted_shards()):
+                contacts.extend(self.read_shard(shard))
+        return contacts
+
+    def iter_contacts(self, fields=None):
+        with self.locked():
+            self.read_manifest()
+            for shard in sorted(self.wanted_shards()):
+                filename = self.shard_filename(shard)
+                if os.path.exists(filename):
+                    yield from iter_contacts_from_csv(filename, fields)
+
+    def group_members(self, group_name):
+        return self.find_contacts(group=group_name)
+
+    def find_contacts(self, **conditions):
+        # Reads just the shard that can hold the matches when the book is
+        # split by a column asked for, and every shard otherwise.
+        for column in conditions:
+            if column not in CONTACT_LIST_FIELDS:
+                raise ValueError(f"Cannot query contacts by {column}")
+        phone = conditions.pop("mobile_phone", None)
+        phone_key = canonical_phone(phone)
+        if self.manifest["partition"] == "group" and "group" in conditions:
+            shards = [conditions["group"] or ""]
+        elif self.manifest["partition"] == "hash" and phone is not None:
+            shards = [self.phone_shard(phone_key)]
+        else:
+            shards = sorted(self.manifest["shards"])
+
+        matching_contacts = []
+        with self.locked():
+            for shard in shards:
+                filename = self.shard_filename(shard)
+                if filename is None:
+                    continue
+                for contact in read_contacts_from_csv(filename):
+                    if phone is not None and contact.phone_keys[0] != phone_key:
+                        continue
+                    if all(
+                        getattr(contact, column) == value
+                        for column, value in conditions.items()
+                    ):
+                        matching_contacts.append(contact)
+        return matching_contacts
+
+    def save_contact_changes(self, contacts, indexes=None):
+        if self.dirty_shards:
+            with self.locked():
+                # A shard this process added contacts to without having
+                # loaded it is read first, so rewriting it keeps what is
+                # already in it. A refresh before saving normally did that.
+                # Its contacts join the book, so they are indexed and no
+                # longer counted as unloaded.
+                touched = self.dirty_shards - self.loaded
+                for shard in touched:
+                    shard_contacts = self.read_shard(shard)
+                    contacts.extend(shard_contacts)
+                    if indexes is not None:
+                        for contact in shard_contacts:
+                            index_contact(indexes, contact)
+                if touched and indexes is not None:
+                    self.index_unloaded(indexes)
+
+                members = {shard: [] for shard in self.dirty_shards}
+                for contact in contacts:
+                    shard_contacts = members.get(self.shard_of(contact))
+                    if shard_contacts is not None:
+                        shard_contacts.append(contact)
+                for shard, shard_contacts in members.items():
+                    self.write_shard(shard, shard_contacts)
+                self.write_manifest()
+        self.pending_records = []
+        self.dirty_shards = set()
+
+    def discard_changes(self):
+        self.dirty_shards = set()
+        super().discard_changes()
+
+    def save_all(self, contacts, groups, melodies):
+        with self.locked():
+            self.read_manifest()
+            # Shards left without contacts are removed.
+            members = {shard: [] for shard in self.manifest["shards"]}
+            for contact in contacts:
+                members.setdefault(self.shard_of(contact), []).append(contact)
+            for shard, shard_contacts in members.items():
+                self.write_shard(shard, shard_contacts)
+            self.write_manifest()
+            self.save_groups(groups)
+            self.save_melodies(melodies)
+        self.pending_records = []
+        self.dirty_shards = set()
+        self.dirty.clear()
+
+    def contacts_changed(self):
+        # Every save rewrites the manifest after the shards, so an unchanged
+        # manifest means no shard changed either.
+        return file_stamp(self.manifest_filename) != self.manifest_stamp or bool(
+            self.dirty_shards - self.loaded
+        )
+
+    def refresh_contacts(self, contacts, indexes):
+        if not self.contacts_changed():
+            return False
+        touched = self.dirty_shards - self.loaded
+        if file_stamp(self.manifest_filename) != self.manifest_stamp:
+            self.read_manifest()
+        shards = self.loaded | self.wanted_shards()
+        changed = {
+            shard
+            for shard in shards
+            if self.shard_stamp(shard) != self.shard_stamps.get(shard)
+        }
+
+        if changed & self.dirty_shards:
+            # Another process saved a shard this process has unsaved changes
+            # in. As with a rewritten snapshot, the book is reloaded and the
+            # pending changes are replayed on top.
+            fresh_contacts = []
+            for shard in sorted(shards | touched):
+                fresh_contacts.extend(self.read_shard(shard))
+            for record in self.pending_records:
+                apply_journal_record(fresh_contacts, record)
+            contacts[:] = fresh_contacts
+            indexes.clear()
+            indexes.update(build_indexes(contacts))
+        elif changed or touched:
+            self.reload_shards(contacts, indexes, changed, touched)
+
+        self.index_unloaded(indexes)
+        return True
+
+    def reload_shards(self, contacts, indexes, changed, touched):
+        # Contacts that are the same on disk as in memory stay as they are, so
+        # only what another process actually changed is reindexed.
+        fresh_contacts = {}
+        for shard in sorted(changed):
+            for contact in self.read_shard(shard):
+                fresh_contacts.setdefault(flatten_contact_row(contact), []).append(
+                    contact
+                )
+
+        kept_contacts = []
+        removed_contacts = []
+        for contact in contacts:
+            if changed and self.shard_of(contact) in changed:
+                same_contacts = fresh_contacts.get(flatten_contact_row(contact))
+                if not same_contacts:
+                    removed_contacts.append(contact)
+                    continue
+                same_contacts.pop()
+            kept_contacts.append(contact)
+
+        added_contacts = [
+            contact for same in fresh_contacts.values() for contact in same
+        ]
+        for shard in sorted(touched):
+            added_contacts.extend(self.read_shard(shard))
+        contacts[:] = kept_contacts + added_contacts
+        indexes["positions"] = ContactPositions()
+
+        # Sorted indexes make every single insertion cost a pass over them,
+        # so past a few thousand changes rebuilding them is quicker.
+        if len(removed_contacts) + len(added_contacts) > REINDEX_MAX_CHANGES:
+            indexes.clear()
+            indexes.update(build_indexes(contacts))
+        else:
+            for contact in removed_contacts:
+                unindex_contact(indexes, contact)
+            for contact in added_contacts:
+                index_contact(indexes, contact)
 
+    def contact_added(self, contacts, contact):
+        self.dirty_shards.add(self.shard_of(contact))
+        super().contact_added(contacts, contact)
 
-def add_melody(melodies):
+    def contact_updated(self, contacts, index, old_contact, contact):
+        self.dirty_shards.update((self.shard_of(old_contact), self.shard_of(contact)))
+        super().contact_updated(contacts, index, old_contact, contact)
+
+    def contact_deleted(self, contacts, index, contact):
+        self.dirty_shards.add(self.shard_of(contact))
+        super().contact_deleted(contacts, index, contact)
+
+    def contact_group_changed(self, contacts, contact, old_group):
+        self.dirty_shards.add(self.shard_of(contact))
+        if self.manifest["partition"] == "group":
+            self.dirty_shards.add(old_group or "")
+        super().contact_group_changed(contacts, contact, old_group)
+
+    def group_moved(self, contacts, source, target):
+        if self.manifest["partition"] == "group":
+            self.dirty_shards.update((source or "", target or ""))
+        else:
+            self.dirty_shards.update(
+                self.shard_of(contact)
+                for contact in contacts
+                if contact.group == target
+            )
+        super().group_moved(contacts, source, target)
+
+
+class SQLiteStore(Store):
+    INDEXED_COLUMNS = ("name", "mobile_phone", "group", "melody", "birth_month_day")
+
+    def __init__(self, filename="contacts.db"):
+        super().__init__()
+        self.filename = filename
+        # The server saves on a thread of its own; it never uses the
+        # connection from two threads at once.
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        # Contacts are plain objects, so the store remembers which row each
+        # loaded or inserted contact lives in.
+        self.row_ids = {}
+        self.create_schema()
+
+    def create_schema(self):
+        columns = ", ".join(f'"{field}" TEXT' for field in CONTACT_FIELDNAMES)
+        with self.connection:
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS contacts "
+                f"(id INTEGER PRIMARY KEY, {columns}, birth_month_day TEXT)"
+            )
+            for column in self.INDEXED_COLUMNS:
+                self.connection.execute(
+                    f'CREATE INDEX IF NOT EXISTS contacts_{column} ON contacts ("{column}")'
+                )
+            for table in ("groups", "melodies"):
+                self.connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} "
+                    f"(position INTEGER PRIMARY KEY, name TEXT, count INTEGER)"
+                )
+            # Every phone key and every birthday of a contact gets a row, as
+            # in the phone and birthday indexes of a loaded book, so looking
+            # a phone or the coming birthdays up needs no load.
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS phones (key TEXT, contact INTEGER)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS birthdays (day INTEGER, "
+                "contact INTEGER, position INTEGER, name TEXT, relation TEXT, "
+                "birthday TEXT)"
+            )
+            for table, column in (
+                ("phones", "key"),
+                ("phones", "contact"),
+                ("birthdays", "day"),
+                ("birthdays", "contact"),
+            ):
+                self.connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS {table}_{column} "
+                    f"ON {table} ({column})"
+                )
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] < 1:
+                # Older versions kept the raw phones; they are replaced by the
+                # canonical keys once.
+                self.connection.execute("DELETE FROM phones")
+                for row in self.connection.execute("SELECT * FROM contacts"):
+                    self.index_phones(row["id"], unflatten_contact(row))
+                self.connection.execute("PRAGMA user_version = 1")
+
+    def index_row(self, row_id, contact):
+        self.index_phones(row_id, contact)
+        self.connection.executemany(
+            "INSERT INTO birthdays VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (day, row_id, position, name, relation, birthday)
+                for day, _, position, name, relation, birthday in birthday_entries(
+                    contact
+                )
+            ],
+        )
+
+    def index_phones(self, row_id, contact):
+        self.connection.executemany(
+            "INSERT INTO phones (key, contact) VALUES (?, ?)",
+            [(phone_key, row_id) for phone_key in set(contact_phone_keys(contact))],
+        )
+
+    def unindex_row(self, row_id):
+        self.connection.execute("DELETE FROM phones WHERE contact = ?", (row_id,))
+        self.connection.execute("DELETE FROM birthdays WHERE contact = ?", (row_id,))
+
+    def contact_row(self, contact):
+        row = list(flatten_contact_row(contact))
+        birth_day = row[CONTACT_FIELDNAMES.index("other_birth_day")]
+        row.append(birth_day[5:10] if birth_day else None)
+        return row
+
+    def load_contacts(self):
+        contacts = []
+        self.row_ids = {}
+        for row in self.connection.execute("SELECT * FROM contacts ORDER BY id"):
+            contact = unflatten_contact(row)
+            self.row_ids[id(contact)] = row["id"]
+            contacts.append(contact)
+        return contacts
+
+    def find_contacts(self, **conditions):
+        clauses = []
+        params = []
+        for column, value in conditions.items():
+            if column not in self.INDEXED_COLUMNS:
+                raise ValueError(f"Cannot query contacts by {column}")
+            clauses.append(f'"{column}" = ?')
+            params.append(value)
+
+        where = " AND ".join(clauses) if clauses else "1"
+        rows = self.connection.execute(
+            f"SELECT * FROM contacts WHERE {where} ORDER BY id", params
+        )
+        return [unflatten_contact(row) for row in rows]
+
+    def iter_contacts(self, fields=None):
+        for row in self.connection.execute("SELECT * FROM contacts ORDER BY id"):
+            if fields is None:
+                yield unflatten_contact(row)
+            else:
+                yield project_contact(row, fields)
+
+    def find_contact_row(self, phone):
+        phone_key = canonical_phone(phone)
+        if not phone_key:
+            return None
+        return self.connection.execute(
+            "SELECT contacts.* FROM phones JOIN contacts ON contacts.id = "
+            "phones.contact WHERE phones.key = ? ORDER BY contacts.id LIMIT 1",
+            (phone_key,),
+        ).fetchone()
+
+    def find_contact(self, phone):
+        row = self.find_contact_row(phone)
+        return None if row is None else unflatten_contact(row)
+
+    def update_contact(self, phone, data):
+        # Checks and changes the one row, and the counts of the groups and
+        # melodies it leaves or joins, in a single transaction.
+        row = self.find_contact_row(phone)
+        if row is None:
+            raise ValueError(f"No contact found with the mobile phone {phone}.")
+        old_contact = unflatten_contact(row)
+
+        contact = contact_from_command(data)
+        for new_phone in contact_phones(contact):
+            existing = self.connection.execute(
+                "SELECT contacts.name FROM phones JOIN contacts ON contacts.id = "
+                "phones.contact WHERE phones.key = ? AND phones.contact != ? LIMIT 1",
+                (canonical_phone(new_phone), row["id"]),
+            ).fetchone()
+            if existing is not None:
+                raise ValueError(
+                    f"The phone number {new_phone} is already used by "
+                    f"{existing['name']}."
+                )
+        check_references(self.load_groups(), self.load_melodies(), contact)
+
+        with self.connection:
+            self.row_ids[id(old_contact)] = row["id"]
+            self.contact_updated(None, None, old_contact, contact)
+            for table, old_name, name in (
+                ("groups", old_contact.group, contact.group),
+                ("melodies", old_contact.melody, contact.melody),
+            ):
+                if old_name != name:
+                    for item_name, change in ((old_name, -1), (name, 1)):
+                        self.connection.execute(
+                            f"UPDATE {table} SET count = count + ? WHERE name = ?",
+                            (change, item_name),
+                        )
+        self.dirty.clear()
+        return contact
+
+    def group_members(self, group_name):
+        return self.find_contacts(group=group_name)
+
+    def birthdays_within(self, days=BIRTHDAY_REMINDER_DAYS):
+        # The same days as upcoming_birthdays, as ranges of the day-of-year
+        # column; a range past the end of the year wraps to its start.
+        today = date.today()
+        start = day_of_year(today)
+        if days >= 365:
+            ranges = [(start, 366), (1, start - 1)]
+        else:
+            end = day_of_year(today + timedelta(days=days))
+            ranges = [(start, end)] if start <= end else [(start, 366), (1, end)]
+
+        birthdays = []
+        for first_day, last_day in ranges:
+            rows = self.connection.execute(
+                "SELECT contacts.*, birthdays.name AS person, birthdays.relation "
+                "AS relation, birthdays.birthday AS birthday FROM birthdays JOIN "
+                "contacts ON contacts.id = birthdays.contact WHERE birthdays.day "
+                "BETWEEN ? AND ? ORDER BY birthdays.day, birthdays.contact, "
+                "birthdays.position",
+                (first_day, last_day),
+            )
+            birthdays.extend(
+                (
+                    unflatten_contact(row),
+                    row["person"],
+                    row["relation"],
+                    row["birthday"],
+                )
+                for row in rows
+            )
+        return birthdays
+
+    def load_groups(self):
+        return self.load_counts("groups")
+
+    def load_melodies(self):
+        return self.load_counts("melodies")
+
+    def load_counts(self, table):
+        rows = self.connection.execute(
+            f"SELECT name, count FROM {table} ORDER BY position"
+        )
+        return [{"name": row["name"], "count": row["count"]} for row in rows]
+
+    def save_groups(self, groups):
+        with self.connection:
+            self.save_counts("groups", groups)
+
+    def save_melodies(self, melodies):
+        with self.connection:
+            self.save_counts("melodies", melodies)
+
+    def save_counts(self, table, data):
+        self.connection.execute(f"DELETE FROM {table}")
+        self.connection.executemany(
+            f"INSERT INTO {table} (name, count) VALUES (?, ?)",
+            [(item["name"], item["count"]) for item in data],
+        )
+
+    def save_contact_changes(self, contacts, indexes=None):
+        # Contact writes accumulate in one open transaction until here.
+        self.connection.commit()
+
+    def discard_changes(self):
+        self.connection.rollback()
+        super().discard_changes()
+
+    def save_all(self, contacts, groups, melodies):
+        with self.connection:
+            for table in ("contacts", "phones", "birthdays"):
+                self.connection.execute(f"DELETE FROM {table}")
+            self.row_ids = {}
+            for contact in contacts:
+                self.insert_contact(contact)
+            self.save_counts("groups", groups)
+            self.save_counts("melodies", melodies)
+        self.dirty.clear()
+
+    def insert_contact(self, contact):
+        placeholders = ", ".join("?" for _ in range(len(CONTACT_FIELDNAMES) + 1))
+        columns = ", ".join(f'"{field}"' for field in CONTACT_FIELDNAMES)
+        cursor = self.connection.execute(
+            f"INSERT INTO contacts ({columns}, birth_month_day) VALUES ({placeholders})",
+            self.contact_row(contact),
+        )
+        self.row_ids[id(contact)] = cursor.lastrowid
+        self.index_row(cursor.lastrowid, contact)
+
+    def contact_added(self, contacts, contact):
+        self.insert_contact(contact)
+        self.mark_dirty("contacts")
+
+    def contact_updated(self, contacts, index, old_contact, contact):
+        assignments = ", ".join(f'"{field}" = ?' for field in CONTACT_FIELDNAMES)
+        row_id = self.row_ids.pop(id(old_contact))
+        self.connection.execute(
+            f"UPDATE contacts SET {assignments}, birth_month_day = ? WHERE id = ?",
+            self.contact_row(contact) + [row_id],
+        )
+        self.unindex_row(row_id)
+        self.index_row(row_id, contact)
+        self.row_ids[id(contact)] = row_id
+        self.mark_dirty("contacts")
+
+    def contact_deleted(self, contacts, index, contact):
+        row_id = self.row_ids.pop(id(contact))
+        self.connection.execute("DELETE FROM contacts WHERE id = ?", (row_id,))
+        self.unindex_row(row_id)
+        self.mark_dirty("contacts")
+
+    def contact_group_changed(self, contacts, contact, old_group):
+        self.connection.execute(
+            'UPDATE contacts SET "group" = ? WHERE id = ?',
+            (contact.group, self.row_ids[id(contact)]),
+        )
+        self.mark_dirty("contacts")
+
+    def group_moved(self, contacts, source, target):
+        self.connection.execute(
+            'UPDATE contacts SET "group" = ? WHERE "group" = ?', (target, source)
+        )
+        self.mark_dirty("contacts")
+
+    def close(self):
+        self.connection.close()
+
+
+@instrumented("menu add_melody")
+def add_melody(melodies, store):
     print("Current melodies:")
     if not melodies:
         print("No melodies available.")
     else:
-        for index, melody in enumerate(melodies):
-            print(f"{index + 1}. {melody['name']}")
+        print_numbered(melody["name"] for melody in melodies)
 
     try:
         melody_name = input(
@@ -170,7 +3430,7 @@ def add_melody(melodies):
             print("Returning to main menu.")
         else:
             melodies.append({"name": melody_name, "count": 0})
-            write_to_file(melodies, "melodies.txt")
+            store.mark_dirty("melodies")
             print(f"Melody '{melody_name}' has been added.")
     except EOFError:
         print("Unexpected input error. Please try again.")
@@ -178,10 +3438,13 @@ def add_melody(melodies):
     return melodies
 
 
+@instrumented("menu show_melodies")
 def show_melodies(melodies):
     print("\nMelodies:")
-    for index, melody in enumerate(melodies):
-        print(f"{index + 1}. {melody['name']} (used by {melody['count']} contact(s))")
+    print_numbered(
+        f"{melody['name']} (used by {melody['count']} contact(s))"
+        for melody in melodies
+    )
     print("\nPress Enter to return to the main menu.")
 
     while True:
@@ -197,13 +3460,13 @@ def show_melodies(melodies):
             )
 
 
-def delete_melody(melodies):
+@instrumented("menu delete_melody")
+def delete_melody(melodies, store):
     print("Available melodies:")
     if not melodies:
         print("No melodies available.")
     else:
-        for index, melody in enumerate(melodies):
-            print(f"{index + 1}. {melody['name']}")
+        print_numbered(melody["name"] for melody in melodies)
 
         valid_input = False
         while not valid_input:
@@ -234,7 +3497,7 @@ def delete_melody(melodies):
 
         if melody["count"] == 0:
             melodies.pop(melody_index)
-            write_to_file(melodies, "melodies.txt")
+            store.mark_dirty("melodies")
             print(f"Melody '{melody['name']}' has been deleted.")
         else:
             print(
@@ -243,13 +3506,13 @@ def delete_melody(melodies):
     return melodies
 
 
-def add_group(groups):
+@instrumented("menu add_group")
+def add_group(groups, store):
     print("Current groups:")
     if not groups:
         print("No groups available.")
     else:
-        for index, group in enumerate(groups):
-            print(f"{index + 1}. {group['name']}")
+        print_numbered(group["name"] for group in groups)
 
     try:
         group_name = input(
@@ -259,7 +3522,7 @@ def add_group(groups):
             print("Returning to main menu.")
         else:
             groups.append({"name": group_name, "count": 0})
-            write_to_file(groups, "groups.txt")
+            store.mark_dirty("groups")
             print(f"Group '{group_name}' has been added.")
     except EOFError:
         print("Unexpected input error. Please try again.")
@@ -267,10 +3530,12 @@ def add_group(groups):
     return groups
 
 
+@instrumented("menu show_groups")
 def show_groups(groups):
     print("\nGroups:")
-    for index, group in enumerate(groups):
-        print(f"{index + 1}. {group['name']} (contains {group['count']} contact(s))")
+    print_numbered(
+        f"{group['name']} (contains {group['count']} contact(s))" for group in groups
+    )
     print("\nPress Enter to return to the main menu.")
 
     while True:
@@ -286,13 +3551,13 @@ def show_groups(groups):
             )
 
 
-def delete_group(groups):
+@instrumented("menu delete_group")
+def delete_group(groups, store):
     print("Available groups:")
     if not groups:
         print("No groups available.")
     else:
-        for index, group in enumerate(groups):
-            print(f"{index + 1}. {group['name']}")
+        print_numbered(group["name"] for group in groups)
 
         valid_input = False
         while not valid_input:
@@ -307,7 +3572,7 @@ def delete_group(groups):
                 )
                 if group_index == -1:
                     print("Returning to main menu.")
-                    return melodies
+                    return groups
                 elif 0 <= group_index < len(groups):
                     valid_input = True
                 else:
@@ -323,7 +3588,7 @@ def delete_group(groups):
 
         if group["count"] == 0:
             groups.pop(group_index)
-            write_to_file(groups, "groups.txt")
+            store.mark_dirty("groups")
             print(f"Group '{group['name']}' has been deleted.")
         else:
             print(
@@ -332,61 +3597,79 @@ def delete_group(groups):
     return groups
 
 
-def main():
-    contacts = read_contacts_from_csv()
-    melodies = read_from_file("melodies.txt")
-    groups = read_from_file("groups.txt")
+def main(store):
+    contacts = store.load_contacts()
+    melodies = store.load_melodies()
+    groups = store.load_groups()
+    indexes = build_indexes(contacts)
+    store.index_unloaded(indexes)
+    update_counts(groups, indexes, store, "groups", *find_names(groups))
+    update_counts(melodies, indexes, store, "melodies", *find_names(melodies))
 
     while True:
         try:
             print_menu()
             user_input = input("Please enter the number of your choice (0 to exit): ")
+            store.refresh(contacts, groups, melodies, indexes)
 
             if user_input == "0":
                 print("Exiting the program.")
                 break
             elif user_input == "1":
-                contacts, groups, melodies = add_contact(contacts, groups, melodies)
-                write_to_file(groups, "groups.txt")
-                write_to_file(melodies, "melodies.txt")
-                write_contacts_to_csv(contacts)
+                contacts, groups, melodies = add_contact(
+                    contacts, groups, melodies, indexes, store
+                )
             elif user_input == "2":
-                contacts, groups, melodies = update_contact(contacts, groups, melodies)
-                write_to_file(groups, "groups.txt")
-                write_to_file(melodies, "melodies.txt")
-                write_contacts_to_csv(contacts)
+                contacts, groups, melodies = update_contact(
+                    contacts, groups, melodies, indexes, store
+                )
             elif user_input == "3":
-                contacts = delete_contact(contacts)
-                write_contacts_to_csv(contacts)
+                contacts = delete_contact(contacts, groups, melodies, indexes, store)
             elif user_input == "4":
-                search_contact(contacts)
+                search_contact(contacts, indexes)
             elif user_input == "5":
-                groups = add_group(groups)
+                groups = add_group(groups, store)
             elif user_input == "6":
                 show_groups(groups)
             elif user_input == "7":
-                groups = delete_group(groups)
+                groups = delete_group(groups, store)
             elif user_input == "8":
-                contacts, groups = manage_group_subscription(contacts, groups)
-                write_contacts_to_csv(contacts)
-                write_to_file(groups, "groups.txt")
+                contacts, groups = manage_group_subscription(
+                    contacts, groups, indexes, store
+                )
             elif user_input == "9":
-                manage_birthday_reminders(contacts)
+                manage_birthday_reminders(contacts, indexes)
             elif user_input == "10":
                 print_contact_list(contacts)
             elif user_input == "11":
-                print_contact_details(contacts)
+                print_contact_details(contacts, indexes)
             elif user_input == "12":
-                melodies = add_melody(melodies)
+                melodies = add_melody(melodies, store)
             elif user_input == "13":
                 show_melodies(melodies)
             elif user_input == "14":
-                melodies = delete_melody(melodies)
+                melodies = delete_melody(melodies, store)
+            elif user_input == "15":
+                list_group_members(groups, indexes)
+            elif user_input == "16":
+                contacts, groups = move_group_members(contacts, groups, indexes, store)
+            elif user_input == "17":
+                list_melody_users(melodies, indexes)
+            elif user_input == "18":
+                contacts, groups, melodies = find_duplicates(
+                    contacts, groups, melodies, indexes, store
+                )
             else:
-                print("Invalid input. Please enter a number between 0 and 14.")
+                print("Invalid input. Please enter a number between 0 and 18.")
         except Exception as e:
             print(f"Error: {e}")
-            continue
+
+        try:
+            store.save_changes(contacts, groups, melodies, indexes)
+        except OSError as e:
+            print(f"Error: {e} They stay pending and are saved after the next action.")
+        if instrumentation is not None:
+            instrumentation.action_finished()
 
 
 def print_menu():
@@ -405,6 +3688,10 @@ def print_menu():
     print("12. Add a melody")
     print("13. Show melodies")
     print("14. Delete a melody")
+    print("15. List the members of a group")
+    print("16. Move the members of a group")
+    print("17. List the contacts using a melody")
+    print("18. Find and merge duplicate contacts")
     print("0. Exit the program")
 
 
@@ -418,43 +3705,76 @@ def create_contact(
     melody={},
     other={},
 ):
-    contact = {
-        "name": name,
-        "mobile_phone": mobile_phone,
-        "group": group,
-        "company": {
-            "name": company.get("name", None),
-            "occupation": company.get("occupation", None),
-            "address": company.get("address", None),
-            "web_page": company.get("web_page", None),
-        },
-        "other_phones": {
-            "mobile_phone_2": other_phones.get("mobile_phone_2", None),
-            "mobile_phone_3": other_phones.get("mobile_phone_3", None),
-            "home_phone": other_phones.get("home_phone", None),
-            "office_phone": other_phones.get("office_phone", None),
-        },
-        "emails": {
-            "private_email_1": emails.get("private_email_1", None) if emails else None,
-            "private_email_2": emails.get("private_email_2", None) if emails else None,
-            "office_email": emails.get("office_email", None) if emails else None,
-        },
-        "melody": melody,
-        "other": {
-            "address": other.get("address", None) if other else None,
-            "birth_day": other.get("birth_day", None) if other else None,
-            "notes": other.get("notes", None) if other else None,
-            "spouse": {
-                "name": other.get("spouse", {}).get("name", None),
-                "birthday": other.get("spouse", {}).get("birthday", None),
-                "notes": other.get("spouse", {}).get("notes", None),
-            },
-            "children": other.get("children", {}),
-        },
-    }
+    spouse = other.get("spouse", {})
+    contact = Contact(
+        name,
+        mobile_phone,
+        group,
+        Company(
+            company.get("name", None),
+            company.get("occupation", None),
+            company.get("address", None),
+            company.get("web_page", None),
+        ),
+        OtherPhones(
+            other_phones.get("mobile_phone_2", None),
+            other_phones.get("mobile_phone_3", None),
+            other_phones.get("home_phone", None),
+            other_phones.get("office_phone", None),
+        ),
+        Emails(
+            emails.get("private_email_1", None),
+            emails.get("private_email_2", None),
+            emails.get("office_email", None),
+        ),
+        melody,
+        OtherDetails(
+            other.get("address", None),
+            other.get("birth_day", None),
+            other.get("notes", None),
+            Spouse(
+                spouse.get("name", None),
+                spouse.get("birthday", None),
+                spouse.get("notes", None),
+            ),
+            other.get("children", []),
+        ),
+    )
     return contact
 
 
+def select_contact(indexes, action):
+    while True:
+        prefix = input(
+            f"Enter the beginning of the name or phone number of the contact to {action} "
+            "(or press Enter to return to the main menu): "
+        )
+        if not prefix.strip():
+            return None
+
+        matches = complete_contacts(indexes, prefix, AUTOCOMPLETE_LIMIT + 1)
+        if not matches:
+            print(f"No contacts start with '{prefix}'.")
+            continue
+
+        print_numbered(
+            f"{contact.name} ({contact.mobile_phone})"
+            for contact in matches[:AUTOCOMPLETE_LIMIT]
+        )
+        if len(matches) > AUTOCOMPLETE_LIMIT:
+            print(
+                f"Only the first {AUTOCOMPLETE_LIMIT} matches are shown; type more to narrow them down."
+            )
+
+        choice = input("Enter the contact's number (or press Enter to search again): ")
+        if not choice:
+            continue
+        selected_index = int(choice) - 1
+        if 0 <= selected_index < min(len(matches), AUTOCOMPLETE_LIMIT):
+            return matches[selected_index]
+        print("Invalid contact number.")
+
+
 def input_yes_no(prompt):
     while True:
         answer = input(prompt).strip().lower()
@@ -464,10 +3784,158 @@ def input_yes_no(prompt):
             print("Invalid input. Please enter 'y' for yes or 'n' for no.")
 
 
-def add_contact(contacts, groups, melodies):
+def find_named(items, name):
+    return next((item for item in items if item["name"] == name), None)
+
+
+def find_names(items):
+    return [item["name"] for item in items]
+
+
+def phone_conflict(indexes, contact, owner=None):
+    for phone in contact_phones(contact):
+        existing_contact = phone_user(indexes, phone)
+        if existing_contact is not None and existing_contact is not owner:
+            return phone, existing_contact
+    return None
+
+
+def insert_contact(contacts, groups, melodies, indexes, store, contact):
+    contacts.append(contact)
+    index_contact(indexes, contact)
+    update_counts(groups, indexes, store, "groups", contact.group)
+    update_counts(melodies, indexes, store, "melodies", contact.melody)
+    store.contact_added(contacts, contact)
+
+
+def replace_contact(contacts, groups, melodies, indexes, store, index, contact):
+    old_contact = contacts[index]
+    unindex_contact(indexes, old_contact)
+    contacts[index] = contact
+    indexes["positions"].replaced(old_contact, contact)
+    index_contact(indexes, contact)
+    update_counts(groups, indexes, store, "groups", old_contact.group, contact.group)
+    update_counts(
+        melodies, indexes, store, "melodies", old_contact.melody, contact.melody
+    )
+    store.contact_updated(contacts, index, old_contact, contact)
+
+
+def remove_contact(contacts, groups, melodies, indexes, store, index):
+    contact = contacts[index]
+    unindex_contact(indexes, contact)
+    del contacts[index]
+    indexes["positions"].removed(contact)
+    update_counts(groups, indexes, store, "groups", contact.group)
+    update_counts(melodies, indexes, store, "melodies", contact.melody)
+    store.contact_deleted(contacts, index, contact)
+
+
+def set_contact_group(contacts, groups, indexes, store, contact, group_name):
+    old_group_name = contact.group
+    if old_group_name:
+        unindex_member(indexes, "group", old_group_name, id(contact))
+
+    contact.group = group_name
+    if group_name:
+        indexes["group"].setdefault(group_name, set()).add(id(contact))
+    update_counts(groups, indexes, store, "groups", old_group_name, group_name)
+    store.contact_group_changed(contacts, contact, old_group_name)
+
+
+def move_group(contacts, groups, indexes, store, source, target):
+    if source == target:
+        return 0
+
+    members = indexes["group"].pop(source, set())
+    contacts_by_id = indexes["contacts"]
+    for contact_id in members:
+        contacts_by_id[contact_id].group = target
+    if target:
+        indexes["group"].setdefault(target, set()).update(members)
+
+    update_counts(groups, indexes, store, "groups", source, target)
+    store.group_moved(contacts, source, target)
+    return len(members)
+
+
+def fill_missing(target, source):
+    for key, value in source.items():
+        if isinstance(value, dict):
+            fill_missing(target[key], value)
+        elif isinstance(value, list) and isinstance(target.get(key), list):
+            target[key] = target[key] + [
+                item for item in value if item not in target[key]
+            ]
+        elif value and not target.get(key) and value not in target.values():
+            target[key] = value
+
+
+def merge_contact_details(cluster):
+    # The first contact wins every field it has; the duplicates only fill the
+    # gaps, and their phone numbers move into free phone slots.
+    merged = cluster[0].to_dict()
+    phone_slots = merged["other_phones"]
+    known_phones = set(contact_phone_keys(cluster[0]))
+    dropped_phones = []
+    for duplicate in cluster[1:]:
+        details = duplicate.to_dict()
+        phones = [(None, details.pop("mobile_phone"))]
+        phones.extend(details.pop("other_phones").items())
+        fill_missing(merged, details)
+
+        for preferred_slot, phone in phones:
+            phone_key = canonical_phone(phone)
+            if not phone_key or phone_key in known_phones:
+                continue
+            known_phones.add(phone_key)
+            free_slots = [slot for slot in OtherPhones.fields if not phone_slots[slot]]
+            if not free_slots:
+                dropped_phones.append(phone)
+            elif preferred_slot in free_slots:
+                phone_slots[preferred_slot] = phone
+            else:
+                phone_slots[free_slots[0]] = phone
+
+    return create_contact(**merged), dropped_phones
+
+
+def merge_duplicates(contacts, groups, melodies, indexes, store, clusters):
+    positions = {id(contact): position for position, contact in enumerate(contacts)}
+    merged_contacts = []
+    removed_positions = []
+    dropped_phones = []
+    for cluster in clusters:
+        contact, dropped = merge_contact_details(cluster)
+        merged_contacts.append((cluster[0], contact))
+        removed_positions.extend(positions[id(duplicate)] for duplicate in cluster[1:])
+        dropped_phones.extend(dropped)
+
+    # The duplicates go first so that their phone numbers are free for the
+    # merged contacts by the time those are indexed.
+    for position in sorted(removed_positions, reverse=True):
+        remove_contact(contacts, groups, melodies, indexes, store, position)
+
+    positions = {id(contact): position for position, contact in enumerate(contacts)}
+    for survivor, contact in merged_contacts:
+        replace_contact(
+            contacts, groups, melodies, indexes, store, positions[id(survivor)], contact
+        )
+    return len(removed_positions), dropped_phones
+
+
+@instrumented("menu add_contact")
+def add_contact(contacts, groups, melodies, indexes, store):
     print("Adding a new contact.")
+    contact = input_contact(groups, melodies, indexes)
+    insert_contact(contacts, groups, melodies, indexes, store, contact)
+
+    return contacts, groups, melodies
+
+
+def input_contact(groups, melodies, indexes, owner=None):
     name = input("Enter name: ")
-    mobile_phone = input("Enter mobile phone: ")
+    mobile_phone = read_phone("Enter mobile phone: ", indexes, owner)
 
     group = None
     if (
@@ -475,20 +3943,16 @@ def add_contact(contacts, groups, melodies):
         and input_yes_no("Do you want to add the contact to a group? (y/n): ") == "y"
     ):
         print("Available groups:")
-        for index, group_item in enumerate(groups):
-            print(f"{index + 1}. {group_item['name']}")
+        print_numbered(group_item["name"] for group_item in groups)
         group_index = int(input("Enter the number of the desired group: ")) - 1
         group = groups[group_index]["name"]
-        groups[group_index]["count"] += 1
 
     melody = "default"
     if melodies and input_yes_no("Do you want to add a melody? (y/n): ") == "y":
         print("Available melodies:")
-        for index, melody_item in enumerate(melodies):
-            print(f"{index + 1}. {melody_item['name']}")
+        print_numbered(melody_item["name"] for melody_item in melodies)
         melody_index = int(input("Enter the number of the desired melody: ")) - 1
         melody = melodies[melody_index]["name"]
-        melodies[melody_index]["count"] += 1
 
     company = {}
     if input_yes_no("Do you want to add company details? (y/n): ") == "y":
@@ -505,10 +3969,10 @@ def add_contact(contacts, groups, melodies):
 
     other_phones = {}
     if input_yes_no("Do you want to add other phone numbers? (y/n): ") == "y":
-        mobile_phone_2 = input("Enter mobile phone 2: ")
-        mobile_phone_3 = input("Enter mobile phone 3: ")
-        home_phone = input("Enter home phone: ")
-        office_phone = input("Enter office phone: ")
+        mobile_phone_2 = read_phone("Enter mobile phone 2: ", indexes, owner)
+        mobile_phone_3 = read_phone("Enter mobile phone 3: ", indexes, owner)
+        home_phone = read_phone("Enter home phone: ", indexes, owner)
+        office_phone = read_phone("Enter office phone: ", indexes, owner)
         other_phones = {
             "mobile_phone_2": mobile_phone_2,
             "mobile_phone_3": mobile_phone_3,
@@ -578,55 +4042,45 @@ def add_contact(contacts, groups, melodies):
         other=other,
     )
 
-    contacts.append(contact)
-
-    return contacts, groups, melodies
+    return contact
 
 
-def update_contact(contacts, groups, melodies):
+@instrumented("menu update_contact")
+def update_contact(contacts, groups, melodies, indexes, store):
     if not contacts:
         print("No contacts to update.")
-        return contacts
-
-    print("Select a contact to update or press 0 to return to the main menu:")
-    for index, contact in enumerate(contacts):
-        print(f"{index + 1}. {contact['name']} ({contact['mobile_phone']})")
+        return contacts, groups, melodies
 
     try:
-        selected_index = int(input("Enter the contact's number: ")) - 1
-        if selected_index == -1:
-            return contacts
-        if selected_index < 0 or selected_index >= len(contacts):
-            print("Invalid contact number.")
-            return contacts
+        selected_contact = select_contact(indexes, "update")
+        if selected_contact is None:
+            return contacts, groups, melodies
 
-        updated_contact, groups, melodies = add_contact([], groups, melodies)
-        contacts[selected_index] = updated_contact[0]
+        selected_index = indexes["positions"].find(contacts, selected_contact)
+        updated_contact = input_contact(groups, melodies, indexes, selected_contact)
+        replace_contact(
+            contacts, groups, melodies, indexes, store, selected_index, updated_contact
+        )
     except ValueError:
         print("Invalid input. Please enter a valid number.")
-        return contacts
+        return contacts, groups, melodies
 
     return contacts, groups, melodies
 
 
-def delete_contact(contacts):
+@instrumented("menu delete_contact")
+def delete_contact(contacts, groups, melodies, indexes, store):
     if not contacts:
         print("No contacts to delete.")
         return contacts
 
-    print("Select a contact to delete or press 0 to return to the main menu:")
-    for index, contact in enumerate(contacts):
-        print(f"{index + 1}. {contact['name']} ({contact['mobile_phone']})")
-
     try:
-        selected_index = int(input("Enter the contact's number: ")) - 1
-        if selected_index == -1:
-            return contacts
-        if selected_index < 0 or selected_index >= len(contacts):
-            print("Invalid contact number.")
+        selected_contact = select_contact(indexes, "delete")
+        if selected_contact is None:
             return contacts
 
-        del contacts[selected_index]
+        selected_index = indexes["positions"].find(contacts, selected_contact)
+        remove_contact(contacts, groups, melodies, indexes, store, selected_index)
         print("Contact deleted.")
     except ValueError:
         print("Invalid input. Please enter a valid number.")
@@ -635,34 +4089,38 @@ def delete_contact(contacts):
     return contacts
 
 
-def search_contact(contacts):
+@instrumented("menu search_contact")
+def search_contact(contacts, indexes):
     if not contacts:
         print("No contacts to search.")
         return
 
     try:
-        search_query = input("Enter a search query (name or mobile phone): ").lower()
+        search_query = input(
+            "Enter a search query (name, phone, email or company): "
+        ).lower()
     except (KeyboardInterrupt, EOFError):
         print("\nCancelled search.")
         return
 
-    matching_contacts = [
-        contact
-        for contact in contacts
-        if search_query in contact["name"].lower()
-        or search_query in contact["mobile_phone"]
-    ]
+    matching_contacts = find_contacts(indexes, search_query)
 
     if not matching_contacts:
-        print("No contacts found matching your search query.")
+        similar_contacts = fuzzy_find_contacts(indexes, search_query)
+        if not similar_contacts:
+            print("No contacts found matching your search query.")
+            return
+
+        print("No exact matches. Contacts with a similar name:")
+        for contact, distance in similar_contacts:
+            print(f"{contact.name} ({contact.mobile_phone}) - {distance} edit(s) away")
         return
 
-    print("Matching contacts:")
-    for contact in matching_contacts:
-        print(f"{contact['name']} ({contact['mobile_phone']})")
+    print_contact_list(matching_contacts, "Matching contacts:")
 
 
-def manage_group_subscription(contacts, groups):
+@instrumented("menu manage_group_subscription")
+def manage_group_subscription(contacts, groups, indexes, store):
     if not contacts:
         print("No contacts available to manage group subscriptions.")
         return contacts, groups
@@ -675,17 +4133,13 @@ def manage_group_subscription(contacts, groups):
         print("\nCancelled group subscription management.")
         return contacts, groups
 
-    selected_contact = None
-    for contact in contacts:
-        if contact["mobile_phone"] == contact_mobile_phone:
-            selected_contact = contact
-            break
+    selected_contact = find_contact_by_phone(indexes, contact_mobile_phone)
 
     if not selected_contact:
         print("No contact found with the provided mobile phone number.")
         return contacts, groups
 
-    print(f"Managing group subscription for: {selected_contact['name']}")
+    print(f"Managing group subscription for: {selected_contact.name}")
 
     if not groups:
         print("No groups available.")
@@ -711,46 +4165,26 @@ def manage_group_subscription(contacts, groups):
             print("\nCancelled group subscription management.")
             return contacts, groups
 
-        group = next((group for group in groups if group["name"] == group_name), None)
-        if not group:
+        if not find_named(groups, group_name):
             print(f"No group with the name {group_name} found.")
             return contacts, groups
 
-        if selected_contact["group"] == group_name:
-            print(f"{selected_contact['name']} is already in the group {group_name}.")
+        if selected_contact.group == group_name:
+            print(f"{selected_contact.name} is already in the group {group_name}.")
         else:
-            if selected_contact["group"]:
-                old_group = next(
-                    (
-                        group
-                        for group in groups
-                        if group["name"] == selected_contact["group"]
-                    ),
-                    None,
-                )
-                if old_group:
-                    old_group["count"] -= 1
-
-            selected_contact["group"] = group_name
-            group["count"] += 1
-            print(
-                f"{selected_contact['name']} has been added to the group {group_name}."
+            set_contact_group(
+                contacts, groups, indexes, store, selected_contact, group_name
             )
+            print(f"{selected_contact.name} has been added to the group {group_name}.")
 
     elif action == "remove":
-        if not selected_contact["group"]:
-            print(f"{selected_contact['name']} is not in any group.")
+        if not selected_contact.group:
+            print(f"{selected_contact.name} is not in any group.")
         else:
-            group_name = selected_contact["group"]
-            group = next(
-                (group for group in groups if group["name"] == group_name), None
-            )
-            if group:
-                group["count"] -= 1
-
-            selected_contact["group"] = None
+            group_name = selected_contact.group
+            set_contact_group(contacts, groups, indexes, store, selected_contact, None)
             print(
-                f"{selected_contact['name']} has been removed from the group {group_name}."
+                f"{selected_contact.name} has been removed from the group {group_name}."
             )
     else:
         print("Invalid action. Please enter 'add' or 'remove'.")
@@ -758,101 +4192,870 @@ def manage_group_subscription(contacts, groups):
     return contacts, groups
 
 
-def manage_birthday_reminders(contacts):
-    today = datetime.today()
-    ten_days_from_today = today + timedelta(days=10)
+@instrumented("menu list_group_members")
+def list_group_members(groups, indexes):
+    if not groups:
+        print("No groups available.")
+        return
+
+    print("Available groups:")
+    for group in groups:
+        print(f"{group['name']}: {group['count']} contacts")
+
+    try:
+        group_name = input("Enter the name of the group you want to list: ")
+    except (KeyboardInterrupt, EOFError):
+        print("\nCancelled group listing.")
+        return
 
-    upcoming_birthdays = []
+    if not find_named(groups, group_name):
+        print(f"No group with the name {group_name} found.")
+        return
 
-    for contact in contacts:
-        birthday_str = contact["other"]["birth_day"]
-        if not birthday_str:
-            continue
+    members = indexed_members(indexes, "group", group_name)
+    members.sort(key=lambda contact: contact.name.lower())
+    print_contact_list(members)
+
+
+@instrumented("menu list_melody_users")
+def list_melody_users(melodies, indexes):
+    if not melodies:
+        print("No melodies available.")
+        return
+
+    print("Available melodies:")
+    for melody in melodies:
+        print(f"{melody['name']}: used by {melody['count']} contact(s)")
+
+    try:
+        melody_name = input("Enter the name of the melody you want to look up: ")
+    except (KeyboardInterrupt, EOFError):
+        print("\nCancelled melody lookup.")
+        return
+
+    if not find_named(melodies, melody_name):
+        print(f"No melody with the name {melody_name} found.")
+        return
+
+    users = indexed_members(indexes, "melody", melody_name)
+    users.sort(key=lambda contact: contact.name.lower())
+    print_contact_list(users)
+
+
+@instrumented("menu move_group_members")
+def move_group_members(contacts, groups, indexes, store):
+    if not groups:
+        print("No groups available.")
+        return contacts, groups
+
+    print("Available groups:")
+    for group in groups:
+        print(f"{group['name']}: {group['count']} contacts")
+
+    try:
+        source = input("Enter the name of the group to move contacts from: ")
+        if not find_named(groups, source):
+            print(f"No group with the name {source} found.")
+            return contacts, groups
 
+        target = input(
+            "Enter the name of the group to move them to "
+            "(or press Enter to remove them from the group): "
+        )
+    except (KeyboardInterrupt, EOFError):
+        print("\nCancelled moving group members.")
+        return contacts, groups
+
+    if target and not find_named(groups, target):
+        print(f"No group with the name {target} found.")
+    elif target == source:
+        print(f"The contacts are already in the group {source}.")
+    else:
+        moved = move_group(contacts, groups, indexes, store, source, target or None)
+        if target:
+            print(f"Moved {moved} contact(s) from {source} to {target}.")
+        else:
+            print(f"Removed {moved} contact(s) from the group {source}.")
+
+    return contacts, groups
+
+
+@instrumented("menu find_duplicates")
+def find_duplicates(contacts, groups, melodies, indexes, store):
+    clusters, skipped = find_duplicate_clusters(contacts)
+    if skipped:
+        print(f"{skipped} very common name(s) were too frequent to compare by name.")
+    if not clusters:
+        print("No duplicate contacts found.")
+        return contacts, groups, melodies
+
+    print(f"Found {len(clusters)} group(s) of possible duplicates:")
+    for number, (cluster, reasons) in enumerate(clusters, start=1):
+        print(f"{number}. {', '.join(reasons)}")
+        for contact in cluster:
+            print(f"   {contact.name} ({contact.mobile_phone})")
+
+    try:
+        choice = input(
+            "Enter the numbers of the groups to merge separated by commas, "
+            "'all' to merge every group, or press Enter to keep them: "
+        ).strip()
+    except (KeyboardInterrupt, EOFError):
+        print("\nCancelled merging duplicates.")
+        return contacts, groups, melodies
+
+    if not choice:
+        return contacts, groups, melodies
+    if choice.lower() == "all":
+        selected = [cluster for cluster, _ in clusters]
+    else:
         try:
-            birthday = datetime.strptime(birthday_str, "%Y-%m-%d")
+            numbers = {int(number) for number in choice.split(",")}
         except ValueError:
-            print(
-                f"Invalid date format for {contact['name']}'s birthday: {birthday_str}"
-            )
-            continue
+            print("Invalid input. Please enter the numbers of the groups.")
+            return contacts, groups, melodies
+        if not all(1 <= number <= len(clusters) for number in numbers):
+            print("Invalid group number.")
+            return contacts, groups, melodies
+        selected = [clusters[number - 1][0] for number in sorted(numbers)]
+
+    removed, dropped_phones = merge_duplicates(
+        contacts, groups, melodies, indexes, store, selected
+    )
+    print(f"Merged {removed} duplicate contact(s).")
+    if dropped_phones:
+        print(f"No free phone slot was left for: {', '.join(dropped_phones)}")
+
+    return contacts, groups, melodies
+
+
+@instrumented("menu manage_birthday_reminders")
+def manage_birthday_reminders(contacts, indexes):
+    try:
+        days = input(
+            f"Enter the number of days to look ahead (default {BIRTHDAY_REMINDER_DAYS}): "
+        )
+        days = int(days) if days else BIRTHDAY_REMINDER_DAYS
+    except ValueError:
+        print("Invalid input. Please enter a valid number.")
+        return
+    except (KeyboardInterrupt, EOFError):
+        print("\nCancelled birthday reminders.")
+        return
 
-        birthday = birthday.replace(year=today.year)
+    if days < 0:
+        print("Invalid input. Please enter a positive number of days.")
+        return
+
+    print_birthdays(upcoming_birthdays(indexes, days), days)
 
-        if today <= birthday <= ten_days_from_today:
-            upcoming_birthdays.append(contact)
 
-    if upcoming_birthdays:
-        print("Upcoming birthdays within 10 days:")
-        for contact in upcoming_birthdays:
-            print(f"{contact['name']} - {contact['other']['birth_day']}")
+def print_birthdays(birthdays, days):
+    if birthdays:
+        print(f"Upcoming birthdays within {days} days:")
+        for contact, name, relation, birthday in birthdays:
+            if relation:
+                print(f"{name} ({contact.name}'s {relation}) - {birthday}")
+            else:
+                print(f"{name} - {birthday}")
     else:
-        print("No upcoming birthdays within 10 days.")
+        print(f"No upcoming birthdays within {days} days.")
 
 
-def print_contact_list(contacts):
+@instrumented("menu print_contact_list")
+def print_contact_list(
+    contacts, title="Contacts summary:", page_size=CONTACT_PAGE_SIZE
+):
     if not contacts:
         print("No contacts available.")
         return
 
-    print("\nContacts summary:")
-    print(
-        "{:<20} {:<15} {:<20} {:<20}".format("Name", "Mobile Number", "Group", "Melody")
+    # Only the visible page is formatted, and it goes out in a single write, so
+    # showing a page costs the same however large the book is.
+    page_count = (len(contacts) + page_size - 1) // page_size
+    page = 0
+    while True:
+        start = page * page_size
+        lines = [
+            f"\n{title}\n",
+            CONTACT_LIST_FORMAT.format("Name", "Mobile Number", "Group", "Melody"),
+            format_contact_rows(contacts[start : start + page_size]),
+        ]
+        if page_count > 1:
+            lines.append(
+                f"Page {page + 1} of {page_count} ({len(contacts)} contacts)\n"
+            )
+        sys.stdout.write("".join(lines))
+        if page_count == 1:
+            return
+
+        try:
+            choice = input(
+                "Enter n for the next page, p for the previous page, a page number, "
+                "s and a column (name, phone, group or melody) to sort, "
+                "or press Enter to return: "
+            )
+        except (KeyboardInterrupt, EOFError):
+            print("\nStopped listing contacts.")
+            return
+
+        command = choice.lower().split()
+        if not command:
+            return
+        elif command == ["n"]:
+            if page + 1 < page_count:
+                page += 1
+            else:
+                print("This is the last page.")
+        elif command == ["p"]:
+            if page > 0:
+                page -= 1
+            else:
+                print("This is the first page.")
+        elif len(command) == 1 and command[0].isdigit():
+            if 1 <= int(command[0]) <= page_count:
+                page = int(command[0]) - 1
+            else:
+                print(f"Please enter a page number between 1 and {page_count}.")
+        elif len(command) == 2 and command[0] == "s":
+            if command[1] in CONTACT_SORT_COLUMNS:
+                contacts = sort_contacts(contacts, command[1])
+                page = 0
+            else:
+                print("You can sort by name, phone, group or melody.")
+        else:
+            print("Invalid input.")
+
+
+def print_contact_rows(
+    contacts, title="Contacts summary:", empty_message="No contacts available."
+):
+    # Prints the contacts as they are read, a chunk at a time, so a book of
+    # any size is listed in constant memory.
+    contacts = iter(contacts)
+    chunk = list(itertools.islice(contacts, LIST_CHUNK_SIZE))
+    if not chunk:
+        print(empty_message)
+        return
+
+    sys.stdout.write(
+        f"\n{title}\n"
+        + CONTACT_LIST_FORMAT.format("Name", "Mobile Number", "Group", "Melody")
     )
+    while chunk:
+        sys.stdout.write(format_contact_rows(chunk))
+        chunk = list(itertools.islice(contacts, LIST_CHUNK_SIZE))
 
-    for contact in contacts:
-        name = contact["name"]
-        mobile_number = contact["mobile_phone"]
-        group = contact["group"] if contact["group"] else "-"
-        melody = contact["melody"] if contact["melody"] else "-"
 
-        print("{:<20} {:<15} {:<20} {:<20}".format(name, mobile_number, group, melody))
+CONTACT_LIST_FORMAT = "{:<20} {:<15} {:<20} {:<20}\n"
+CONTACT_SORT_COLUMNS = {
+    "name": "name",
+    "phone": "mobile_phone",
+    "group": "group",
+    "melody": "melody",
+}
+
+
+def format_contact_rows(contacts):
+    return "".join(
+        CONTACT_LIST_FORMAT.format(
+            contact.name,
+            contact.mobile_phone,
+            contact.group if contact.group else "-",
+            contact.melody if contact.melody else "-",
+        )
+        for contact in contacts
+    )
+
 
+def sort_contacts(contacts, column):
+    value = operator.attrgetter(CONTACT_SORT_COLUMNS[column])
+    return sorted(contacts, key=lambda contact: (value(contact) or "").lower())
 
-def print_contact_details(contacts):
+
+def print_numbered(labels):
+    sys.stdout.write(
+        "".join(f"{number}. {label}\n" for number, label in enumerate(labels, start=1))
+    )
+
+
+@instrumented("menu print_contact_details")
+def print_contact_details(contacts, indexes):
     if not contacts:
         print("No contacts available.")
         return
 
-    for index, contact in enumerate(contacts):
-        print(f"{index + 1}. {contact['name']} ({contact['mobile_phone']})")
-
     try:
-        contact_number = int(input("Enter the contact number: ")) - 1
-        if contact_number < 0 or contact_number >= len(contacts):
-            print("Invalid contact number.")
+        selected_contact = select_contact(indexes, "show")
+        if selected_contact is None:
             return
 
-        selected_contact = contacts[contact_number]
-        print("\nContact details:")
+        print_details(selected_contact)
 
-        selected_contact = contacts[contact_number]
-        print("\nContact details:")
+    except (ValueError, KeyboardInterrupt, EOFError):
+        print("\nInvalid input or action canceled.")
 
-        print(f"Name: {selected_contact['name']}")
-        print(f"Mobile phone: {selected_contact['mobile_phone']}")
 
-        print(
-            f"Group: {selected_contact['group'] if selected_contact['group'] else '-'}"
+def print_details(contact):
+    print("\nContact details:")
+
+    print(f"Name: {contact.name}")
+    print(f"Mobile phone: {contact.mobile_phone}")
+
+    print(f"Group: {contact.group if contact.group else '-'}")
+    print(f"Melody: {contact.melody if contact.melody else '-'}")
+
+    for key, value in contact.items():
+        if key in ["name", "mobile_phone", "group", "melody"]:
+            continue
+
+        if isinstance(value, Record):
+            for sub_key, sub_value in value.items():
+                label = f"{key.capitalize()} {sub_key.capitalize()}:"
+                print(f"{label} {sub_value if sub_value else '-'}")
+        else:
+            print(f"{key.capitalize()}: {value if value else '-'}")
+
+
+def contact_from_command(data):
+    return create_contact(
+        data["name"],
+        data["mobile_phone"],
+        group=data.get("group"),
+        company=data.get("company", {}),
+        other_phones=data.get("other_phones", {}),
+        emails=data.get("emails", {}),
+        melody=data.get("melody", "default"),
+        other=data.get("other", {}),
+    )
+
+
+def batch_find_contact(book, phone):
+    contact = find_contact_by_phone(book["indexes"], phone)
+    if contact is None:
+        raise ValueError(f"No contact found with the mobile phone {phone}.")
+    return contact
+
+
+def batch_contact_index(book, contact):
+    return book["indexes"]["positions"].find(book["contacts"], contact)
+
+
+def batch_check_references(book, contact, owner=None):
+    conflict = phone_conflict(book["indexes"], contact, owner)
+    if conflict:
+        phone, existing_contact = conflict
+        raise ValueError(
+            f"The phone number {phone} is already used by {existing_contact.name}."
         )
-        print(
-            f"Melody: {selected_contact['melody'] if selected_contact['melody'] else '-'}"
+    check_references(book["groups"], book["melodies"], contact)
+
+
+def check_references(groups, melodies, contact):
+    if contact.group and not find_named(groups, contact.group):
+        raise ValueError(f"No group with the name {contact.group} found.")
+    if contact.melody != "default" and not find_named(melodies, contact.melody):
+        raise ValueError(f"No melody with the name {contact.melody} found.")
+
+
+def batch_add_contact(book, command):
+    contact = contact_from_command(command["contact"])
+    batch_check_references(book, contact)
+    insert_contact(
+        book["contacts"],
+        book["groups"],
+        book["melodies"],
+        book["indexes"],
+        book["store"],
+        contact,
+    )
+    return {"contact": contact.to_dict()}
+
+
+def batch_update_contact(book, command):
+    old_contact = batch_find_contact(book, command["mobile_phone"])
+    contact = contact_from_command(command["contact"])
+    batch_check_references(book, contact, old_contact)
+    replace_contact(
+        book["contacts"],
+        book["groups"],
+        book["melodies"],
+        book["indexes"],
+        book["store"],
+        batch_contact_index(book, old_contact),
+        contact,
+    )
+    return {"contact": contact.to_dict()}
+
+
+def batch_delete_contact(book, command):
+    contact = batch_find_contact(book, command["mobile_phone"])
+    remove_contact(
+        book["contacts"],
+        book["groups"],
+        book["melodies"],
+        book["indexes"],
+        book["store"],
+        batch_contact_index(book, contact),
+    )
+    return {}
+
+
+def batch_set_group(book, command):
+    contact = batch_find_contact(book, command["mobile_phone"])
+    group_name = command.get("group")
+    if group_name and not find_named(book["groups"], group_name):
+        raise ValueError(f"No group with the name {group_name} found.")
+
+    if contact.group != group_name:
+        set_contact_group(
+            book["contacts"],
+            book["groups"],
+            book["indexes"],
+            book["store"],
+            contact,
+            group_name,
+        )
+    return {"contact": contact.to_dict()}
+
+
+def batch_members(items, kind):
+    def handler(book, command):
+        name = command[kind]
+        if not find_named(book[items], name):
+            raise ValueError(f"No {kind} with the name {name} found.")
+
+        members = indexed_members(book["indexes"], COUNTED_INDEXES[items], name)
+        members.sort(key=lambda contact: contact.name.lower())
+        return {
+            "contacts": [
+                {"name": contact.name, "mobile_phone": contact.mobile_phone}
+                for contact in members
+            ]
+        }
+
+    return handler
+
+
+def batch_move_group(book, command):
+    source = command["from"]
+    target = command.get("to")
+    for group_name in (source, target):
+        if group_name and not find_named(book["groups"], group_name):
+            raise ValueError(f"No group with the name {group_name} found.")
+
+    moved = move_group(
+        book["contacts"],
+        book["groups"],
+        book["indexes"],
+        book["store"],
+        source,
+        target or None,
+    )
+    return {"moved": moved}
+
+
+def batch_find_duplicates(book, command):
+    clusters, skipped = find_duplicate_clusters(book["contacts"])
+    result = {
+        "clusters": [
+            {
+                "reasons": reasons,
+                "contacts": [
+                    {"name": contact.name, "mobile_phone": contact.mobile_phone}
+                    for contact in cluster
+                ],
+            }
+            for cluster, reasons in clusters
+        ],
+        "skipped_blocks": skipped,
+    }
+    if command.get("merge"):
+        result["merged"], result["dropped_phones"] = merge_duplicates(
+            book["contacts"],
+            book["groups"],
+            book["melodies"],
+            book["indexes"],
+            book["store"],
+            [cluster for cluster, _ in clusters],
+        )
+    return result
+
+
+def batch_add_named(items):
+    def handler(book, command):
+        name = command["name"]
+        if not name:
+            raise ValueError("A name is required.")
+        if find_named(book[items], name):
+            raise ValueError(f"'{name}' already exists.")
+        book[items].append({"name": name, "count": 0})
+        book["store"].mark_dirty(items)
+        return {}
+
+    return handler
+
+
+def batch_delete_named(items):
+    def handler(book, command):
+        item = find_named(book[items], command["name"])
+        if not item:
+            raise ValueError(f"No entry with the name {command['name']} found.")
+        if item["count"] != 0:
+            raise ValueError(
+                f"Cannot delete '{item['name']}'. {item['count']} contact(s) are using it."
+            )
+        book[items].remove(item)
+        book["store"].mark_dirty(items)
+        return {}
+
+    return handler
+
+
+def batch_search(book, command):
+    matching_contacts = find_contacts(book["indexes"], command["query"])
+    return {
+        "contacts": [
+            {"name": contact.name, "mobile_phone": contact.mobile_phone}
+            for contact in matching_contacts
+        ]
+    }
+
+
+def batch_fuzzy_search(book, command):
+    max_distance = int(command.get("max_distance", FUZZY_SEARCH_DISTANCE))
+    return {
+        "contacts": [
+            {
+                "name": contact.name,
+                "mobile_phone": contact.mobile_phone,
+                "distance": distance,
+            }
+            for contact, distance in fuzzy_find_contacts(
+                book["indexes"], command["query"], max_distance
+            )
+        ]
+    }
+
+
+def batch_complete(book, command):
+    limit = int(command.get("limit", AUTOCOMPLETE_LIMIT))
+    return {
+        "contacts": [
+            {"name": contact.name, "mobile_phone": contact.mobile_phone}
+            for contact in complete_contacts(book["indexes"], command["prefix"], limit)
+        ]
+    }
+
+
+def batch_reminders(book, command):
+    days = int(command.get("days", BIRTHDAY_REMINDER_DAYS))
+    return {
+        "birthdays": [
+            {
+                "name": name,
+                "contact": contact.name,
+                "relation": relation,
+                "birthday": birthday,
+            }
+            for contact, name, relation, birthday in upcoming_birthdays(
+                book["indexes"], days
+            )
+        ]
+    }
+
+
+BATCH_COMMANDS = {
+    "add_contact": batch_add_contact,
+    "update_contact": batch_update_contact,
+    "delete_contact": batch_delete_contact,
+    "set_group": batch_set_group,
+    "group_members": batch_members("groups", "group"),
+    "melody_members": batch_members("melodies", "melody"),
+    "move_group": batch_move_group,
+    "find_duplicates": batch_find_duplicates,
+    "add_group": batch_add_named("groups"),
+    "delete_group": batch_delete_named("groups"),
+    "add_melody": batch_add_named("melodies"),
+    "delete_melody": batch_delete_named("melodies"),
+    "search": batch_search,
+    "complete": batch_complete,
+    "fuzzy_search": batch_fuzzy_search,
+    "reminders": batch_reminders,
+}
+
+
+def open_book(store):
+    contacts = store.load_contacts()
+    book = {
+        "contacts": contacts,
+        "groups": store.load_groups(),
+        "melodies": store.load_melodies(),
+        "indexes": build_indexes(contacts),
+        "store": store,
+    }
+    store.index_unloaded(book["indexes"])
+    for items_name in COUNTED_INDEXES:
+        update_counts(
+            book[items_name],
+            book["indexes"],
+            store,
+            items_name,
+            *find_names(book[items_name]),
         )
+    return book
+
+
+def run_batch(store, lines, flush_every=BATCH_FLUSH_EVERY):
+    book = open_book(store)
+    contacts = book["contacts"]
 
-        for key, value in selected_contact.items():
-            if key in ["name", "mobile_phone", "group", "melody"]:
+    processed = 0
+    start = time.perf_counter()
+    try:
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
                 continue
 
-            if isinstance(value, dict):
-                for sub_key, sub_value in value.items():
-                    label = f"{key.capitalize()} {sub_key.capitalize()}:"
-                    print(f"{label} {sub_value if sub_value else '-'}")
-            else:
-                print(f"{key.capitalize()}: {value if value else '-'}")
+            try:
+                store.refresh(
+                    contacts, book["groups"], book["melodies"], book["indexes"]
+                )
+                command = json.loads(line)
+                handler = BATCH_COMMANDS.get(command.get("command"))
+                if handler is None:
+                    raise ValueError(f"Unknown command: {command.get('command')}")
+                result = {"line": line_number, "ok": True}
+                with measure(f"batch {command['command']}"):
+                    result.update(handler(book, command))
+            except KeyError as e:
+                result = {"line": line_number, "ok": False, "error": f"Missing {e}"}
+            except (AttributeError, TypeError, ValueError) as e:
+                result = {"line": line_number, "ok": False, "error": str(e)}
+            print(json.dumps(result))
+
+            processed += 1
+            if instrumentation is not None:
+                instrumentation.action_finished()
+            if processed % flush_every == 0:
+                store.save_changes(
+                    contacts, book["groups"], book["melodies"], book["indexes"]
+                )
+    finally:
+        store.save_changes(contacts, book["groups"], book["melodies"], book["indexes"])
+
+    elapsed = time.perf_counter() - start
+    rate = processed / elapsed if elapsed else 0
+    print(
+        f"Processed {processed} commands in {elapsed:.3f}s ({rate:.0f} commands/s)",
+        file=sys.stderr,
+    )
+    return processed, elapsed
+
+
+def add_store_arguments(parser):
+    parser.add_argument(
+        "--contacts",
+        metavar="FILE",
+        default="contacts.csv",
+        help="contacts file of the CSV store; a .bin file is kept in the binary "
+        "snapshot format (default %(default)s)",
+    )
+    parser.add_argument(
+        "--sqlite",
+        metavar="DATABASE",
+        help="keep the contact book in a SQLite database instead of CSV files",
+    )
+    parser.add_argument(
+        "--shards",
+        metavar="DIRECTORY",
+        help="keep the contacts split over several CSV files in DIRECTORY",
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=("hash", "group"),
+        default="hash",
+        help="split a new sharded book by a hash of the mobile phone or by group "
+        "(default %(default)s)",
+    )
+    parser.add_argument(
+        "--only-group",
+        metavar="NAME",
+        action="append",
+        help="load only the contacts of this group from a book sharded by group "
+        "(can be repeated)",
+    )
 
-    except (ValueError, KeyboardInterrupt, EOFError):
-        print("\nInvalid input or action canceled.")
+
+def open_store(args):
+    if args.sqlite:
+        return SQLiteStore(args.sqlite)
+    if args.shards:
+        return ShardedStore(args.shards, args.shard_by, only_groups=args.only_group)
+    return CSVStore(args.contacts)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Contact Book Manager")
+    add_store_arguments(parser)
+    parser.add_argument(
+        "--import-csv",
+        action="store_true",
+        help="copy contacts.csv, groups.txt and melodies.txt into the store first",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="print the contacts summary and exit, reading the contacts one at a "
+        "time instead of loading the book",
+    )
+    parser.add_argument(
+        "--search",
+        metavar="QUERY",
+        help="print the contacts matching QUERY and exit, in book order and "
+        "without loading the book",
+    )
+    parser.add_argument(
+        "--members",
+        metavar="GROUP",
+        help="print the contacts in GROUP and exit; the SQLite store looks them "
+        "up without loading the book",
+    )
+    parser.add_argument(
+        "--birthdays",
+        metavar="DAYS",
+        type=int,
+        nargs="?",
+        const=BIRTHDAY_REMINDER_DAYS,
+        help="print the birthdays in the next DAYS days (default "
+        f"{BIRTHDAY_REMINDER_DAYS}) and exit; the SQLite store looks them up "
+        "without loading the book",
+    )
+    parser.add_argument(
+        "--convert",
+        nargs=2,
+        metavar=("SOURCE", "TARGET"),
+        help="write the contacts of SOURCE to TARGET and exit; a .bin TARGET gets "
+        "the binary snapshot format, anything else CSV",
+    )
+    parser.add_argument(
+        "--show",
+        metavar="PHONE",
+        help="print the details of the contact with this phone and exit; the "
+        "SQLite store looks it up without loading the book, a CSV store reads "
+        "just that contact through the offset index",
+    )
+    parser.add_argument(
+        "--update",
+        nargs=2,
+        metavar=("PHONE", "JSON"),
+        help="replace the contact with this mobile phone by the JSON contact, as "
+        "the update_contact batch command does, and exit",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="run the JSON-lines commands in FILE ('-' for stdin) instead of the menu",
+    )
+    parser.add_argument(
+        "--flush-every",
+        metavar="N",
+        type=int,
+        default=BATCH_FLUSH_EVERY,
+        help="persist batch changes every N commands (default %(default)s)",
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="FILE",
+        help="time menu actions and file access and write the counters to FILE "
+        "as JSON on exit",
+    )
+    parser.add_argument(
+        "--stats-every",
+        metavar="N",
+        type=int,
+        default=0,
+        help="print a summary of the counters to stderr every N actions",
+    )
+    parser.add_argument(
+        "--stats-memory",
+        action="store_true",
+        help="also record the peak Python memory of each operation "
+        "(noticeably slower)",
+    )
+    args = parser.parse_args()
+
+    if args.stats or args.stats_every or args.stats_memory:
+        enable_instrumentation(args.stats_memory, args.stats_every)
+    if args.convert:
+        convert_contacts(*args.convert)
+        sys.exit()
+
+    try:
+        store = open_store(args)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        if args.import_csv:
+            source = CSVStore()
+            store.save_all(
+                source.load_contacts(), source.load_groups(), source.load_melodies()
+            )
+        if args.list:
+            print_contact_rows(store.iter_contacts(CONTACT_LIST_FIELDS))
+        elif args.search is not None:
+            fields = CONTACT_SEARCH_FIELDS + ("group", "melody")
+            query = search_query(args.search)
+            print_contact_rows(
+                (
+                    filter_contacts(store.iter_contacts(fields), query)
+                    if query is not None
+                    else ()
+                ),
+                "Matching contacts:",
+                "No contacts found matching your search query.",
+            )
+        elif args.members is not None:
+            if not any(group["name"] == args.members for group in store.load_groups()):
+                print(f"No group with the name {args.members} found.")
+            else:
+                members = store.group_members(args.members)
+                members.sort(key=lambda contact: contact.name.lower())
+                print_contact_rows(
+                    members,
+                    f"Contacts in {args.members}:",
+                    "No contacts in this group.",
+                )
+        elif args.birthdays is not None:
+            print_birthdays(store.birthdays_within(args.birthdays), args.birthdays)
+        elif args.show:
+            contact = store.find_contact(args.show)
+            if contact is None:
+                print(f"No contact found with the phone {args.show}.")
+            else:
+                print_details(contact)
+        elif args.update:
+            phone, data = args.update
+            try:
+                print_details(store.update_contact(phone, json.loads(data)))
+            except KeyError as e:
+                print(f"Error: Missing {e}")
+            except (AttributeError, TypeError, ValueError) as e:
+                print(f"Error: {e}")
+        elif args.batch == "-":
+            run_batch(store, sys.stdin, args.flush_every)
+        elif args.batch:
+            with open(args.batch, mode="r", encoding="utf-8") as batch_file:
+                run_batch(store, batch_file, args.flush_every)
+        else:
+            main(store)
+    except OSError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        store.close()
+        if instrumentation is not None:
+            if args.stats:
+                instrumentation.dump(args.stats)
+            else:
+                instrumentation.print_summary()
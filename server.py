@@ -0,0 +1,444 @@
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import signal
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import manager
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+WRITE_BATCH_SIZE = 256
+LIST_LIMIT = 100
+MAX_LIST_LIMIT = 1000
+MAX_BODY_BYTES = 1024 * 1024
+
+STATUS_REASONS = {
+    200: "OK",
+    201: "Created",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def sorted_contacts(book, column):
+    # Sorted views are kept until the next write, so paging through a sorted
+    # list does not sort the whole book for every page.
+    cached = book["sorted"].get(column)
+    if cached is None or cached[0] != book["generation"]:
+        cached = (book["generation"], manager.sort_contacts(book["contacts"], column))
+        book["sorted"][column] = cached
+    return cached[1]
+
+
+def page_bounds(command):
+    offset = int(command.get("offset", 0))
+    limit = min(int(command.get("limit", LIST_LIMIT)), MAX_LIST_LIMIT)
+    if offset < 0 or limit < 0:
+        raise ValueError("offset and limit must not be negative.")
+    return offset, limit
+
+
+def list_contacts(book, command):
+    offset, limit = page_bounds(command)
+    column = command.get("sort")
+    if column is None:
+        contacts = book["contacts"]
+    elif column in manager.CONTACT_SORT_COLUMNS:
+        contacts = sorted_contacts(book, column)
+    else:
+        raise ValueError(f"Cannot sort contacts by {column}.")
+
+    return {
+        "total": len(contacts),
+        "offset": offset,
+        "contacts": [
+            {
+                "name": contact.name,
+                "mobile_phone": contact.mobile_phone,
+                "group": contact.group,
+                "melody": contact.melody,
+            }
+            for contact in contacts[offset : offset + limit]
+        ],
+    }
+
+
+def search_contacts(book, command):
+    offset, limit = page_bounds(command)
+    matching_contacts = manager.find_contacts(book["indexes"], command["query"])
+    return {
+        "total": len(matching_contacts),
+        "offset": offset,
+        "contacts": [
+            {"name": contact.name, "mobile_phone": contact.mobile_phone}
+            for contact in matching_contacts[offset : offset + limit]
+        ],
+    }
+
+
+def get_contact(book, command):
+    contact = manager.find_contact_by_phone(book["indexes"], command["mobile_phone"])
+    if contact is None:
+        raise HTTPError(
+            404, f"No contact found with the mobile phone {command['mobile_phone']}."
+        )
+    return {"contact": contact.to_dict()}
+
+
+def list_named(items):
+    def handler(book, command):
+        return {items: book[items]}
+
+    return handler
+
+
+def existing_contact(handler):
+    def checked_handler(book, command):
+        get_contact(book, command)
+        return handler(book, command)
+
+    return checked_handler
+
+
+def existing_named(items, kind):
+    def checked_handler(book, command):
+        if not manager.find_named(book[items], command["name"]):
+            raise HTTPError(404, f"No {kind} with the name {command['name']} found.")
+        return manager.BATCH_COMMANDS[f"delete_{kind}"](book, command)
+
+    return checked_handler
+
+
+def read_body(body):
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        raise HTTPError(400, "The request body is not valid JSON.")
+    if not isinstance(data, dict):
+        raise HTTPError(400, "The request body must be a JSON object.")
+    return data
+
+
+def route(method, parts, params, body):
+    # Returns the handler, the batch-style command for it and whether it
+    # changes the book; handlers share the signature of BATCH_COMMANDS.
+    commands = manager.BATCH_COMMANDS
+    if parts == ["contacts"]:
+        if method == "GET":
+            return list_contacts, params, False
+        if method == "POST":
+            return commands["add_contact"], {"contact": read_body(body)}, True
+    elif parts == ["contacts", "search"] and method == "GET":
+        return search_contacts, {"query": params.get("q", ""), **params}, False
+    elif parts == ["contacts", "complete"] and method == "GET":
+        return (
+            commands["complete"],
+            {"prefix": params.get("prefix", ""), **params},
+            False,
+        )
+    elif parts == ["contacts", "fuzzy"] and method == "GET":
+        return commands["fuzzy_search"], {"query": params.get("q", ""), **params}, False
+    elif len(parts) == 2 and parts[0] == "contacts":
+        command = {"mobile_phone": parts[1]}
+        if method == "GET":
+            return get_contact, command, False
+        if method == "PUT":
+            command["contact"] = read_body(body)
+            return existing_contact(commands["update_contact"]), command, True
+        if method == "DELETE":
+            return existing_contact(commands["delete_contact"]), command, True
+    elif len(parts) == 3 and parts[0] == "contacts" and parts[2] == "group":
+        if method == "PUT":
+            command = {"mobile_phone": parts[1], "group": read_body(body).get("group")}
+            return existing_contact(commands["set_group"]), command, True
+    elif parts[:1] in (["groups"], ["melodies"]):
+        items = parts[0]
+        kind = manager.COUNTED_INDEXES[items]
+        if len(parts) == 1:
+            if method == "GET":
+                return list_named(items), {}, False
+            if method == "POST":
+                name = read_body(body).get("name", "")
+                return commands[f"add_{kind}"], {"name": name}, True
+        elif len(parts) == 2 and method == "DELETE":
+            return existing_named(items, kind), {"name": parts[1]}, True
+        elif len(parts) == 3 and parts[2] == "contacts" and method == "GET":
+            return commands[f"{kind}_members"], {kind: parts[1]}, False
+    elif parts == ["birthdays"] and method == "GET":
+        return commands["reminders"], params, False
+    else:
+        raise HTTPError(404, "Not found.")
+    raise HTTPError(405, f"{method} is not supported here.")
+
+
+def run_handler(handler, book, command):
+    try:
+        return handler(book, command)
+    except KeyError as e:
+        raise HTTPError(400, f"Missing {e}")
+    except (AttributeError, TypeError, ValueError) as e:
+        raise HTTPError(400, str(e))
+
+
+async def refresh_book(book, run=asyncio.to_thread, wait=False):
+    # Comparing the file stamps costs a few stat calls, so it happens on the
+    # event loop; reading in what other processes saved happens on a thread.
+    # The caller holds the book's lock, so no request sees the book half
+    # changed; requests only wait while there is something to read in.
+    store = book["store"]
+    if store.changed() and await run(
+        store.refresh,
+        book["contacts"],
+        book["groups"],
+        book["melodies"],
+        book["indexes"],
+        wait,
+    ):
+        book["generation"] += 1
+
+
+def reopen_book(store):
+    store.discard_changes()
+    return manager.open_book(store)
+
+
+def apply_batch(book, batch):
+    outcomes = []
+    for handler, command, future in batch:
+        try:
+            outcomes.append((future, run_handler(handler, book, command), None))
+        except HTTPError as e:
+            outcomes.append((future, None, e))
+        except Exception as e:
+            outcomes.append((future, None, HTTPError(500, str(e))))
+    return outcomes
+
+
+async def write_batch(book, batch, run):
+    async with book["lock"]:
+        await refresh_book(book, run, wait=True)
+        book["generation"] += 1
+        # The writes may read the store too, such as checking a new phone
+        # against shards that are not loaded, so they run where the store's
+        # lock is held.
+        outcomes = await run(apply_batch, book, batch)
+        # Shards the writes added contacts to without loading them are read
+        # in and indexed now, while reads wait, instead of during the save.
+        await refresh_book(book, run, wait=True)
+
+    # Reads go on while the batch is saved. The store's lock has been held
+    # since the refresh, so the save has nothing more to merge in.
+    store = book["store"]
+    with manager.measure("http write batch"):
+        await run(
+            store.save_changes,
+            book["contacts"],
+            book["groups"],
+            book["melodies"],
+            book["indexes"],
+        )
+    return outcomes
+
+
+async def run_writer(book, queue, batch_size=WRITE_BATCH_SIZE):
+    # The only task that changes the book. It applies whatever writes are
+    # queued, up to batch_size, persists them together and only then answers
+    # the requests, so a reply to a write means the change is on disk. The
+    # store's lock is held from the refresh before the writes to the save
+    # after them. Taking it, the writes and the disk work run on one thread
+    # of their own, since the lock belongs to the thread that took it. A None in the
+    # queue stops the writer once the writes before it are saved.
+    store = book["store"]
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+
+        def run(function, *args):
+            return loop.run_in_executor(executor, function, *args)
+
+        stopping = False
+        while not stopping:
+            batch = [await queue.get()]
+            while len(batch) < batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            stopping = None in batch
+            batch = [write for write in batch if write is not None]
+            if not batch:
+                continue
+
+            lock = contextlib.ExitStack()
+            try:
+                await run(lock.enter_context, store.locked())
+                outcomes = await write_batch(book, batch, run)
+            except Exception as e:
+                # The book may hold changes that are not on disk. They are
+                # dropped and the book is read again, so it matches what the
+                # failed requests are told.
+                error = HTTPError(500, f"Could not save the contact book: {e}")
+                outcomes = [(future, None, error) for _, _, future in batch]
+                try:
+                    book.update(await run(reopen_book, store))
+                except Exception as e:
+                    print(f"Could not reload the contact book: {e}")
+                book["generation"] += 1
+            finally:
+                await run(lock.close)
+
+            for future, result, error in outcomes:
+                if future.cancelled():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+
+async def handle_request(book, queue, method, target, body):
+    url = urlsplit(target)
+    params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+    parts = [unquote(part) for part in url.path.split("/") if part]
+    try:
+        handler, command, writes = route(method, parts, params, body)
+        if not writes:
+            # Reads run on the event loop; they never wait for queued writes
+            # or for a batch to be saved. Changes saved by other processes are
+            # picked up first, unless another process or the writer holds the
+            # store's lock; then the read answers from the book as it is.
+            async with book["lock"]:
+                await refresh_book(book)
+                return 200, run_handler(handler, book, command)
+
+        future = asyncio.get_running_loop().create_future()
+        await queue.put((handler, command, future))
+        result = await future
+        return (201 if method == "POST" else 200), result
+    except HTTPError as e:
+        return e.status, {"error": str(e)}
+    except Exception as e:
+        return 500, {"error": str(e)}
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, version = request_line.decode("latin-1").split()
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+
+async def handle_connection(book, queue, reader, writer):
+    try:
+        while True:
+            request = await read_request(reader)
+            if request is None:
+                break
+            method, target, version, headers = request
+
+            length = int(headers.get("content-length", 0))
+            if length > MAX_BODY_BYTES:
+                status, payload = 413, {"error": "The request body is too large."}
+                keep_alive = False
+            else:
+                body = await reader.readexactly(length) if length else b""
+                status, payload = await handle_request(
+                    book, queue, method, target, body
+                )
+                keep_alive = (
+                    version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+
+            data = json.dumps(payload).encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status} {STATUS_REASONS[status]}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                f"\r\n".encode("latin-1") + data
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(
+    store, host=DEFAULT_HOST, port=DEFAULT_PORT, batch_size=WRITE_BATCH_SIZE
+):
+    book = manager.open_book(store)
+    book["generation"] = 0
+    book["sorted"] = {}
+    # Held while the book changes: by a refresh and by the writes of a batch.
+    book["lock"] = asyncio.Lock()
+    queue = asyncio.Queue()
+    writer_task = asyncio.create_task(run_writer(book, queue, batch_size))
+
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(book, queue, reader, writer),
+        host,
+        port,
+    )
+    stopped = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        # Event loops on Windows have no signal handlers; Ctrl+C still stops
+        # the server there through KeyboardInterrupt.
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(signal_number, stopped.set)
+
+    print(f"Serving {len(book['contacts'])} contacts on http://{host}:{port}")
+    try:
+        async with server:
+            await stopped.wait()
+    finally:
+        await queue.put(None)
+        await writer_task
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Contact Book JSON API server")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="address to listen on")
+    parser.add_argument(
+        "--port", type=int, default=DEFAULT_PORT, help="port to listen on"
+    )
+    manager.add_store_arguments(parser)
+    parser.add_argument(
+        "--write-batch",
+        metavar="N",
+        type=int,
+        default=WRITE_BATCH_SIZE,
+        help="persist at most N queued writes together (default %(default)s)",
+    )
+    args = parser.parse_args()
+
+    try:
+        store = manager.open_store(args)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        asyncio.run(serve(store, args.host, args.port, args.write_batch))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manager  # noqa: E402
+
+
+def make_contact(number, group="", mobile_phone=None, home_phone=None):
+    return manager.Contact(
+        name=f"Contact {number}",
+        mobile_phone=mobile_phone or f"555{number:07d}",
+        group=group,
+        other_phones=manager.OtherPhones(home_phone=home_phone),
+        melody="",
+    )
+
+
+def flat(contacts):
+    # A CSV file reads an unset field back as an empty one.
+    return [
+        {
+            field: value or ""
+            for field, value in manager.flatten_contact(contact).items()
+        }
+        for contact in contacts
+    ]
+
+
+@pytest.fixture
+def book_files(tmp_path):
+    # A CSV book of 20 contacts in two groups, with its groups and melodies.
+    contacts = [
+        make_contact(number, group="Work" if number % 2 else "Gym")
+        for number in range(20)
+    ]
+    contacts_filename = str(tmp_path / "contacts.csv")
+    groups_filename = str(tmp_path / "groups.txt")
+    melodies_filename = str(tmp_path / "melodies.txt")
+    assert manager.write_contacts_to_csv(contacts, contacts_filename)
+    groups = [{"name": "Work", "count": 10}, {"name": "Gym", "count": 10}]
+    assert manager.write_to_file(groups, groups_filename)
+    assert manager.write_to_file([], melodies_filename)
+    return contacts_filename, groups_filename, melodies_filename
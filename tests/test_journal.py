@@ -0,0 +1,191 @@
+import os
+import random
+
+import manager
+from conftest import flat, make_contact
+
+
+def replay(contacts, records):
+    # The book a list of records leaves, applied one by one to a list.
+    contacts = list(contacts)
+    for record in records:
+        manager.apply_journal_record(contacts, record)
+    return contacts
+
+
+def update_record(contacts, position, contact):
+    return {
+        "op": "update",
+        "index": position,
+        "mobile_phone": contacts[position].mobile_phone,
+        "contact": manager.flatten_contact(contact),
+    }
+
+
+def test_journal_replays_every_kind_of_record(book_files):
+    contacts_filename, _, _ = book_files
+    contacts = manager.read_contacts_from_csv(contacts_filename)
+    records = [
+        {"op": "add", "contact": manager.flatten_contact(make_contact(100))},
+        update_record(contacts, 3, make_contact(101, group="Work")),
+        {"op": "delete", "index": 5, "mobile_phone": contacts[5].mobile_phone},
+        {"op": "group", "mobile_phone": contacts[7].mobile_phone, "group": "Gym"},
+        {"op": "move_group", "from": "Work", "to": "Office"},
+    ]
+    assert manager.log_contact_changes(contacts, records, contacts_filename)
+
+    expected = replay(contacts, records)
+    assert flat(manager.read_contacts_from_csv(contacts_filename)) == flat(expected)
+    assert expected[-1].name == "Contact 100"
+    assert all(contact.group != "Work" for contact in expected)
+
+
+def test_incomplete_last_record_is_ignored(book_files):
+    contacts_filename, _, _ = book_files
+    contacts = manager.read_contacts_from_csv(contacts_filename)
+    records = [{"op": "add", "contact": manager.flatten_contact(make_contact(100))}]
+    assert manager.log_contact_changes(contacts, records, contacts_filename)
+    # A crash in the middle of an append leaves half a record behind.
+    with open(manager.journal_filename(contacts_filename), mode="a") as file:
+        file.write('{"op": "add", "contact": {"na')
+
+    loaded = manager.read_contacts_from_csv(contacts_filename)
+    assert flat(loaded) == flat(replay(contacts, records))
+    streamed = manager.iter_contacts_from_csv(contacts_filename)
+    assert flat(streamed) == flat(loaded)
+
+
+def test_replay_stops_at_a_damaged_record(book_files, capsys):
+    contacts_filename, _, _ = book_files
+    contacts = manager.read_contacts_from_csv(contacts_filename)
+    records = [{"op": "add", "contact": manager.flatten_contact(make_contact(100))}]
+    assert manager.log_contact_changes(contacts, records, contacts_filename)
+    with open(manager.journal_filename(contacts_filename), mode="a") as file:
+        file.write('{"op": "add", "contact": {"na\n')
+    later = [{"op": "add", "contact": manager.flatten_contact(make_contact(101))}]
+    assert manager.log_contact_changes(contacts, later, contacts_filename)
+
+    loaded = manager.read_contacts_from_csv(contacts_filename)
+    assert flat(loaded) == flat(replay(contacts, records))
+    assert "Ignoring incomplete journal entry at line 3." in capsys.readouterr().out
+
+
+def test_journal_of_an_older_snapshot_is_not_replayed(book_files):
+    contacts_filename, _, _ = book_files
+    contacts = manager.read_contacts_from_csv(contacts_filename)
+    records = [{"op": "add", "contact": manager.flatten_contact(make_contact(100))}]
+    assert manager.log_contact_changes(contacts, records, contacts_filename)
+    compacted = replay(contacts, records)
+    # A crash between writing the compacted snapshot and removing the journal
+    # leaves a journal whose records are already in the snapshot.
+    assert manager.write_snapshot(compacted, contacts_filename)
+    assert os.path.exists(manager.journal_filename(contacts_filename))
+
+    assert flat(manager.read_contacts_from_csv(contacts_filename)) == flat(compacted)
+    assert flat(manager.iter_contacts_from_csv(contacts_filename)) == flat(compacted)
+
+
+def test_journal_of_a_copied_snapshot_is_replayed(book_files):
+    contacts_filename, _, _ = book_files
+    contacts = manager.read_contacts_from_csv(contacts_filename)
+    records = [{"op": "add", "contact": manager.flatten_contact(make_contact(100))}]
+    assert manager.log_contact_changes(contacts, records, contacts_filename)
+    # Copying a book changes the snapshot's modification time only.
+    stat = os.stat(contacts_filename)
+    os.utime(contacts_filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    loaded = manager.read_contacts_from_csv(contacts_filename)
+    assert flat(loaded) == flat(replay(contacts, records))
+
+
+def test_compaction_leaves_the_same_book(book_files, monkeypatch):
+    contacts_filename, _, _ = book_files
+    monkeypatch.setattr(manager, "JOURNAL_COMPACT_BYTES", 0)
+    contacts = manager.read_contacts_from_csv(contacts_filename)
+    contacts.append(make_contact(100))
+    records = [{"op": "add", "contact": manager.flatten_contact(contacts[-1])}]
+    assert manager.log_contact_changes(contacts, records, contacts_filename)
+
+    assert not os.path.exists(manager.journal_filename(contacts_filename))
+    assert flat(manager.read_contacts_from_csv(contacts_filename)) == flat(contacts)
+
+
+def random_records(contacts, rng, count):
+    # Records as several processes sharing a book write them: some with an
+    # index that other records have since moved, some naming a phone that
+    # more than one contact has.
+    contacts = list(contacts)
+    records = []
+    for number in range(count):
+        choice = rng.random()
+        if choice < 0.25 or not contacts:
+            contact = make_contact(
+                1000 + number,
+                group=rng.choice(["Work", "Gym"]),
+                mobile_phone=(
+                    rng.choice(contacts).mobile_phone if rng.random() < 0.3 else None
+                ),
+            )
+            record = {"op": "add", "contact": manager.flatten_contact(contact)}
+        elif choice < 0.55:
+            position = rng.randrange(len(contacts))
+            contact = make_contact(
+                1000 + number,
+                group="Gym",
+                mobile_phone=(
+                    contacts[position].mobile_phone if rng.random() < 0.5 else None
+                ),
+            )
+            record = update_record(contacts, position, contact)
+            record["index"] += rng.choice([0, 0, 1, -1])
+        elif choice < 0.8:
+            position = rng.randrange(len(contacts))
+            record = {
+                "op": "delete",
+                "index": position + rng.choice([0, 0, 2]),
+                "mobile_phone": contacts[position].mobile_phone,
+            }
+        elif choice < 0.9:
+            record = {
+                "op": "group",
+                "mobile_phone": rng.choice(contacts).mobile_phone,
+                "group": rng.choice(["Work", "Gym", ""]),
+            }
+        else:
+            source, target = rng.sample(["Work", "Gym", "Office"], 2)
+            record = {"op": "move_group", "from": source, "to": target}
+        manager.apply_journal_record(contacts, record)
+        records.append(record)
+    return records
+
+
+def test_streamed_and_single_reads_match_the_full_load(tmp_path):
+    for seed in range(5):
+        rng = random.Random(seed)
+        contacts_filename = str(tmp_path / f"contacts-{seed}.csv")
+        # Some phones are shared from the start.
+        contacts = [
+            make_contact(number, mobile_phone=f"555{rng.randrange(24):07d}")
+            for number in range(30)
+        ]
+        assert manager.write_contacts_to_csv(contacts, contacts_filename)
+        records = random_records(contacts, rng, 200)
+        assert manager.log_contact_changes(None, records, contacts_filename)
+
+        loaded = manager.read_contacts_from_csv(contacts_filename)
+        assert flat(loaded) == flat(replay(contacts, records))
+        streamed = manager.iter_contacts_from_csv(contacts_filename)
+        assert flat(streamed) == flat(loaded)
+
+        store = manager.CSVStore(contacts_filename)
+        for contact in loaded:
+            found = store.find_contact(contact.mobile_phone)
+            first = next(
+                index
+                for index, other in enumerate(loaded)
+                if other.phone_keys[0] == contact.phone_keys[0]
+            )
+            assert found is not None
+            assert manager.flatten_contact(found) == manager.flatten_contact(
+                loaded[first]
+            )
@@ -0,0 +1,175 @@
+import threading
+import time
+
+import pytest
+
+import manager
+from conftest import flat, make_contact
+
+
+def add_contact(book, number, group="Work"):
+    contact = {"name": f"Contact {number}", "mobile_phone": f"555{number:07d}"}
+    if group:
+        contact["group"] = group
+    manager.BATCH_COMMANDS["add_contact"](book, {"contact": contact})
+
+
+def save(book):
+    book["store"].save_changes(
+        book["contacts"], book["groups"], book["melodies"], book["indexes"]
+    )
+
+
+def refresh(book, wait=True):
+    return book["store"].refresh(
+        book["contacts"], book["groups"], book["melodies"], book["indexes"], wait
+    )
+
+
+@pytest.fixture
+def held_lock():
+    # Holds a store's lock on another thread until the test is done with it.
+    release = threading.Event()
+    threads = []
+
+    def hold(store):
+        taken = threading.Event()
+
+        def run():
+            with store.locked():
+                taken.set()
+                release.wait()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        threads.append(thread)
+        taken.wait()
+
+    yield hold
+    release.set()
+    for thread in threads:
+        thread.join()
+
+
+def test_refresh_reads_in_what_another_store_saved(book_files):
+    first = manager.open_book(manager.CSVStore(*book_files))
+    second = manager.open_book(manager.CSVStore(*book_files))
+    add_contact(second, 100)
+    save(second)
+
+    assert first["store"].changed()
+    assert refresh(first)
+    assert manager.find_contact_by_phone(first["indexes"], "5550000100") is not None
+    assert flat(first["contacts"]) == flat(second["contacts"])
+    assert manager.member_count(first["indexes"], "group", "Work") == 11
+    assert not first["store"].changed()
+
+
+def test_save_keeps_what_another_store_saved(book_files):
+    first = manager.open_book(manager.CSVStore(*book_files))
+    second = manager.open_book(manager.CSVStore(*book_files))
+    add_contact(first, 100)
+    add_contact(second, 101)
+    save(first)
+    save(second)
+
+    loaded = manager.CSVStore(*book_files).load_contacts()
+    assert {"Contact 100", "Contact 101"} <= {contact.name for contact in loaded}
+    # The other store's contact joins this store's book after its own unsaved
+    # one, so only what the books hold is compared.
+    assert sorted(flat(loaded), key=str) == sorted(flat(second["contacts"]), key=str)
+
+
+def test_unchanged_book_refreshes_without_the_lock(book_files, held_lock):
+    book = manager.open_book(manager.CSVStore(*book_files))
+    held_lock(manager.CSVStore(*book_files))
+
+    start = time.perf_counter()
+    assert not refresh(book)
+    assert time.perf_counter() - start < 1
+
+
+def test_refresh_without_wait_skips_a_locked_book(book_files, held_lock):
+    book = manager.open_book(manager.CSVStore(*book_files))
+    other = manager.open_book(manager.CSVStore(*book_files))
+    add_contact(other, 100)
+    save(other)
+    held_lock(other["store"])
+
+    assert not refresh(book, wait=False)
+    assert manager.find_contact_by_phone(book["indexes"], "5550000100") is None
+    assert book["store"].changed()
+
+
+def sharded_book(tmp_path, partition):
+    contacts = [
+        make_contact(number, group="Work" if number % 2 else "Gym")
+        for number in range(40)
+    ]
+    groups = [{"name": "Work", "count": 20}, {"name": "Gym", "count": 20}]
+    directory = str(tmp_path / "contacts")
+    manager.ShardedStore(directory, partition).save_all(contacts, groups, [])
+    return directory
+
+
+@pytest.mark.parametrize("partition", ["hash", "group"])
+def test_shard_saves_merge(tmp_path, partition):
+    directory = sharded_book(tmp_path, partition)
+    first = manager.open_book(manager.ShardedStore(directory))
+    second = manager.open_book(manager.ShardedStore(directory))
+    # Both stores change the same shards.
+    add_contact(first, 100)
+    add_contact(second, 101)
+    manager.BATCH_COMMANDS["delete_contact"](first, {"mobile_phone": "5550000001"})
+    manager.BATCH_COMMANDS["set_group"](
+        second, {"mobile_phone": "5550000003", "group": "Gym"}
+    )
+    save(first)
+    save(second)
+
+    loaded = manager.ShardedStore(directory).load_contacts()
+    names = {contact.name for contact in loaded}
+    assert {"Contact 100", "Contact 101"} <= names
+    assert "Contact 1" not in names
+    assert len(loaded) == 41
+    assert [contact.group for contact in loaded if contact.name == "Contact 3"] == [
+        "Gym"
+    ]
+    assert sorted(flat(loaded), key=str) == sorted(flat(second["contacts"]), key=str)
+
+
+def test_phones_are_checked_against_unloaded_shards(tmp_path):
+    directory = sharded_book(tmp_path, "group")
+    book = manager.open_book(manager.ShardedStore(directory, only_groups=["Work"]))
+
+    with pytest.raises(ValueError, match="already used"):
+        manager.BATCH_COMMANDS["add_contact"](
+            book,
+            {"contact": {"name": "New", "mobile_phone": "5550000002"}},
+        )
+
+
+@pytest.mark.parametrize("refresh_first", [True, False])
+def test_sharded_save_indexes_the_shards_it_reads(tmp_path, refresh_first):
+    directory = sharded_book(tmp_path, "group")
+    store = manager.ShardedStore(directory, only_groups=["Work"])
+    book = manager.open_book(store)
+    add_contact(book, 100, group="Gym")
+    if refresh_first:
+        save(book)
+    else:
+        # Saving without a refresh first reads in the shard that the new
+        # contact joined.
+        with store.locked():
+            store.save_contact_changes(book["contacts"], book["indexes"])
+
+    gym = [
+        contact
+        for contact in manager.ShardedStore(directory).load_contacts()
+        if contact.group == "Gym"
+    ]
+    assert len(gym) == 21
+    for contact in gym:
+        assert manager.find_contact_by_phone(book["indexes"], contact.mobile_phone)
+    assert manager.member_count(book["indexes"], "group", "Gym") == 21
+    assert manager.member_count(book["indexes"], "group", "Work") == 20